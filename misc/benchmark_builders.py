@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# Copyright (c) 2026 MetaBrainz Foundation
+# License: MIT, see LICENSE for details
+"""
+Compare how long converting objects of each entity type into documents takes
+by walking each path with :func:`sir.querying.iterate_path_values` and with the
+builders compiled by :func:`sir.schema.searchentities.compile_fields`. Both
+include the transform functions and the conversion of UUIDs, but not the
+wscompat ``_store`` field.
+
+The objects are built in memory by following the paths of the fields, with
+every one-to-many relationship holding ``--children`` objects, so no
+database is required::
+
+    python misc/benchmark_builders.py --rows 2000 --entity-type recording
+"""
+import argparse
+import os
+import sys
+import time
+
+from datetime import date, datetime
+from uuid import UUID, uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from sir.querying import iterate_path_values  # noqa: E402
+from sir.schema import SCHEMA  # noqa: E402
+from sqlalchemy.orm.attributes import InstrumentedAttribute  # noqa: E402
+from sqlalchemy.orm.interfaces import ONETOMANY, MANYTOONE  # noqa: E402
+from sqlalchemy.orm.properties import (ColumnProperty,  # noqa: E402
+                                       RelationshipProperty)
+
+
+def build_object(model, paths, children):
+    """
+    Return an instance of ``model`` whose attributes along ``paths`` are
+    filled in.
+    """
+    obj = model()
+    subpaths = {}
+    for path in paths:
+        pathelem, _, rest = path.partition(".")
+        subpaths.setdefault(pathelem, []).append(rest)
+    for pathelem, rests in subpaths.items():
+        column = getattr(model, pathelem)
+        if not isinstance(column, InstrumentedAttribute):
+            continue
+        prop = column.property
+        rests = [rest for rest in rests if rest]
+        if isinstance(prop, RelationshipProperty) and rests:
+            target = prop.mapper.class_
+            if prop.direction == ONETOMANY:
+                setattr(obj, pathelem, [build_object(target, rests, children)
+                                        for _ in range(children)])
+            elif prop.direction == MANYTOONE:
+                setattr(obj, pathelem, build_object(target, rests, children))
+        elif isinstance(prop, ColumnProperty):
+            try:
+                setattr(obj, pathelem, column_value(prop, pathelem, obj))
+            except Exception:
+                pass
+    return obj
+
+
+def column_value(prop, name, obj):
+    """
+    Return a value of the type of the column of ``prop``, so the transform
+    functions of the fields can handle it.
+    """
+    try:
+        python_type = prop.columns[0].type.python_type
+    except (IndexError, NotImplementedError):
+        python_type = str
+    if python_type is bool:
+        return True
+    if issubclass(python_type, int):
+        return id(obj) % 1000 + 1
+    if issubclass(python_type, UUID):
+        return uuid4()
+    if issubclass(python_type, datetime):
+        return datetime.now()
+    if issubclass(python_type, date):
+        return date.today()
+    return "%s-%d" % (name, id(obj))
+
+
+def convert_by_paths(entity, obj):
+    data = {}
+    for field in entity.fields:
+        tempvals = set()
+        for path in field.paths:
+            for value in iterate_path_values(path, obj):
+                if value is not None:
+                    if isinstance(value, list):
+                        tempvals.update(set(value))
+                    else:
+                        tempvals.add(value)
+        if field.transformfunc is not None:
+            tempvals = field.transformfunc(tempvals)
+        if isinstance(tempvals, (set, list)) and len(tempvals) == 1:
+            tempvals = tempvals.pop()
+        if tempvals is not None and tempvals:
+            if isinstance(tempvals, UUID):
+                tempvals = str(tempvals)
+            elif isinstance(tempvals, (set, list)):
+                tempvals = [str(tempval) if isinstance(tempval, UUID)
+                            else tempval for tempval in tempvals]
+            data[field.name] = tempvals
+    return data
+
+
+def convert_compiled(entity, obj):
+    return entity.builder(obj)
+
+
+def comparable(data):
+    """
+    Return ``data`` with the values of multi-valued fields sorted, because
+    their order depends on the order they have been collected in.
+    """
+    return dict((name, sorted(value, key=repr)
+                 if isinstance(value, list) else value)
+                for name, value in data.items())
+
+
+def measure(function, entity, objects):
+    start = time.perf_counter()
+    for obj in objects:
+        function(entity, obj)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entity-type", action="append",
+                        choices=SCHEMA.keys())
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--children", type=int, default=3)
+    args = parser.parse_args()
+
+    print("%-20s %12s %12s %8s" % ("core", "paths rows/s", "built rows/s",
+                                    "speed-up"))
+    for name in args.entity_type or sorted(SCHEMA.keys()):
+        entity = SCHEMA[name]
+        paths = [path for field in entity.fields for path in field.paths]
+        objects = [build_object(entity.model, paths, args.children)
+                   for _ in range(args.rows)]
+        expected = [comparable(convert_by_paths(entity, obj))
+                    for obj in objects[:10]]
+        actual = [comparable(convert_compiled(entity, obj))
+                  for obj in objects[:10]]
+        if expected != actual:
+            print("%-20s documents differ" % name)
+            continue
+        old = measure(convert_by_paths, entity, objects)
+        new = measure(convert_compiled, entity, objects)
+        print("%-20s %12.0f %12.0f %7.1fx" % (name, args.rows / old,
+                                               args.rows / new, old / new))
+
+
+if __name__ == "__main__":
+    main()
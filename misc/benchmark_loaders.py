@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# Copyright (c) 2026 MetaBrainz Foundation
+# License: MIT, see LICENSE for details
+"""
+Compare the eager loading strategies of the entity queries (see
+:meth:`sir.schema.searchentities.SearchEntity.loader_strategies`) on the
+fixtures in ``test/sql``.
+
+The fixtures of each entity type are loaded into the database configured in
+``config.ini`` within a transaction that's rolled back afterwards, like the
+tests in ``test/test_indexing_real_data.py`` do. For each strategy, the
+number of SQL statements and the time it takes to query all rows are
+reported::
+
+    python misc/benchmark_loaders.py --entity-type recording --repeat 20
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from sir import config, util  # noqa: E402
+from sir.schema import SCHEMA  # noqa: E402
+from sir.schema.searchentities import (LOADER_STRATEGIES,  # noqa: E402
+                                       selectin_chunk_size)
+from sqlalchemy import event, text  # noqa: E402
+from sqlalchemy.orm import Session  # noqa: E402
+
+SQL_DIRECTORY = os.path.join(os.path.dirname(__file__), "..", "test", "sql")
+
+
+def measure(session, entity, repeat, statements):
+    # Rebuild the query with the current configuration
+    entity._query = None
+    query = entity.query
+    count = len(statements)
+    start = time.perf_counter()
+    with selectin_chunk_size():
+        for _ in range(repeat):
+            rows = query.with_session(session).all()
+            session.expunge_all()
+    duration = (time.perf_counter() - start) / repeat
+    return len(rows), (len(statements) - count) // repeat, duration
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entity-type", action="append",
+                        choices=SCHEMA.keys())
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--selectin-chunk-size", type=int, default=0)
+    args = parser.parse_args()
+
+    config.read_config()
+    if args.selectin_chunk_size:
+        config.CFG.set("sir", "selectin_chunk_size",
+                       str(args.selectin_chunk_size))
+    connection = util.engine().connect()
+    statements = []
+    event.listen(connection, "before_cursor_execute",
+                 lambda *args: statements.append(args[2]))
+
+    print("%-15s %-10s %6s %10s %10s" % ("core", "strategy", "rows",
+                                         "statements", "ms/query"))
+    for name in args.entity_type or SCHEMA.keys():
+        path = os.path.join(SQL_DIRECTORY, "%s.sql" % name)
+        if not os.path.exists(path):
+            continue
+        transaction = connection.begin()
+        session = Session(bind=connection)
+        try:
+            with open(path, encoding="utf-8") as f:
+                session.execute(text(f.read()))
+            for strategy in sorted(LOADER_STRATEGIES):
+                config.CFG.set("sir", "eager_loading", strategy)
+                rows, count, duration = measure(session, SCHEMA[name],
+                                                args.repeat, statements)
+                print("%-15s %-10s %6d %10d %10.1f" % (name, strategy, rows,
+                                                       count,
+                                                       duration * 1000))
+        finally:
+            session.close()
+            transaction.rollback()
+    connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,12 +5,14 @@ import logging
 import multiprocessing
 import configparser
 
+from datetime import datetime
 from . import config, init_sentry_sdk
 from .amqp.extension_generation import generate_extension
 from .amqp.handler import watch
 from .amqp.publisher import publish
 from .amqp.setup import setup_rabbitmq
 from .indexing import reindex
+from .shards import export, load
 from .schema import SCHEMA
 from .trigger_generation import generate_func
 
@@ -18,6 +20,44 @@ from .trigger_generation import generate_func
 logger = logging.getLogger("sir")
 
 
+def id_range(value):
+    """
+    Parse a range of ids given as ``LOWER:UPPER``.
+
+    :param str value:
+    :rtype: (int, int)
+    """
+    try:
+        lower, upper = [int(bound) if bound.strip() else None
+                        for bound in value.split(":")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("%r is not a range of ids like "
+                                         "LOWER:UPPER" % value)
+    if lower is not None and upper is not None and lower >= upper:
+        raise argparse.ArgumentTypeError("%r is an empty range of ids" %
+                                         value)
+    return (lower, upper)
+
+
+def shard(value):
+    """
+    Parse a shard given as ``K/N``, where ``K`` counts from 1 to ``N``.
+
+    :param str value:
+    :returns: The index of the shard, counting from 0, and the number of
+              shards
+    :rtype: (int, int)
+    """
+    try:
+        k, n = [int(part) for part in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("%r is not a shard like K/N" % value)
+    if not 1 <= k <= n:
+        raise argparse.ArgumentTypeError("Shard %d doesn't exist among %d "
+                                         "shards" % (k, n))
+    return (k - 1, n)
+
+
 def main():
 
     parser = argparse.ArgumentParser(prog="sir")
@@ -32,6 +72,85 @@ def main():
     reindex_parser.add_argument('--entity-type', action='append',
                                 help="Which entity types to index.",
                                 choices=SCHEMA.keys())
+    reindex_parser.add_argument('--resume', action="store_true",
+                                help="Skip the ids that a previous run with "
+                                "the same run id has already committed to "
+                                "Solr. Requires checkpoint_file to be set.")
+    reindex_parser.add_argument('--run-id', action="store",
+                                help="Identifies the run in the checkpoint "
+                                "file (reindex by default) and, with "
+                                "shard_leases, in the lease table, where it "
+                                "is required and has to be new for each "
+                                "sharded reindex.")
+    reindex_parser.add_argument('--shadow', action="store_true",
+                                help="Index into a shadow core of each "
+                                "entity type and swap it with the live core "
+                                "once done.")
+    reindex_parser.add_argument('--differential', action="store_true",
+                                help="Only send documents that have changed "
+                                "since they were last sent. Requires "
+                                "hash_file to be set.")
+    reindex_parser.add_argument('--since', action="store",
+                                type=datetime.fromisoformat,
+                                help="Only reindex rows that have changed "
+                                "since this ISO 8601 timestamp, according to "
+                                "the last_updated columns of their own and "
+                                "related tables.")
+    reindex_parser.add_argument('--ids-file', action="store",
+                                help="Only reindex rows whose ids are listed "
+                                "in this file, one per line and optionally "
+                                "preceded by the entity type. Use - to read "
+                                "from standard input.")
+    reindex_parser.add_argument('--id-range', action="append",
+                                type=id_range,
+                                help="Only reindex rows whose ids are within "
+                                "LOWER:UPPER, excluding UPPER. Either bound "
+                                "may be omitted. Can be given several times.")
+    reindex_parser.add_argument('--shard', action="store", type=shard,
+                                help="Only reindex shard K of N, so N hosts "
+                                "can reindex disjoint parts of the same "
+                                "cores at the same time.")
+
+    export_parser = subparsers.add_parser("export",
+                                          help="Writes the documents of all "
+                                          "or a single entity type to "
+                                          "compressed JSONL files instead of "
+                                          "sending them to Solr")
+    export_parser.set_defaults(func=export)
+    export_parser.add_argument('--entity-type', action='append',
+                               help="Which entity types to export.",
+                               choices=SCHEMA.keys())
+    export_parser.add_argument('-o', '--directory', action="store",
+                               default="export",
+                               help="The directory to write the files into, "
+                               "with a subdirectory per entity type")
+    export_parser.add_argument('-c', '--compression', action="store",
+                               default="gzip",
+                               choices=["gzip", "zstd", "none"],
+                               help="How to compress the files. zstd "
+                               "requires the zstandard package.")
+    export_parser.add_argument('-s', '--shard-size', action="store",
+                               type=int, default=100000,
+                               help="The number of documents per file")
+
+    load_parser = subparsers.add_parser("load",
+                                        help="Sends files written by the "
+                                        "export subcommand to Solr")
+    load_parser.set_defaults(func=load)
+    load_parser.add_argument('--entity-type', action='append',
+                             help="Which entity types to load.",
+                             choices=SCHEMA.keys())
+    load_parser.add_argument('-i', '--directory', action="store",
+                             default="export",
+                             help="The directory the files have been "
+                             "exported to")
+    load_parser.add_argument('-p', '--parallel', action="store",
+                             type=int, default=4,
+                             help="The number of requests to Solr running "
+                             "at the same time")
+    load_parser.add_argument('--resume', action="store_true",
+                             help="Skip the documents that a previous load "
+                             "from the same directory has already sent")
 
     generate_trigger_parser = subparsers.add_parser("triggers",
                                                     help="Generate triggers")
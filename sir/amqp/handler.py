@@ -12,7 +12,7 @@ import sir.indexing as indexing
 import time
 
 from sir.amqp import message
-from sir import config
+from sir import config, dimensions
 from sir.schema import SCHEMA, generate_update_map
 from sir.indexing import live_index
 from sir.trigger_generation.paths import second_last_model_in_path, generate_query, generate_filtered_query
@@ -258,6 +258,9 @@ class Handler(object):
         """
         logger.debug("Processing `index` message from table: %s" % parsed_message.table_name)
         logger.debug("Message columns %s" % parsed_message.columns)
+        # The changed row is loaded again with the other cached rows before
+        # the entities referring to it are indexed
+        dimensions.invalidate(parsed_message.table_name)
         if parsed_message.operation == 'delete':
             self._index_by_fk(parsed_message)
         else:
@@ -0,0 +1,208 @@
+# Copyright (c) 2026 MetaBrainz Foundation
+# License: MIT, see LICENSE for details
+"""
+This module keeps track of the bounds of a reindex run whose documents have
+been sent and committed to Solr, so an interrupted run can be resumed.
+"""
+import os
+import sqlite3
+
+
+__all__ = ["CheckpointStore", "merge_ranges", "range_covered"]
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS bounds (
+    run_id TEXT NOT NULL,
+    core TEXT NOT NULL,
+    lower INTEGER NOT NULL,
+    upper INTEGER,
+    expected INTEGER,
+    sent INTEGER NOT NULL DEFAULT 0,
+    committed INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (run_id, core, lower)
+)
+"""
+
+
+class CheckpointStore(object):
+    """
+    Records the progress of the bounds of a reindex run in a SQLite database.
+
+    For each bound, the processes sending documents to Solr record how many
+    of its documents they have sent and, once the process that queried the
+    database is done with it, how many documents it has in total. After a
+    commit, the bounds whose documents have all been sent before the commit
+    started are marked as committed.
+
+    The database connection is opened lazily in each process using the
+    store, so instances can be passed to other processes.
+
+    :param str path: The path of the SQLite database.
+    :param str run_id: Identifies the reindex run.
+    """
+
+    def __init__(self, path, run_id):
+        self.path = path
+        self.run_id = run_id
+        self._connection = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_connection"] = None
+        state["_pid"] = None
+        return state
+
+    @property
+    def connection(self):
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=60,
+                                               isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(_SCHEMA)
+            self._pid = os.getpid()
+        return self._connection
+
+    def reset(self, core):
+        """
+        Forget all progress of ``core`` in this run.
+
+        :param str core:
+        """
+        self.connection.execute(
+            "DELETE FROM bounds WHERE run_id = ? AND core = ?",
+            (self.run_id, core))
+
+    def discard_uncommitted(self, core):
+        """
+        Forget the progress of the bounds of ``core`` in this run that
+        haven't been committed. Their documents are sent again when the run
+        is resumed, and the counts of the documents sent before must not be
+        added to those.
+
+        :param str core:
+        """
+        self.connection.execute(
+            "DELETE FROM bounds WHERE run_id = ? AND core = ? "
+            "AND committed = 0",
+            (self.run_id, core))
+
+    def add_sent(self, core, counts):
+        """
+        Record that documents of some bounds of ``core`` have been sent.
+
+        :param str core:
+        :param counts: Maps bounds to the number of their documents that
+                       have been sent.
+        :type counts: dict((int, int), int)
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO bounds (run_id, core, lower, upper, sent) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (run_id, core, lower) "
+                "DO UPDATE SET sent = sent + excluded.sent",
+                [(self.run_id, core, lower, upper, count)
+                 for (lower, upper), count in counts.items()])
+
+    def set_expected(self, core, bounds, count):
+        """
+        Record that the bounds ``bounds`` of ``core`` contain ``count``
+        documents.
+
+        :param str core:
+        :param bounds:
+        :type bounds: (int, int)
+        :param int count:
+        """
+        lower, upper = bounds
+        self.connection.execute(
+            "INSERT INTO bounds (run_id, core, lower, upper, expected) "
+            "VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (run_id, core, lower) "
+            "DO UPDATE SET expected = excluded.expected",
+            (self.run_id, core, lower, upper, count))
+
+    def sent_bounds(self, core):
+        """
+        Return the lower bounds of all bounds of ``core`` whose documents
+        have all been sent, but that haven't been committed yet.
+
+        :param str core:
+        :rtype: [int]
+        """
+        return [row[0] for row in self.connection.execute(
+            "SELECT lower FROM bounds WHERE run_id = ? AND core = ? "
+            "AND expected IS NOT NULL AND sent >= expected "
+            "AND committed = 0",
+            (self.run_id, core))]
+
+    def mark_committed(self, core, lowers):
+        """
+        Mark the bounds of ``core`` starting at ``lowers`` as committed.
+
+        :param str core:
+        :param [int] lowers:
+        """
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE bounds SET committed = 1 "
+                "WHERE run_id = ? AND core = ? AND lower = ?",
+                [(self.run_id, core, lower) for lower in lowers])
+
+    def committed_ranges(self, core):
+        """
+        Return the id ranges of ``core`` that have been committed, with
+        adjacent ranges merged.
+
+        :param str core:
+        :rtype: [(int, int)]
+        """
+        return merge_ranges(self.connection.execute(
+            "SELECT lower, upper FROM bounds WHERE run_id = ? AND core = ? "
+            "AND committed = 1",
+            (self.run_id, core)))
+
+
+def merge_ranges(ranges):
+    """
+    Merge overlapping and adjacent half-open ranges. An upper bound of
+    ``None`` means the range is unbounded.
+
+    :param ranges:
+    :type ranges: [(int, int)]
+    :rtype: [(int, int)]
+    """
+    merged = []
+    for lower, upper in sorted(ranges):
+        if merged:
+            last_lower, last_upper = merged[-1]
+            if last_upper is None:
+                break
+            if lower <= last_upper:
+                if upper is None or upper > last_upper:
+                    merged[-1] = (last_lower, upper)
+                continue
+        merged.append((lower, upper))
+    return merged
+
+
+def range_covered(bounds, ranges):
+    """
+    Return whether ``bounds`` lie completely within one of ``ranges``,
+    as returned by :func:`merge_ranges`.
+
+    :param bounds:
+    :type bounds: (int, int)
+    :param ranges:
+    :type ranges: [(int, int)]
+    :rtype: bool
+    """
+    lower, upper = bounds
+    for range_lower, range_upper in ranges:
+        if range_lower <= lower and (
+                range_upper is None or
+                (upper is not None and upper <= range_upper)):
+            return True
+    return False
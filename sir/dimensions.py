@@ -0,0 +1,230 @@
+# Copyright (c) 2026 MetaBrainz Foundation
+# License: MIT, see LICENSE for details
+"""
+This module caches small, nearly static lookup tables (like ``gender``,
+``language`` or the ``*_type`` tables) that most entity types refer to.
+
+With ``dimension_cache`` enabled in the ``sir`` section of the
+configuration, all rows of those tables are loaded once before the worker
+processes are started, which inherit them. The queries built by
+:meth:`sir.schema.searchentities.SearchEntity.build_entity_query` then only
+load the foreign key columns of the rows referring to them, and the related
+rows are filled in from the cache as the rows are loaded.
+
+Only many-to-one relationships whose paths end in a column of the lookup
+table are cached. Related rows that are missing from the cache (because
+they have been added after it was loaded) are loaded lazily.
+
+The cache is dropped when an AMQP message about a change to one of those
+tables arrives and loaded again before the next batch of messages is
+indexed.
+"""
+from logging import getLogger
+from sqlalchemy import event
+from sqlalchemy.orm.attributes import (InstrumentedAttribute,
+                                       instance_dict,
+                                       set_committed_value)
+from sqlalchemy.orm.interfaces import MANYTOONE
+from sqlalchemy.orm.properties import RelationshipProperty
+
+
+__all__ = ["DimensionCache", "is_dimension_table", "dimension_relationships",
+           "is_cached", "load", "invalidate"]
+
+
+logger = getLogger("sir")
+
+
+#: Lookup tables whose names don't end in ``_type``.
+DIMENSION_TABLES = frozenset(["gender", "language", "medium_format",
+                              "release_packaging", "release_status",
+                              "script"])
+
+
+def is_dimension_table(name):
+    """
+    Return whether the table ``name`` is a lookup table that may be cached.
+
+    :param str name:
+    :rtype: bool
+    """
+    return name.endswith("_type") or name in DIMENSION_TABLES
+
+
+def _is_dimension_relationship(prop):
+    return (prop.direction == MANYTOONE and
+            len(prop.local_columns) == 1 and
+            len(prop.mapper.primary_key) == 1 and
+            is_dimension_table(prop.mapper.persist_selectable.name))
+
+
+def dimension_relationships(entities):
+    """
+    Return the many-to-one relationships to lookup tables that are followed
+    by the paths of ``entities``. Relationships some path continues past
+    the columns of the lookup table with are left out.
+
+    :param entities:
+    :type entities: [sir.schema.searchentities.SearchEntity]
+    :rtype: set(sqlalchemy.orm.properties.RelationshipProperty)
+    """
+    found = set()
+    excluded = set()
+    for entity in entities:
+        paths = [path for field in entity.fields for path in field.paths]
+        paths.extend(entity.extrapaths or [])
+        for path in paths:
+            model = entity.model
+            split_path = path.split(".")
+            for i, pathelem in enumerate(split_path):
+                column = getattr(model, pathelem, None)
+                if not (isinstance(column, InstrumentedAttribute) and
+                        isinstance(column.property, RelationshipProperty)):
+                    break
+                prop = column.property
+                if _is_dimension_relationship(prop):
+                    if len(split_path) - i > 2:
+                        excluded.add(prop)
+                    else:
+                        found.add(prop)
+                model = prop.mapper.class_
+    return found - excluded
+
+
+class DimensionCache(object):
+    """
+    Caches all rows of the targets of ``relationships`` by their primary
+    key and fills in the relationships of the objects referring to them when
+    they get loaded.
+
+    :param relationships:
+    :type relationships: [sqlalchemy.orm.properties.RelationshipProperty]
+    """
+
+    def __init__(self, relationships):
+        self.relationships = set(relationships)
+        self.rows = {}
+        self._listening = set()
+
+    @property
+    def loaded(self):
+        return bool(self.rows)
+
+    def load(self, session):
+        """
+        Load all rows of the cached tables with ``session``.
+
+        :param sqlalchemy.orm.session.Session session:
+        """
+        rows = {}
+        for prop in self.relationships:
+            model = prop.mapper.class_
+            if model in rows:
+                continue
+            objs = session.query(model).all()
+            for obj in objs:
+                session.expunge(obj)
+            pk = prop.mapper.primary_key[0].key
+            rows[model] = dict((getattr(obj, pk), obj) for obj in objs)
+        self.rows = rows
+        logger.info("Cached %d rows of %d lookup tables",
+                    sum(len(r) for r in rows.values()), len(rows))
+        self._listen()
+
+    def invalidate(self):
+        """
+        Drop the cached rows, until :meth:`load` is called again.
+        """
+        self.rows = {}
+
+    def _listen(self):
+        by_parent = {}
+        for prop in self.relationships:
+            fk = prop.parent.get_property_by_column(
+                list(prop.local_columns)[0])
+            by_parent.setdefault(prop.parent.class_, []).append(
+                (prop.key, fk.key, prop.mapper.class_))
+        for parent, props in by_parent.items():
+            if parent in self._listening:
+                continue
+            event.listen(parent, "load", _load_listener(self, props),
+                         propagate=True)
+            self._listening.add(parent)
+
+    def populate(self, obj, props):
+        """
+        Fill in the relationships ``props`` of ``obj`` from the cache.
+
+        :param obj: A :ref:`declarative <sqla:declarative_toplevel>` object.
+        :param props: Triples of the names of a relationship and its
+                      foreign key and the class of the cached rows.
+        """
+        if not self.rows:
+            return
+        dict_ = instance_dict(obj)
+        for key, fk_key, model in props:
+            if fk_key not in dict_:
+                # The foreign key hasn't been loaded
+                continue
+            fk = dict_[fk_key]
+            if fk is None:
+                value = None
+            else:
+                value = self.rows[model].get(fk)
+                if value is None:
+                    continue
+            set_committed_value(obj, key, value)
+
+
+def _load_listener(cache, props):
+    def on_load(target, context):
+        cache.populate(target, props)
+    return on_load
+
+
+_cache = None
+
+
+def _get_cache():
+    global _cache
+    if _cache is None:
+        from .schema import SCHEMA
+        _cache = DimensionCache(dimension_relationships(SCHEMA.values()))
+    return _cache
+
+
+def is_cached(prop):
+    """
+    Return whether the values of the relationship ``prop`` are taken from
+    the cache of this process.
+
+    :param sqlalchemy.orm.properties.RelationshipProperty prop:
+    :rtype: bool
+    """
+    return prop in _get_cache().relationships
+
+
+def load(session):
+    """
+    Load the cache of this process with ``session`` unless it's already
+    loaded.
+
+    :param sqlalchemy.orm.session.Session session:
+    """
+    cache = _get_cache()
+    if not cache.loaded:
+        cache.load(session)
+
+
+def invalidate(table_name):
+    """
+    Drop the cache of this process if ``table_name`` is a cached table.
+
+    :param str table_name:
+    """
+    if _cache is None or not is_dimension_table(table_name):
+        return
+    if _cache.loaded:
+        logger.info("Dropping the cached lookup tables after a change to %s",
+                    table_name)
+    _cache.invalidate()
@@ -0,0 +1,212 @@
+# Copyright (c) 2026 MetaBrainz Foundation
+# License: MIT, see LICENSE for details
+"""
+This module keeps track of hashes of the documents that have been sent to
+Solr, so a reindex can skip documents that haven't changed since.
+"""
+import hashlib
+import os
+import sqlite3
+
+import ujson
+
+
+__all__ = ["HashStore", "HashFilter", "document_hash", "document_key"]
+
+
+_SCHEMA = ["""
+CREATE TABLE IF NOT EXISTS documents (
+    core TEXT NOT NULL,
+    id TEXT NOT NULL,
+    hash BLOB,
+    pending BLOB,
+    PRIMARY KEY (core, id)
+) WITHOUT ROWID
+""", """
+CREATE TABLE IF NOT EXISTS stats (
+    core TEXT PRIMARY KEY,
+    checked INTEGER NOT NULL DEFAULT 0,
+    changed INTEGER NOT NULL DEFAULT 0
+)
+"""]
+
+# SQLite limits the number of parameters of a statement
+_LOOKUP_SIZE = 500
+
+
+def document_key(doc):
+    """
+    Return the value of the unique key of ``doc``.
+
+    :param dict doc:
+    :rtype: str
+    """
+    return str(doc["mbid"] if "mbid" in doc else doc["id"])
+
+
+def document_hash(doc):
+    """
+    Return a hash of the content of ``doc`` that doesn't depend on the order
+    of its keys or of the values of its multi-valued fields.
+
+    :param dict doc:
+    :rtype: bytes
+    """
+    canonical = dict((key, sorted(value, key=str)
+                      if isinstance(value, list) else value)
+                     for key, value in doc.items())
+    return hashlib.blake2b(ujson.dumps(canonical, sort_keys=True,
+                                       ensure_ascii=False).encode("utf-8"),
+                           digest_size=16).digest()
+
+
+class HashStore(object):
+    """
+    Records the hashes of the documents of each core in a SQLite database.
+
+    Processes converting documents check their hashes with :meth:`changed`,
+    which records the new hashes of changed documents as pending. Once all
+    documents of a core have been sent, the pending hashes replace the
+    recorded ones, see :meth:`promote`.
+
+    The database connection is opened lazily in each process using the
+    store, so instances can be passed to other processes.
+
+    :param str path: The path of the SQLite database.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_connection"] = None
+        state["_pid"] = None
+        return state
+
+    @property
+    def connection(self):
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=60,
+                                               isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            for statement in _SCHEMA:
+                self._connection.execute(statement)
+            self._pid = os.getpid()
+        return self._connection
+
+    def start(self, core):
+        """
+        Discard the pending hashes and the statistics of ``core``.
+
+        :param str core:
+        """
+        with self.connection:
+            self.connection.execute(
+                "UPDATE documents SET pending = NULL "
+                "WHERE core = ? AND pending IS NOT NULL", (core,))
+            self.connection.execute("DELETE FROM stats WHERE core = ?",
+                                    (core,))
+
+    def changed(self, core, hashes):
+        """
+        Return the keys of the documents of ``core`` whose hash differs from
+        the recorded one and record their new hashes as pending.
+
+        :param str core:
+        :param hashes: Maps the keys of documents to their hashes
+        :type hashes: dict(str, bytes)
+        :rtype: set(str)
+        """
+        keys = list(hashes)
+        recorded = {}
+        for i in range(0, len(keys), _LOOKUP_SIZE):
+            chunk = keys[i:i + _LOOKUP_SIZE]
+            recorded.update(self.connection.execute(
+                "SELECT id, hash FROM documents WHERE core = ? AND id IN "
+                "(%s)" % ", ".join("?" * len(chunk)), [core] + chunk))
+        changed = set(key for key, value in hashes.items()
+                      if recorded.get(key) != value)
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO documents (core, id, pending) VALUES (?, ?, ?) "
+                "ON CONFLICT (core, id) DO UPDATE SET pending = "
+                "excluded.pending",
+                [(core, key, hashes[key]) for key in changed])
+            self.connection.execute(
+                "INSERT INTO stats (core, checked, changed) VALUES (?, ?, ?) "
+                "ON CONFLICT (core) DO UPDATE SET "
+                "checked = checked + excluded.checked, "
+                "changed = changed + excluded.changed",
+                (core, len(hashes), len(changed)))
+        return changed
+
+    def promote(self, core):
+        """
+        Replace the recorded hashes of ``core`` with the pending ones.
+
+        :param str core:
+        :returns: The number of hashes that have been replaced
+        :rtype: int
+        """
+        with self.connection:
+            return self.connection.execute(
+                "UPDATE documents SET hash = pending, pending = NULL "
+                "WHERE core = ? AND pending IS NOT NULL", (core,)).rowcount
+
+    def stats(self, core):
+        """
+        Return how many documents of ``core`` have been checked and how many
+        of those have changed since :meth:`start`.
+
+        :param str core:
+        :rtype: (int, int)
+        """
+        row = self.connection.execute(
+            "SELECT checked, changed FROM stats WHERE core = ?",
+            (core,)).fetchone()
+        return tuple(row) if row else (0, 0)
+
+
+class HashFilter(object):
+    """
+    Collects documents of ``core`` and only puts those that have changed
+    according to ``store`` into ``queue``, checking ``batch_size`` documents
+    at a time.
+
+    :meth:`flush` has to be called once no more documents will be added.
+
+    :param queue: Any object with a ``put`` method.
+    :param HashStore store:
+    :param str core:
+    :param int batch_size:
+    """
+
+    def __init__(self, queue, store, core, batch_size):
+        self.queue = queue
+        self.store = store
+        self.core = core
+        self.batch_size = batch_size
+        #: The number of unchanged documents that have been dropped.
+        self.skipped = 0
+        self._documents = {}
+
+    def put(self, doc):
+        self._documents[document_key(doc)] = doc
+        if len(self._documents) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._documents:
+            return
+        documents = self._documents
+        self._documents = {}
+        changed = self.store.changed(
+            self.core, dict((key, document_hash(doc))
+                            for key, doc in documents.items()))
+        self.skipped += len(documents) - len(changed)
+        for key, doc in documents.items():
+            if key in changed:
+                self.queue.put(doc)
@@ -1,31 +1,76 @@
 # Copyright (c) 2014, 2015, 2017 Lukas Lalinsky, Wieland Hoffmann, MetaBrainz Foundation
 # License: MIT, see LICENSE for details
+import asyncio
 import multiprocessing
 import signal
+import sys
+import threading
+import time
 
 import sentry_sdk
+import ujson
 
-from . import config, querying, util
+from . import (checkpoint, config, dimensions, hashstore, querying, sharding,
+               transport, util, workers)
+from .memo import batch_memo
 from .schema import SCHEMA
+from .schema.searchentities import selectin_chunk_size
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from configparser import NoOptionError
+from contextlib import nullcontext
 from functools import partial
+from heapq import heappop, heappush
 from logging import getLogger, DEBUG, INFO
 from sqlalchemy import and_
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import defer, Session
+from sqlalchemy.orm.attributes import set_committed_value
 from .util import SIR_EXIT
 from ctypes import c_bool
 
 __all__ = ["reindex", "index_entity", "queue_to_solr", "send_data_to_solr",
            "_multiprocessed_import", "_index_entity_process_wrapper", "live_index",
-           "live_index_entity"]
+           "live_index_entity", "convert_rows"]
 
 
 logger = getLogger("sir")
 
+#: The supported values of the ``commit`` and ``live_commit`` options in the
+#: ``solr`` section of the configuration, see :class:`_AsyncSender`.
+COMMIT_POLICIES = ("hard", "soft", "within", "none")
+
 PROCESS_FLAG = multiprocessing.Value(c_bool, True)
 FAILED = multiprocessing.Value(c_bool, False)
 STOP = None
 
+#: The database engine of a worker process, see :func:`_worker_engine`.
+_engine = None
+#: Maps entity names to :class:`sir.transport.BatchingQueue` objects in a
+#: worker process, see :func:`_init_worker`.
+_data_queues = {}
+#: Limits the number of concurrent database queries of all worker processes,
+#: see :func:`_init_worker`.
+_db_semaphore = None
+#: Whether a worker process tags the documents it puts into the channels
+#: with the bounds they belong to, see :func:`_init_worker`.
+_tag_bounds = False
+#: Whether a worker process converts the rows it retrieves to documents or
+#: leaves that to the converter processes, see :func:`_init_worker`.
+_convert = True
+#: The :class:`sir.hashstore.HashStore` used by a worker process to skip
+#: unchanged documents, see :func:`_init_worker`.
+_hash_store = None
+#: The identifier of the database snapshot the sessions of a worker process
+#: use, see :func:`_init_worker`.
+_snapshot = None
+
+#: Returned by :func:`_index_entity_process_wrapper`, describing the entity
+#: type of a task, the number of rows it retrieved, how long querying and
+#: converting them took and the peak resident set size of the worker process
+#: during the task.
+_TaskResult = namedtuple("_TaskResult", ["entity_name", "rows", "seconds",
+                                         "rss"])
+
 
 def reindex(args):
     """
@@ -33,6 +78,39 @@ def reindex(args):
 
     If no types are specified, all known entities will be reindexed.
 
+    If ``checkpoint_file`` is set in the ``sir`` section of the
+    configuration, the bounds that have been committed to Solr are recorded
+    in it under the run id in args["run_id"]. If args["resume"] is true,
+    those bounds are skipped, otherwise the records of a previous run with
+    the same id are discarded.
+
+    If args["shadow"] is true, the documents are sent to the shadow core of
+    each entity type instead (see :func:`sir.util.prepare_shadow_core`),
+    which is emptied first unless resuming. Changes are only committed once
+    at the end, so no searchers are opened and warmed while indexing. If
+    everything has been indexed successfully, the shadow core is swapped with
+    the live core afterwards, see :func:`_swap_shadow_cores`.
+
+    If args["differential"] is true, only documents whose hashes differ from
+    the ones recorded in the ``hash_file`` configured in the ``sir`` section
+    are sent, see :class:`sir.hashstore.HashStore`.
+
+    If args["since"] is given, only the rows that have changed since then
+    according to their ``last_updated`` columns are reindexed, see
+    :func:`_select_ids`. If args["ids_file"] is given, only the rows with
+    the ids listed in it are reindexed, see :func:`read_ids_file`. Both are
+    reindexed in batches of ids. If args["id_range"] contains ranges of
+    ids, only the rows within them are reindexed.
+
+    If args["shard"] is a tuple ``(index, count)``, only the rows of that
+    shard are reindexed, so several hosts can share a reindex, see
+    :mod:`sir.sharding`. The ids are divided into blocks of
+    ``shard_block_size`` ids. If ``shard_leases`` is enabled in the ``sir``
+    section, the blocks are claimed through a lease table in the database
+    instead of being assigned to shards up front, see
+    :class:`sir.sharding.LeasedShard`. That requires args["run_id"] to be
+    set, because blocks marked as done are never claimed again in a run.
+
     :param args: A dictionary with a key named ``entities``.
     :type args: dict
     """
@@ -56,7 +134,215 @@ def reindex(args):
         logger.error(exc)
         return
 
-    _multiprocessed_import(entities)
+    checkpoint_file = config.CFG.get("sir", "checkpoint_file", fallback="")
+    resume = args.get("resume", False)
+    if checkpoint_file:
+        checkpoints = checkpoint.CheckpointStore(checkpoint_file,
+                                                 args.get("run_id") or
+                                                 "reindex")
+    elif resume:
+        logger.error("Resuming a reindex requires checkpoint_file to be set "
+                     "in the sir section of the configuration")
+        return
+    else:
+        checkpoints = None
+
+    hashes = None
+    if args.get("differential", False):
+        hash_file = config.CFG.get("sir", "hash_file", fallback="")
+        if not hash_file:
+            logger.error("A differential reindex requires hash_file to be "
+                         "set in the sir section of the configuration")
+            return
+        if args.get("shadow", False):
+            logger.error("A differential reindex can't be combined with "
+                         "shadow cores, which start out empty")
+            return
+        hashes = hashstore.HashStore(hash_file)
+
+    shard = None
+    if args.get("shard") is not None:
+        if args.get("shadow", False) or args.get("id_range"):
+            logger.error("Reindexing a shard can't be combined with --shadow "
+                         "or --id-range")
+            return
+        index, count = args["shard"]
+        block_size = config.CFG.getint("sir", "shard_block_size",
+                                       fallback=100000)
+        if config.CFG.getboolean("sir", "shard_leases", fallback=False):
+            if not args.get("run_id"):
+                # Blocks stay done in their run, so reusing a run id would
+                # silently reindex nothing
+                logger.error("Claiming blocks through leases requires a "
+                             "--run-id that's unique to this reindex")
+                return
+            shard = sharding.LeasedShard(
+                index, count, block_size, util.db_session(),
+                args["run_id"],
+                config.CFG.getint("sir", "shard_lease_timeout",
+                                  fallback=300))
+        else:
+            shard = sharding.Shard(index, count, block_size)
+        logger.info("Reindexing shard %s", shard)
+
+    ids = None
+    id_ranges = args.get("id_range")
+    since = args.get("since")
+    ids_file = args.get("ids_file")
+    if since is not None or ids_file is not None:
+        if resume or args.get("shadow", False):
+            logger.error("Reindexing batches of ids can't be combined with "
+                         "--resume or --shadow")
+            return
+        if since is not None and ids_file is not None:
+            logger.error("--since and --ids-file can't be combined")
+            return
+        if since is not None:
+            ids = _select_ids(entities, since)
+        else:
+            try:
+                ids = read_ids_file(ids_file, entities)
+            except (IOError, ValueError) as exc:
+                logger.error("Failed to read %s: %s", ids_file, exc)
+                return
+        if id_ranges:
+            ids = dict((e, [i for i in entity_ids
+                            if any((lower is None or lower <= i) and
+                                   (upper is None or i < upper)
+                                   for lower, upper in id_ranges)])
+                       for e, entity_ids in ids.items())
+        if shard is not None:
+            # Leases only apply to ranges of ids
+            ids = dict((e, [i for i in entity_ids if shard.contains(i)])
+                       for e, entity_ids in ids.items())
+            shard = None
+        entities = [e for e in entities if e in ids]
+
+    if shard is not None:
+        shard.start()
+        try:
+            _multiprocessed_import(entities, checkpoints=checkpoints,
+                                   resume=resume, hashes=hashes, shard=shard)
+        finally:
+            shard.stop()
+        return
+
+    if not args.get("shadow", False):
+        _multiprocessed_import(entities, checkpoints=checkpoints,
+                               resume=resume, hashes=hashes, ids=ids,
+                               id_ranges=id_ranges)
+        return
+
+    try:
+        cores = dict((e, util.prepare_shadow_core(e, clear=not resume))
+                     for e in entities)
+    except Exception as exc:
+        logger.error("Failed to prepare the shadow cores: %s", exc)
+        return
+    FAILED.value = False
+    failed = _multiprocessed_import(entities, checkpoints=checkpoints,
+                                    resume=resume, cores=cores,
+                                    commit_policy="hard", id_ranges=id_ranges)
+    _swap_shadow_cores(cores, failed)
+
+
+def read_ids_file(path, entity_names):
+    """
+    Read the ids of the rows to reindex from the file at ``path``, or from
+    standard input if ``path`` is ``-``.
+
+    Each line contains either an id, which belongs to the only entity type
+    in ``entity_names``, or an entity type and an id, separated by
+    whitespace or a comma. Empty lines and lines starting with ``#`` are
+    ignored, as are ids of entity types not in ``entity_names``.
+
+    :param str path:
+    :param [str] entity_names:
+    :raises ValueError: If a line can't be parsed or contains only an id
+                        while there are several entity types
+    :rtype: dict(str, [int])
+    """
+    if path == "-":
+        # Standard input isn't ours to close
+        return _parse_ids(sys.stdin, entity_names)
+    with open(path) as f:
+        return _parse_ids(f, entity_names)
+
+
+def _parse_ids(lines, entity_names):
+    """
+    Parse the ids in ``lines`` as described in :func:`read_ids_file`.
+
+    :param lines: An iterable of strings
+    :param [str] entity_names:
+    :raises ValueError:
+    :rtype: dict(str, [int])
+    """
+    ids = dict((e, set()) for e in entity_names)
+    for number, line in enumerate(lines, 1):
+        fields = line.replace(",", " ").split()
+        if not fields or fields[0].startswith("#"):
+            continue
+        if len(fields) == 1 and len(ids) == 1:
+            e = next(iter(ids))
+        elif len(fields) == 2:
+            e = fields[0]
+        else:
+            raise ValueError("Line %d doesn't contain an id and, unless a "
+                             "single entity type is reindexed, its entity "
+                             "type" % number)
+        if e in ids:
+            ids[e].add(int(fields[-1]))
+    return dict((e, sorted(entity_ids)) for e, entity_ids in ids.items())
+
+
+def _select_ids(entity_names, since):
+    """
+    Return the ids of the rows of each entity type in ``entity_names`` that
+    have changed since ``since``, see :func:`sir.querying.changed_ids`.
+
+    :param [str] entity_names:
+    :param datetime.datetime since:
+    :rtype: dict(str, [int])
+    """
+    ids = {}
+    with util.db_session_ctx(util.db_session()) as session:
+        for e in entity_names:
+            ids[e] = querying.changed_ids(session, SCHEMA[e], since)
+            logger.info("%d rows of %s have changed since %s", len(ids[e]),
+                        e, since)
+    return ids
+
+
+def _swap_shadow_cores(cores, failed):
+    """
+    Swap the shadow cores in ``cores`` with the live cores of their entity
+    types, unless the import of the entity type failed or their versions
+    don't match the schema. The settings overridden while filling them are
+    restored first, see :func:`sir.util.restore_shadow_core`.
+
+    :param cores: Maps entity types to the names of their shadow cores
+    :type cores: dict(str, str)
+    :param failed: The entity types whose import failed
+    :type failed: set(str)
+    """
+    if FAILED.value:
+        logger.error("Not all documents could be sent to Solr, not swapping "
+                     "any shadow cores")
+        return
+    for e, shadow in cores.items():
+        if e in failed:
+            logger.error("Not swapping %s with %s because its import failed",
+                         shadow, e)
+            continue
+        try:
+            util.restore_shadow_core(shadow)
+            util.solr_version_check(e, shadow)
+            util.solr_core_admin("SWAP", core=e, other=shadow)
+        except Exception as exc:
+            logger.error("Failed to swap %s with %s: %s", shadow, e, exc)
+        else:
+            logger.info("Swapped %s with %s", shadow, e)
 
 
 def live_index(entities):
@@ -81,7 +367,10 @@ def live_index(entities):
         raise Exception('Post to Solr failed. Requeueing all pending messages for retry.')
 
 
-def _multiprocessed_import(entity_names, live=False, entities=None):
+def _multiprocessed_import(entity_names, live=False, entities=None,
+                           checkpoints=None, resume=False, sender=None,
+                           cores=None, commit_policy=None, hashes=None,
+                           ids=None, id_ranges=None, shard=None):
     """
     Does the real work to import all entities with ``entity_name`` in multiple
     processes via the :mod:`multiprocessing` module.
@@ -90,11 +379,89 @@ def _multiprocessed_import(entity_names, live=False, entities=None):
     ``entities`` dict, otherwise it reindexes the entire table for entities in
     ``entity_names``.
 
+    Entity types are imported one after another unless ``concurrent_cores``
+    is enabled in the ``sir`` section of the configuration. In that case, the
+    batches of all entity types are interleaved by :class:`_Scheduler` and
+    processed by the same pool, while each entity type still has its own
+    process sending data to Solr.
+
+    The process sending data to Solr for an entity type keeps up to
+    ``solr_threads`` (defaulting to ``import_threads``) update requests
+    running at the same time, see :class:`_AsyncSender`. How changes are
+    committed is configured by the ``commit`` option (or ``live_commit``
+    when ``live`` is True) in the ``solr`` section.
+
+    If ``pipeline`` is enabled in the ``sir`` section, the workers only
+    retrieve rows from the database and pass them on to
+    ``convert_processes`` processes per entity type running
+    :func:`convert_rows`, which pass the documents on to the process sending
+    them to Solr. That way, querying the database and converting rows
+    overlap. ``convert_processes`` and ``solr_threads`` can be set for each
+    entity type in a ``core:<entity type>`` section, see
+    :func:`_core_option`.
+
+    The channels passing documents to those processes are bounded by
+    ``queue_max_documents`` documents and ``queue_max_size`` megabytes of
+    preserialized documents (configured in the ``sir`` section), and their
+    depth is logged every ``queue_log_interval`` seconds.
+
+    If ``adaptive_batch_size`` is enabled, the size of the batches of each
+    entity type is adjusted while reindexing it, see :class:`_BatchSizer`.
+
+    If ``consistent_snapshot`` is enabled while reindexing, a snapshot of the
+    database is exported before determining any bounds, and all sessions
+    querying the database use it, so the whole reindex sees the database at
+    a single point in time, see :func:`sir.util.export_snapshot`.
+
+    If ``dimension_cache`` is enabled, the lookup tables cached by
+    :mod:`sir.dimensions` are loaded (unless they already are) before the
+    workers are started.
+
+    If ``checkpoints`` is given while reindexing, the processes sending data
+    to Solr record in it which bounds have been committed. If ``resume`` is
+    true, bounds that lie completely within the ranges recorded by a
+    previous run are skipped and the progress of the bounds it didn't
+    commit is discarded, because they are sent again. Otherwise all of
+    those records are discarded.
+
     :param entity_names:
     :type entity_names: [str]
     :param bool live:
     :param entities:
     :type entities: dict(set(int))
+    :param checkpoints:
+    :type checkpoints: :class:`sir.checkpoint.CheckpointStore`
+    :param bool resume:
+    :param sender: A function that's run instead of :func:`queue_to_solr`
+                   in the process receiving the documents of an entity type.
+                   It's called with the channel and the name of the entity
+                   type.
+    :param cores: Maps entity types to the names of the Solr cores their
+                  documents are sent to, if that's not the entity type.
+    :type cores: dict(str, str)
+    :param str commit_policy: Overrides the commit policy configured in the
+                              ``solr`` section, see :data:`COMMIT_POLICIES`
+    :param hashes: If given while reindexing, only documents whose hashes
+                   differ from the ones recorded in it are sent. The new
+                   hashes of an entity type are recorded once all of its
+                   documents have been queried, converted and sent
+                   successfully.
+    :type hashes: :class:`sir.hashstore.HashStore`
+    :param ids: If given while reindexing, only the rows with these ids are
+                reindexed, in batches of ``query_batch_size`` ids like when
+                live indexing. Checkpoints aren't recorded in that case.
+    :type ids: dict(str, [int])
+    :param id_ranges: If given while reindexing all rows, only the bounds
+                      within these half-open ranges of ids are reindexed. An
+                      upper or lower bound of ``None`` means the range is
+                      unbounded.
+    :type id_ranges: [(int, int)]
+    :param shard: If given while reindexing all rows, only the ranges of ids
+                  of this shard are reindexed, and it's told about each
+                  entity type that has been reindexed successfully.
+    :type shard: :class:`sir.sharding.Shard`
+    :returns: The entity types whose import failed
+    :rtype: set(str)
     """
     query_batch_size = config.CFG.getint("sir", "query_batch_size")
     try:
@@ -103,102 +470,723 @@ def _multiprocessed_import(entity_names, live=False, entities=None):
         importlimit = 0
 
     max_processes = config.CFG.getint("sir", "import_threads")
+    # The number of batches sent to Solr at the same time for each entity
+    # type
     try:
-        max_solr_processes = config.CFG.getint("sir", "solr_threads")
+        solr_in_flight = config.CFG.getint("sir", "solr_threads")
     except NoOptionError:
-        max_solr_processes = max_processes
+        solr_in_flight = max_processes
     solr_batch_size = config.CFG.getint("solr", "batch_size")
+    transport_kind = config.CFG.get("sir", "transport", fallback="pipe")
+    if commit_policy is None and live:
+        commit_policy = config.CFG.get("solr", "live_commit",
+                                       fallback="within")
+    elif commit_policy is None:
+        commit_policy = config.CFG.get("solr", "commit", fallback="hard")
+    if commit_policy not in COMMIT_POLICIES:
+        raise config.ConfigError("Unknown commit policy %s" % commit_policy)
+    max_db_queries = config.CFG.getint("sir", "max_db_queries", fallback=0)
+    queue_max_documents = config.CFG.getint("sir", "queue_max_documents",
+                                            fallback=0)
+    queue_max_bytes = config.CFG.getint("sir", "queue_max_size",
+                                        fallback=0) * 1024 * 1024
+    if (queue_max_bytes and
+            not config.CFG.getboolean("sir", "preserialize", fallback=False)):
+        logger.warning("queue_max_size only limits preserialized documents")
+    queue_log_interval = config.CFG.getint("sir", "queue_log_interval",
+                                           fallback=60)
+    pipeline = config.CFG.getboolean("sir", "pipeline", fallback=False)
+    concurrent = (not live and
+                  config.CFG.getboolean("sir", "concurrent_cores",
+                                        fallback=False))
+    if (not live and
+            config.CFG.getboolean("sir", "adaptive_batch_size",
+                                  fallback=False)):
+        sizer = _BatchSizer(
+            query_batch_size,
+            config.CFG.getint("sir", "min_query_batch_size", fallback=1000),
+            config.CFG.getint("sir", "max_query_batch_size",
+                              fallback=100000),
+            config.CFG.getfloat("sir", "batch_target_seconds", fallback=30),
+            config.CFG.getint("sir", "batch_max_rss", fallback=0) *
+            1024 * 1024)
+    else:
+        sizer = None
 
     db_session = util.db_session()
+    snapshot_connection = None
+    snapshot = None
+    if (not live and
+            config.CFG.getboolean("sir", "consistent_snapshot",
+                                  fallback=False)):
+        snapshot_connection, snapshot, lsn = util.export_snapshot()
+        util.use_snapshot(db_session, snapshot)
+        logger.info("Reindexing the database as of snapshot %s taken at WAL "
+                    "position %s", snapshot, lsn)
+    if config.CFG.getboolean("sir", "dimension_cache", fallback=False):
+        # Loaded before the workers get started so they can inherit it
+        with util.db_session_ctx(db_session) as session:
+            dimensions.load(session)
 
-    # Only allow one task per child to prevent the process consuming too much
-    # memory
-    pool = multiprocessing.Pool(max_processes, maxtasksperchild=1)
-    for e in entity_names:
-        logger.log(DEBUG if live else INFO, "Importing %s...", e)
-        index_function_args = []
-        # `entities` will be None when reindexing the entire DB
-        entity_id_list = list(entities.get(e, set())) if entities else None
-        manager = multiprocessing.Manager()
-        entity_data_queue = manager.Queue()
-
-        process_function = partial(queue_to_solr,
-                                   entity_data_queue,
-                                   solr_batch_size,
-                                   e)
-        solr_processes = []
-        for i in range(max_solr_processes):
-            p = multiprocessing.Process(target=process_function, name="Solr-" + str(i))
-            p.start()
-            solr_processes.append(p)
-        indexer = partial(_index_entity_process_wrapper, live=live)
-        if live:
-            if entity_id_list:
-                for i in range(0, len(entity_id_list), query_batch_size):
-                    index_function_args.append((e,
-                                                entity_id_list[i:i + query_batch_size],
-                                                entity_data_queue))
+    if live:
+        checkpoints = None
+        hashes = None
+    elif ids is not None:
+        # Batches of ids can't be recorded as ranges
+        checkpoints = None
+        entities = ids
+    by_id = live or ids is not None
+    if hashes is not None:
+        for e in entity_names:
+            hashes.start(e)
+    committed = {}
+    if checkpoints is not None:
+        for e in entity_names:
+            if resume:
+                checkpoints.discard_uncommitted(e)
+                committed[e] = checkpoints.committed_ranges(e)
+            else:
+                checkpoints.reset(e)
+
+    def entity_tasks(e):
+        if by_id:
+            # `entities` will be None when reindexing the entire DB
+            entity_id_list = list(entities.get(e, set())) if entities else []
+            i = 0
+            while i < len(entity_id_list):
+                size = sizer.size(e) if sizer is not None else query_batch_size
+                yield (e, entity_id_list[i:i + size])
+                i += size
         else:
+            ranges = committed.get(e, [])
+            skipped = 0
+            if sizer is not None:
+                batch_size = partial(sizer.size, e)
+            else:
+                batch_size = query_batch_size
             with util.db_session_ctx(db_session) as session:
-                for bounds in querying.iter_bounds(session, SCHEMA[e].model,
-                                                   query_batch_size, importlimit):
-                    args = (e, bounds, entity_data_queue)
-                    index_function_args.append(args)
+                if shard is not None:
+                    id_range_iter = shard.ranges(session, e, SCHEMA[e].model)
+                else:
+                    id_range_iter = id_ranges or [(None, None)]
+                for lower, upper in id_range_iter:
+                    for b in querying.stream_bounds(session, SCHEMA[e].model,
+                                                    batch_size, importlimit,
+                                                    lower, upper):
+                        if checkpoint.range_covered(b, ranges):
+                            skipped += 1
+                            continue
+                        # Don't keep a transaction open while the bound is
+                        # being processed
+                        session.commit()
+                        yield (e, b)
+            if skipped:
+                logger.info("Skipped %d bounds of %s that have already been "
+                            "committed", skipped, e)
 
-        try:
-            results = pool.imap(indexer,
-                                index_function_args)
-            for r in results:
-                if not PROCESS_FLAG.value:
-                    raise SIR_EXIT
-        except SIR_EXIT:
-            logger.info('Killing all worker processes.')
-            entity_data_queue.put(STOP)
-            for p in solr_processes:
-                p.terminate()
-                p.join()
-            pool.terminate()
-            pool.join()
-            raise
-        except Exception as exc:
+    if concurrent and ids is not None:
+        weights = dict((e, len(ids.get(e, ()))) for e in entity_names)
+        groups = [list(entity_names)]
+    elif concurrent:
+        with util.db_session_ctx(db_session) as session:
+            weights = dict((e, querying.estimate_row_count(session,
+                                                           SCHEMA[e].model))
+                           for e in entity_names)
+        logger.info("Estimated row counts: %s", weights)
+        groups = [list(entity_names)]
+    else:
+        weights = dict((e, 1) for e in entity_names)
+        groups = [[e] for e in entity_names]
+
+    def create_transports():
+        data_transport = transport.Transport(transport_kind, entity_names,
+                                             queue_max_documents,
+                                             queue_max_bytes)
+        if pipeline:
+            # Carries the rows retrieved by the workers to the converter
+            # processes
+            row_transport = transport.Transport(transport_kind, entity_names,
+                                                queue_max_documents)
+            return data_transport, row_transport, row_transport.channels
+        return data_transport, None, data_transport.channels
+
+    def close_transports(transports):
+        for t in transports:
+            if t is not None:
+                t.close()
+
+    # The channels have to exist before the workers get started so they can
+    # inherit them
+    data_transport, row_transport, worker_channels = create_transports()
+    # Transports replaced after a failure, which are closed once the
+    # processes of their group have exited
+    stale_transports = []
+    if max_db_queries:
+        db_semaphore = multiprocessing.BoundedSemaphore(max_db_queries)
+    else:
+        db_semaphore = None
+    tag_bounds = checkpoints is not None
+    pool = _create_pool(max_processes, worker_channels, solr_batch_size,
+                        db_semaphore, tag_bounds, not pipeline, hashes,
+                        snapshot)
+    indexer = partial(_index_entity_process_wrapper, live=by_id)
+    solr_processes = {}
+    converter_processes = dict((e, []) for e in entity_names)
+    # The number of converter processes still running for each entity type.
+    # The parent has to keep the shared values alive as long as they're used.
+    converters_running = {}
+    done = set()
+    failed_entities = set()
+
+    def start_solr_process(e):
+        logger.log(DEBUG if live else INFO, "Importing %s...", e)
+        if sender is not None:
+            process_function = partial(sender, data_transport.channels[e], e)
+            name = "Sender-%s" % e
+        else:
+            process_function = partial(queue_to_solr,
+                                       data_transport.channels[e],
+                                       solr_batch_size,
+                                       e,
+                                       checkpoints,
+                                       _core_option(e, "solr_threads",
+                                                    solr_in_flight),
+                                       commit_policy,
+                                       (cores or {}).get(e))
+            name = "Solr-%s" % e
+        p = multiprocessing.Process(target=process_function, name=name)
+        p.start()
+        solr_processes[e] = p
+        if pipeline:
+            start_converters(e)
+
+    def start_converters(e):
+        processes = max(_core_option(e, "convert_processes", max_processes),
+                        1)
+        running = converters_running[e] = multiprocessing.Value("i",
+                                                                processes)
+        for i in range(processes):
+            p = multiprocessing.Process(target=convert_rows,
+                                        args=(row_transport.channels[e],
+                                              data_transport.channels[e],
+                                              e,
+                                              solr_batch_size,
+                                              running,
+                                              hashes),
+                                        name="Convert-%s-%d" % (e, i))
+            p.start()
+            converter_processes[e].append(p)
+
+    def record_done(e, failed):
+        done.add(e)
+        if sizer is not None:
+            sizer.report(e)
+        if failed:
+            failed_entities.add(e)
             logger.error("Failed to import %s.", e)
-            logger.exception(exc)
-            pool.terminate()
         else:
             logger.log(DEBUG if live else INFO, "Successfully imported %s!", e)
-        entity_data_queue.put(STOP)
-        for p in solr_processes:
+
+    def entity_done(e, failed):
+        record_done(e, failed)
+        worker_channels[e].put(STOP)
+
+    try:
+        for group in groups:
+            for e in group:
+                start_solr_process(e)
+            scheduler = _Scheduler(dict((e, entity_tasks(e)) for e in group),
+                                   dict((e, weights[e]) for e in group),
+                                   entity_done)
+            if queue_log_interval:
+                # Logged from a thread, because no results arrive while the
+                # workers are blocked on full channels
+                depth_logger = _Repeater(
+                    queue_log_interval,
+                    lambda: _log_queue_depths(data_transport, group, done))
+                depth_logger.start()
+            else:
+                depth_logger = None
+            try:
+                results = pool.imap_unordered(indexer, scheduler,
+                                              return_exceptions=True)
+                for r in results:
+                    if not PROCESS_FLAG.value:
+                        raise SIR_EXIT
+                    if isinstance(r, workers.TaskError):
+                        logger.error("Failed to import %s with id in bounds "
+                                     "%s: %s", r.args[0], r.args[1],
+                                     r.exception)
+                        scheduler.task_failed(r.args[0])
+                    else:
+                        if sizer is not None:
+                            sizer.update(r)
+                        scheduler.task_done(r.entity_name)
+            except SIR_EXIT:
+                raise
+            except Exception as exc:
+                logger.exception(exc)
+                # Get rid of the remaining tasks of this group
+                pool.terminate()
+                # The killed workers might have been holding the locks of
+                # the channels or been in the middle of writing into them,
+                # so nothing may be put into those any more. The processes
+                # reading them are stopped instead, and the following
+                # groups use new channels.
+                for e in group:
+                    if e not in done:
+                        record_done(e, True)
+                        for p in converter_processes[e]:
+                            p.terminate()
+                        solr_processes[e].terminate()
+                stale_transports.extend([data_transport, row_transport])
+                (data_transport, row_transport,
+                 worker_channels) = create_transports()
+                pool = _create_pool(max_processes, worker_channels,
+                                    solr_batch_size, db_semaphore,
+                                    tag_bounds, not pipeline, hashes,
+                                    snapshot)
+            finally:
+                if depth_logger is not None:
+                    depth_logger.stop()
+            for e in group:
+                for p in converter_processes[e]:
+                    p.join()
+                    if p.exitcode and e not in failed_entities:
+                        failed_entities.add(e)
+                        logger.error("Failed to convert the rows of %s.", e)
+                solr_processes[e].join()
+                if solr_processes[e].exitcode and e not in failed_entities:
+                    failed_entities.add(e)
+                    logger.error("Failed to send the documents of %s to "
+                                 "Solr.", e)
+                if hashes is not None:
+                    _report_unchanged(hashes, e)
+                    # Documents of batches that failed anywhere might not
+                    # have been sent
+                    if e not in failed_entities and not FAILED.value:
+                        promoted = hashes.promote(e)
+                        logger.debug("Recorded %d new hashes of %s",
+                                     promoted, e)
+                if (shard is not None and e not in failed_entities and
+                        not FAILED.value):
+                    shard.finish(e)
+            close_transports(stale_transports)
+            stale_transports = []
+    except SIR_EXIT:
+        logger.info('Killing all worker processes.')
+        for p in (list(solr_processes.values()) +
+                  sum(converter_processes.values(), [])):
+            p.terminate()
             p.join()
+        pool.terminate()
+        pool.join()
+        close_transports(stale_transports + [data_transport, row_transport])
+        if snapshot_connection is not None:
+            snapshot_connection.close()
+        raise
     pool.close()
     pool.join()
+    close_transports([data_transport, row_transport])
+    if snapshot_connection is not None:
+        snapshot_connection.close()
+    logger.log(DEBUG if live else INFO, pool.report())
+    return failed_entities
+
+
+class _BatchSizer(object):
+    """
+    Adjusts the query batch size of each entity type based on the results
+    of its completed batches.
+
+    After each batch, the size is set so that a batch would take about
+    ``target_seconds`` at the rate of rows per second measured for it, but
+    it changes by at most a factor of two at a time. Only the time spent
+    querying and converting the rows counts, not the time spent waiting for
+    the processes sending the documents to Solr. If the peak resident set
+    size of the worker exceeded ``max_rss`` bytes during the batch, the size
+    is halved instead. The size always stays within ``min_size`` and
+    ``max_size``.
+
+    :param int size: The initial batch size.
+    :param int min_size:
+    :param int max_size:
+    :param float target_seconds:
+    :param int max_rss: 0 means no limit.
+    """
+
+    def __init__(self, size, min_size, max_size, target_seconds, max_rss=0):
+        self._initial = min(max(size, min_size), max_size)
+        self._min_size = min_size
+        self._max_size = max_size
+        self._target_seconds = target_seconds
+        self._max_rss = max_rss
+        self._sizes = {}
+        self._used = {}
+
+    def size(self, e):
+        """
+        Return the size of the next batch of entity type ``e``.
+
+        :param str e:
+        :rtype: int
+        """
+        size = self._sizes.get(e, self._initial)
+        self._used.setdefault(e, set()).add(size)
+        return size
+
+    def update(self, result):
+        """
+        Adjust the batch size of an entity type based on ``result``.
+
+        :param _TaskResult result:
+        """
+        e = result.entity_name
+        size = self._sizes.get(e, self._initial)
+        if self._max_rss and result.rss > self._max_rss:
+            new_size = size // 2
+        elif result.rows and result.seconds > 0:
+            desired = result.rows / result.seconds * self._target_seconds
+            new_size = int(min(max(desired, size / 2), size * 2))
+        else:
+            return
+        new_size = min(max(new_size, self._min_size), self._max_size)
+        if new_size != size:
+            logger.debug("Changing the batch size of %s from %d to %d after "
+                         "%d rows in %.2fs with a peak worker RSS of %d bytes",
+                         e, size, new_size, result.rows, result.seconds,
+                         result.rss)
+            self._sizes[e] = new_size
+
+    def report(self, e):
+        """
+        Log the batch sizes used for entity type ``e``.
+
+        :param str e:
+        """
+        used = self._used.get(e)
+        if used:
+            logger.info("Batch sizes of %s ranged from %d to %d, settling "
+                        "at %d", e, min(used), max(used),
+                        self._sizes.get(e, self._initial))
+
+
+class _Scheduler(object):
+    """
+    Iterates over the tasks of several entity types, interleaving them so
+    that all entity types make the same relative progress, assuming each has
+    a number of tasks proportional to its weight.
+
+    Once all tasks of an entity type have been completed, ``on_done`` is
+    called with its name and whether any of its tasks failed. After a task
+    of an entity type failed, no more of its tasks are scheduled.
+
+    :param tasks:
+    :type tasks: dict(str, iterator)
+    :param weights:
+    :type weights: dict(str, int)
+    :param on_done:
+    """
+
+    def __init__(self, tasks, weights, on_done):
+        self._tasks = tasks
+        self._weights = weights
+        self._on_done = on_done
+        self._heap = [(0.0, i, e) for i, e in enumerate(tasks)]
+        self._outstanding = dict((e, 0) for e in tasks)
+        self._exhausted = set()
+        self._failed = set()
+
+    def __iter__(self):
+        while self._heap:
+            progress, order, e = heappop(self._heap)
+            if e in self._failed:
+                self._exhaust(e)
+                continue
+            try:
+                task = next(self._tasks[e])
+            except StopIteration:
+                self._exhaust(e)
+                continue
+            self._outstanding[e] += 1
+            heappush(self._heap,
+                     (progress + 1.0 / max(self._weights[e], 1), order, e))
+            yield task
+
+    def _exhaust(self, e):
+        self._exhausted.add(e)
+        self._check_done(e)
+
+    def _check_done(self, e):
+        if e in self._exhausted and not self._outstanding[e]:
+            self._on_done(e, e in self._failed)
+
+    def task_done(self, e):
+        """
+        Mark a task of entity type ``e`` as completed.
+
+        :param str e:
+        """
+        self._outstanding[e] -= 1
+        self._check_done(e)
+
+    def task_failed(self, e):
+        """
+        Mark a task of entity type ``e`` as failed.
+
+        :param str e:
+        """
+        self._failed.add(e)
+        self.task_done(e)
+
+
+def _core_option(entity_name, option, fallback):
+    """
+    Return the integer ``option`` from the ``core:<entity_name>`` section of
+    the configuration, falling back to the ``sir`` section and then to
+    ``fallback``.
+
+    :param str entity_name:
+    :param str option:
+    :param int fallback:
+    :rtype: int
+    """
+    return config.CFG.getint("core:%s" % entity_name, option,
+                             fallback=config.CFG.getint("sir", option,
+                                                        fallback=fallback))
+
+
+def _report_unchanged(hashes, entity_name):
+    """
+    Log how many documents of ``entity_name`` have been skipped because they
+    haven't changed.
+
+    :param sir.hashstore.HashStore hashes:
+    :param str entity_name:
+    """
+    checked, changed = hashes.stats(entity_name)
+    logger.info("%d of %d documents of %s were unchanged and have not been "
+                "sent (%.1f%%)", checked - changed, checked, entity_name,
+                100.0 * (checked - changed) / checked if checked else 0)
+
+
+class _Repeater(object):
+    """
+    Calls ``function`` every ``interval`` seconds in a thread between
+    :meth:`start` and :meth:`stop`.
+
+    :param float interval:
+    :param function:
+    """
+
+    def __init__(self, interval, function):
+        self.interval = interval
+        self.function = function
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="Repeater",
+                                        daemon=True)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.function()
+            except Exception as exc:
+                logger.debug("Failed to call %s: %s", self.function, exc)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop calling the function. A call that's still running, for example
+        because it's waiting for a lock held by a terminated process, is
+        given at most ``interval`` seconds to finish.
+        """
+        self._stopped.set()
+        self._thread.join(self.interval)
+
+
+def _log_queue_depths(data_transport, entity_names, done):
+    """
+    Log the number of documents waiting to be sent to Solr for each entity
+    type in ``entity_names`` that isn't ``done``.
+    """
+    depths = data_transport.depths()
+    for e in entity_names:
+        if e in depths and e not in done:
+            documents, size = depths[e]
+            logger.info("%d documents (%.1f MB serialized) of %s are waiting "
+                        "to be sent", documents, size / 1024.0 / 1024, e)
+
+
+def _create_pool(processes, channels, batch_size, db_semaphore=None,
+                 tag_bounds=False, convert=True, hashes=None, snapshot=None):
+    """
+    Create the :class:`sir.workers.WorkerPool` used for querying the
+    database. Its workers put the documents for an entity type into the
+    channel for it in ``channels`` in batches of ``batch_size``. If
+    ``db_semaphore`` is given, workers acquire it while querying the
+    database. If ``tag_bounds`` is true, the batches are tagged with the
+    bounds they belong to. If ``convert`` is false, the workers put the rows
+    they retrieve into the channels instead of documents. If ``hashes`` is
+    given, documents that haven't changed according to it are dropped. If
+    ``snapshot`` is given, the workers query the database in that snapshot.
+
+    By default, every worker runs only one task to prevent the process
+    consuming too much memory. If ``persistent_workers`` is enabled in the
+    ``sir`` section of the configuration, workers (and their database
+    engines) are reused for all tasks and only replaced once their resident
+    set size exceeds ``worker_max_rss`` megabytes.
+
+    :param int processes:
+    :param channels:
+    :type channels: dict(str, multiprocessing.SimpleQueue)
+    :param int batch_size:
+    :param multiprocessing.BoundedSemaphore db_semaphore:
+    :param bool tag_bounds:
+    :param bool convert:
+    :param hashes:
+    :type hashes: :class:`sir.hashstore.HashStore`
+    :param str snapshot:
+    :rtype: :class:`sir.workers.WorkerPool`
+    """
+    initargs = (channels, batch_size, db_semaphore, tag_bounds, convert,
+                hashes, snapshot)
+    if config.CFG.getboolean("sir", "persistent_workers", fallback=False):
+        max_rss = config.CFG.getint("sir", "worker_max_rss", fallback=0)
+        return workers.WorkerPool(processes, max_rss=max_rss * 1024 * 1024,
+                                  initializer=_init_worker,
+                                  initargs=initargs)
+    return workers.WorkerPool(processes, maxtasks=1,
+                              initializer=_init_worker, initargs=initargs)
+
+
+def _init_worker(channels, batch_size, db_semaphore=None, tag_bounds=False,
+                 convert=True, hashes=None, snapshot=None):
+    """
+    Set up the :class:`sir.transport.BatchingQueue` objects and the database
+    query semaphore of a worker process.
+
+    If ``tag_bounds`` is true, the documents of each bound are tagged with
+    it and followed by a :class:`sir.transport.TagDone` message once the
+    bound has been processed successfully.
+
+    If ``convert`` is false, the rows retrieved from the database are put
+    into the channels as they are, to be converted by :func:`convert_rows`.
+    Otherwise, if ``preserialize`` is enabled in the ``sir`` section of the
+    configuration, documents are serialized to JSON with
+    :func:`encode_document` before they're put into the channels.
+
+    If ``snapshot`` is given, the database sessions of the worker process
+    use it, see :func:`sir.util.use_snapshot`.
+
+    :param channels:
+    :type channels: dict(str, multiprocessing.SimpleQueue)
+    :param int batch_size:
+    :param multiprocessing.BoundedSemaphore db_semaphore:
+    :param bool tag_bounds:
+    :param bool convert:
+    :param hashes: Used to drop unchanged documents, see
+                   :class:`sir.hashstore.HashFilter`
+    :type hashes: :class:`sir.hashstore.HashStore`
+    :param str snapshot: The identifier of an exported snapshot
+    """
+    global _data_queues, _db_semaphore, _tag_bounds, _convert, _hash_store
+    global _snapshot
+    _db_semaphore = db_semaphore
+    _tag_bounds = tag_bounds
+    _convert = convert
+    _hash_store = hashes
+    _snapshot = snapshot
+    if convert and config.CFG.getboolean("sir", "preserialize",
+                                         fallback=False):
+        encode = encode_document
+    else:
+        encode = None
+    _data_queues = dict((name, transport.BatchingQueue(channel, batch_size,
+                                                       encode))
+                        for name, channel in channels.items())
+
+
+def encode_document(doc):
+    """
+    Serializes ``doc`` to JSON.
+
+    :param dict doc:
+    :rtype: bytes
+    """
+    return ujson.dumps(doc, ensure_ascii=False, escape_forward_slashes=False,
+                       double_precision=15).encode("utf-8")
+
+
+def _worker_engine():
+    """
+    Return the database engine of the current worker process, reading the
+    configuration and creating the engine on the first call.
+
+    :rtype: :class:`sqla:sqlalchemy.engine.Engine`
+    """
+    global _engine
+    if _engine is None:
+        start = time.time()
+        config.read_config()
+        _engine = util.engine()
+        _engine.connect().close()
+        workers.STATS["engines"] += 1
+        workers.STATS["engine_setup_time"] += time.time() - start
+    return _engine
 
 
 def _index_entity_process_wrapper(args, live=False):
     """
-    Calls :func:`sir.indexing.index_entity` with ``args`` unpacked.
+    Calls :func:`sir.indexing.index_entity` with ``args`` unpacked and the
+    data queue for the entity type in ``args[0]``.
 
-    :param bool live:
+    :param bool live: Whether to call :func:`live_index_entity` with a list
+                      of ids instead
 
-    :rtype: None or an Exception
+    :rtype: :class:`_TaskResult`
     """
 
     # Restoring the default SIGTERM handler so the pool can actually terminate
     # its workers
     signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
-    config.read_config()
-
+    data_queue = _data_queues[args[0]]
+    if _tag_bounds:
+        data_queue.start(tuple(args[1]))
+    if _hash_store is not None and _convert:
+        documents = hashstore.HashFilter(data_queue, _hash_store, args[0],
+                                         data_queue.batch_size)
+    else:
+        documents = data_queue
     try:
-        session = Session(util.engine())
+        session = Session(_worker_engine())
+        if _snapshot is not None:
+            util.use_snapshot(session, _snapshot)
+        workers.reset_peak_rss()
+        start = time.time()
+        waited = data_queue.waited
         if live:
-            return live_index_entity(session, *args)
-        return index_entity(session, *args)
+            rows = live_index_entity(session, *args, documents)
+        else:
+            rows = index_entity(session, *args, documents)
+        documents.flush()
+        # Only announce the number of documents of a bound if all of them
+        # have been put into the queue
+        data_queue.finish()
+        # Time spent waiting for room in the channel says nothing about the
+        # cost of the batch itself
+        seconds = time.time() - start - (data_queue.waited - waited)
+        return _TaskResult(args[0], rows or 0, seconds, workers.peak_rss())
     except Exception as exc:
         logger.error("Failed to import %s with id in bounds %s",
                      args[0],
                      args[1])
         logger.exception(exc)
         raise
+    finally:
+        data_queue.flush()
 
 
 def index_entity(session, entity_name, bounds, data_queue):
@@ -212,6 +1200,8 @@ def index_entity(session, entity_name, bounds, data_queue):
     :param bounds:
     :type bounds: (int, int)
     :param Queue.Queue data_queue:
+    :returns: The number of rows retrieved
+    :rtype: int
     """
     model = SCHEMA[entity_name].model
     logger.debug("Importing %s %s", model, bounds)
@@ -220,7 +1210,8 @@ def index_entity(session, entity_name, bounds, data_queue):
         condition = and_(model.id >= lower_bound, model.id < upper_bound)
     else:
         condition = model.id >= lower_bound
-    _query_database(session, entity_name, condition, data_queue)
+    return _query_database(session, entity_name, condition, data_queue,
+                           bounds)
 
 
 def live_index_entity(session, entity_name, ids, data_queue):
@@ -233,15 +1224,18 @@ def live_index_entity(session, entity_name, ids, data_queue):
     :param str entity_name:
     :param [int] ids:
     :param Queue.Queue data_queue:
+    :returns: The number of rows retrieved
+    :rtype: int
     """
     if not PROCESS_FLAG.value:
-        return
+        return 0
     condition = and_(SCHEMA[entity_name].model.id.in_(ids))
     logger.debug("Importing %s new rows for entity %s", len(ids), entity_name)
-    _query_database(session, entity_name, condition, data_queue)
+    return _query_database(session, entity_name, condition, data_queue)
 
 
-def _query_database(session, entity_name, condition, data_queue):
+def _query_database(session, entity_name, condition, data_queue,
+                    bounds=None):
     """
     Retrieve rows for a single entity type identified by ``entity_name``,
     convert them to a dict with :func:`sir.indexing.query_result_to_dict` and
@@ -251,48 +1245,277 @@ def _query_database(session, entity_name, condition, data_queue):
     with log info. It is not considered as an indexing error, since
     it should not be in the MusicBrainz database to start with.
 
+    If ``fetch_chunk_size`` is set in the ``sir`` section of the
+    configuration, the rows are retrieved in chunks of that size, see
+    :func:`_fetch_chunks`. The rows of a chunk share a memo of converted
+    related rows, see :mod:`sir.memo`. If the worker process doesn't convert
+    rows (see :func:`_init_worker`), the rows are put into ``data_queue``
+    instead. Relationships loaded with ``selectin`` are loaded in chunks of
+    ``selectin_chunk_size`` rows, see
+    :func:`sir.schema.searchentities.selectin_chunk_size`.
+
+    If ``bounds`` are given and ``count_queries`` is enabled in the ``sir``
+    section (the default), the counts of related rows the model defines
+    (see :func:`sir.querying.count_properties`) aren't computed by the query
+    for each row. Instead, each of them is counted for all ids within
+    ``bounds`` at once by :func:`sir.querying.count_by_foreign_key` and
+    filled into the rows.
+
     :param str entity_name:
     :param sqlalchemy.sql.expression.BinaryExpression condition:
     :param Queue.Queue data_queue:
+    :param bounds: The range of ids ``condition`` selects
+    :type bounds: (int, int)
+    :returns: The number of rows put into ``data_queue``
+    :rtype: int
     """
     search_entity = SCHEMA[entity_name]
     model = search_entity.model
-    row_converter = search_entity.query_result_to_dict
 
-    with session:
+    chunk_size = config.CFG.getint("sir", "fetch_chunk_size", fallback=0)
+
+    if (bounds is not None and
+            config.CFG.getboolean("sir", "count_queries", fallback=True)):
+        count_props = querying.count_properties(model)
+    else:
+        count_props = []
+
+    with session, selectin_chunk_size():
         query = search_entity.query.filter(condition).with_session(session)
+        counts = []
+        if count_props:
+            query = query.options(*[defer(getattr(model, prop.key))
+                                    for prop in count_props])
+            with _db_semaphore or nullcontext():
+                for prop in count_props:
+                    counts.append((prop.key, querying.count_by_foreign_key(
+                        session, prop.info["count_foreign_key"], *bounds)))
         total_records = 0
-        for row in query:
-            if not PROCESS_FLAG.value:
-                return
-            try:
-                data_queue.put(row_converter(row))
-            except ValueError:
-                logger.info("Skipping %s with id %s. "
-                            "The most likely cause of this is an "
-                            "unsupported control character in the "
-                            "data.",
-                            entity_name,
-                            row.id)
-            except Exception as exc:
-                logger.error("Failed to import %s with id %s",
-                             entity_name,
-                             row.id)
-                logger.exception(exc)
-                raise
-            else:
-                total_records += 1
+        for rows in _fetch_chunks(session, query, model, chunk_size):
+            if counts:
+                _set_counts(rows, counts)
+            with batch_memo():
+                for row in rows:
+                    if not PROCESS_FLAG.value:
+                        return total_records
+                    if _convert:
+                        doc = _convert_row(search_entity, entity_name, row)
+                        if doc is None:
+                            continue
+                        data_queue.put(doc)
+                    else:
+                        data_queue.put(row)
+                    total_records += 1
         logger.debug("Retrieved %s records in %s", total_records, model)
+        return total_records
 
 
-def queue_to_solr(queue, batch_size, entity_name):
+def _set_counts(rows, counts):
+    """
+    Fill the counts of related rows computed by :func:`_query_database`
+    into ``rows``.
+
+    :param rows: :ref:`declarative <sqla:declarative_toplevel>` objects
+    :param counts: Pairs of the name of a count and the counts by id
+    :type counts: [(str, dict(int, int))]
     """
-    Read :class:`dict` objects from ``queue`` and send them to the Solr server
-    behind ``solr_connection`` in batches of ``batch_size``.
+    for row in rows:
+        for key, counts_by_id in counts:
+            set_committed_value(row, key, counts_by_id.get(row.id, 0))
+
+
+def _convert_row(search_entity, entity_name, row):
+    """
+    Convert ``row`` to a dict with
+    :meth:`~sir.schema.searchentities.SearchEntity.query_result_to_dict`.
+
+    Rows that contain unsupported control character are just skipped
+    with log info. It is not considered as an indexing error, since
+    it should not be in the MusicBrainz database to start with.
+
+    :param sir.schema.searchentities.SearchEntity search_entity:
+    :param str entity_name:
+    :param row: A :ref:`declarative <sqla:declarative_toplevel>` object.
+    :returns: The document or ``None`` if ``row`` is skipped
+    :rtype: dict
+    """
+    try:
+        return search_entity.query_result_to_dict(row)
+    except ValueError:
+        logger.info("Skipping %s with id %s. "
+                    "The most likely cause of this is an "
+                    "unsupported control character in the "
+                    "data.",
+                    entity_name,
+                    row.id)
+    except Exception as exc:
+        logger.error("Failed to import %s with id %s",
+                     entity_name,
+                     row.id)
+        logger.exception(exc)
+        raise
+
+
+def convert_rows(queue, data_queue, entity_name, batch_size, running,
+                 hashes=None):
+    """
+    Read the rows of ``entity_name`` put into ``queue`` by the workers of a
+    pipelined import, convert them with :func:`_convert_row` and put the
+    documents into ``data_queue`` in batches of ``batch_size``.
+
+    The documents keep the tags of the batches of rows they have been
+    converted from. :class:`sir.transport.TagDone` messages are passed on
+    and the number of rows of a tag that have been skipped is announced with
+    a :class:`sir.transport.TagSkipped` message, so the sending side can
+    still tell when all documents of a tag have been sent.
+
+    All processes converting the rows of an entity type read from the same
+    ``queue``. A process receiving :data:`STOP` puts it back for the others
+    and the last one to stop, according to ``running``, puts :data:`STOP`
+    into ``data_queue``.
+
+    If ``hashes`` is given, documents that haven't changed according to it
+    are dropped like skipped rows, see :class:`sir.hashstore.HashFilter`.
+
+    If converting a row fails, the remaining rows are discarded and the
+    process exits with status 1.
+
+    :param multiprocessing.Queue queue:
+    :param multiprocessing.Queue data_queue:
+    :param str entity_name:
+    :param int batch_size:
+    :param multiprocessing.Value running: The number of processes still
+                                          converting rows of ``entity_name``
+    :param hashes:
+    :type hashes: :class:`sir.hashstore.HashStore`
+    """
+    # Restoring the default SIGTERM handler so the process can actually be
+    # terminated on calling terminate.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    search_entity = SCHEMA[entity_name]
+    if config.CFG.getboolean("sir", "preserialize", fallback=False):
+        encode = encode_document
+    else:
+        encode = None
+    documents = transport.BatchingQueue(data_queue, batch_size, encode)
+    if hashes is not None:
+        unchanged = hashstore.HashFilter(documents, hashes, entity_name,
+                                         batch_size)
+    else:
+        unchanged = None
+    failed = False
+    while True:
+        item = queue.get()
+        if not PROCESS_FLAG.value or item is STOP:
+            break
+        if isinstance(item, transport.TagDone):
+            data_queue.put(item)
+            continue
+        if failed:
+            continue
+        tag = getattr(item, "tag", None)
+        documents.start(tag)
+        skipped = 0
+        if unchanged is not None:
+            skipped -= unchanged.skipped
+        try:
+            with batch_memo():
+                for row in item if isinstance(item, list) else [item]:
+                    doc = _convert_row(search_entity, entity_name, row)
+                    if doc is None:
+                        skipped += 1
+                    else:
+                        (unchanged or documents).put(doc)
+            if unchanged is not None:
+                unchanged.flush()
+                skipped += unchanged.skipped
+        except Exception:
+            failed = True
+        finally:
+            documents.flush()
+        if skipped and tag is not None:
+            data_queue.put(transport.TagSkipped(tag, skipped))
+
+    queue.put(STOP)
+    with running.get_lock():
+        running.value -= 1
+        last = not running.value
+    if last:
+        data_queue.put(STOP)
+    if failed:
+        sys.exit(1)
+
+
+def _fetch_chunks(session, query, model, chunk_size=0):
+    """
+    Yield the results of ``query`` in lists of ``chunk_size`` rows.
+
+    The chunks are retrieved one after another, ordered by the id of
+    ``model``, so the eager loads of ``query`` only load the related rows of
+    one chunk at a time. Once a chunk has been processed, all objects are
+    expunged from ``session`` so they can be garbage collected. If
+    ``chunk_size`` is 0, all rows are retrieved at once.
+
+    :param sqlalchemy.orm.Session session:
+    :param sqlalchemy.orm.query.Query query:
+    :param model: A :ref:`declarative <sqla:declarative_toplevel>` class.
+    :param int chunk_size:
+    :rtype: iterator over lists of rows
+    """
+    if not chunk_size:
+        with _db_semaphore or nullcontext():
+            rows = query.all()
+        yield rows
+        return
+
+    last_id = None
+    while True:
+        chunk_query = query
+        if last_id is not None:
+            chunk_query = chunk_query.filter(model.id > last_id)
+        with _db_semaphore or nullcontext():
+            rows = chunk_query.order_by(model.id).limit(chunk_size).all()
+        if not rows:
+            return
+        last_id = rows[-1].id
+        yield rows
+        if len(rows) < chunk_size:
+            return
+        rows = None
+        session.expunge_all()
+
+
+def queue_to_solr(queue, batch_size, entity_name, checkpoints=None,
+                  in_flight=1, commit_policy="hard", core=None):
+    """
+    Read :class:`dict` objects (or lists of them) from ``queue`` and send them
+    to the Solr server behind ``solr_connection`` in batches of
+    ``batch_size``, with up to ``in_flight`` batches being sent at the same
+    time by a :class:`_AsyncSender`.
+
+    If no connection to Solr can be established, the items in ``queue`` are
+    discarded until :data:`STOP` is received, so processes putting items
+    into it don't block forever.
+
+    If ``checkpoints`` is given, the number of documents sent for each
+    :class:`sir.transport.Batch` tag and the totals announced by
+    :class:`sir.transport.TagDone` messages are recorded in it. Changes are
+    then committed every ``checkpoint_interval`` seconds (configured in the
+    ``sir`` section), so the bounds whose documents have all been sent can
+    be marked as committed.
+
+    If sending any documents failed, the process exits with status 1.
 
     :param multiprocessing.Queue queue:
     :param int batch_size:
     :param str entity_name:
+    :param checkpoints:
+    :type checkpoints: :class:`sir.checkpoint.CheckpointStore`
+    :param int in_flight:
+    :param str commit_policy: One of :data:`COMMIT_POLICIES`
+    :param str core: The name of the Solr core to send the documents to, if
+                     that's not ``entity_name``
     """
 
     # Restoring the default SIGTERM handler so the Solr process can actually
@@ -300,46 +1523,293 @@ def queue_to_solr(queue, batch_size, entity_name):
     signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
     config.read_config()
-    solr_connection = util.solr_connection(entity_name)
+    try:
+        solr_connection = util.solr_connection(core or entity_name,
+                                               pool_size=in_flight)
+    except Exception as exc:
+        logger.error("Failed to connect to the Solr core %s, discarding "
+                     "its documents", core or entity_name)
+        logger.exception(exc)
+        FAILED.value = True
+        _discard_until_stop(queue)
+        return
 
-    data = []
-    count = 0
-    while True:
-        item = queue.get()
-        if not PROCESS_FLAG.value or item is STOP:
-            break
-        data.append(item)
-        if len(data) >= batch_size:
-            send_data_to_solr(solr_connection, data)
-            count += len(data)
-            logger.debug("Sent %d new documents. Total: %d", len(data), count)
-            data = []
+    sender = _AsyncSender(solr_connection, entity_name, checkpoints,
+                          in_flight, commit_policy)
+    asyncio.run(sender.run(queue, batch_size))
+    if sender.failed:
+        sys.exit(1)
+
+
+def _discard_until_stop(queue):
+    """
+    Read and discard the items in ``queue`` until :data:`STOP` is received,
+    so processes putting items into it don't block forever, then put
+    :data:`STOP` back for the other processes reading from it.
 
+    :param multiprocessing.Queue queue:
+    """
+    while queue.get() is not STOP:
+        pass
     queue.put(STOP)
-    if not PROCESS_FLAG.value:
-        return
-    logger.debug("%s: Sending remaining data & stopping", solr_connection)
-    send_data_to_solr(solr_connection, data)
-    logger.debug("Committing changes to Solr")
-    solr_connection.commit()
 
 
-def send_data_to_solr(solr_connection, data):
+class _AsyncSender(object):
+    """
+    Sends the documents read from a queue to Solr in an :mod:`asyncio`
+    event loop.
+
+    Up to ``in_flight`` update requests are running at the same time in a
+    thread pool, sharing the keep-alive connections of ``solr_connection``.
+    Once that many requests are running, no more items are read from the
+    queue until one of them has finished. Failed requests are retried as
+    configured by ``retries`` and ``backoff_factor`` in the ``solr``
+    section of the configuration, see :func:`send_data_to_solr`.
+
+    Once all items have been sent, the changes are committed according to
+    ``commit_policy``:
+
+    ``hard``
+        A hard commit, which makes the changes durable and visible.
+
+    ``soft``
+        A soft commit, which only makes the changes visible.
+
+    ``within``
+        No commit, but the documents are sent with ``commitWithin`` set to
+        ``commit_within`` milliseconds (configured in the ``solr`` section).
+
+    ``none``
+        No commit at all, leaving it to Solr's ``autoCommit`` settings.
+
+    If ``checkpoints`` is given, a hard commit that doesn't open a new
+    searcher is made at every checkpoint and at the end regardless of the
+    policy, because bounds can only be recorded as committed once their
+    documents are durable.
+
+    :param solr.Solr solr_connection:
+    :param str entity_name:
+    :param checkpoints:
+    :type checkpoints: :class:`sir.checkpoint.CheckpointStore`
+    :param int in_flight:
+    :param str commit_policy: One of :data:`COMMIT_POLICIES`
+    """
+
+    def __init__(self, solr_connection, entity_name, checkpoints=None,
+                 in_flight=1, commit_policy="hard"):
+        self.solr_connection = solr_connection
+        self.entity_name = entity_name
+        self.checkpoints = checkpoints
+        self.in_flight = max(in_flight, 1)
+        self.commit_policy = commit_policy
+        # Whether sending any documents failed
+        self.failed = False
+        if commit_policy == "within":
+            self.commit_within = config.CFG.getint("solr", "commit_within",
+                                                   fallback=10000)
+        else:
+            self.commit_within = None
+        self.retries = config.CFG.getint("solr", "retries", fallback=3)
+        self.backoff = config.CFG.getfloat("solr", "backoff_factor",
+                                           fallback=1)
+        self.checkpoint_interval = config.CFG.getint(
+            "sir", "checkpoint_interval", fallback=300)
+        self.count = 0
+        # Checkpoints are only accessed from the thread running the event
+        # loop, because SQLite connections can't be shared between threads
+        self._senders = ThreadPoolExecutor(self.in_flight)
+        self._reader = ThreadPoolExecutor(1)
+
+    async def run(self, queue, batch_size):
+        """
+        Send the items in ``queue`` until :data:`STOP` is received, then
+        commit. If an exception is raised before that, the remaining items
+        are discarded until :data:`STOP` is received.
+
+        :param multiprocessing.Queue queue:
+        :param int batch_size:
+        """
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.in_flight)
+        requests = set()
+        last_checkpoint = time.time()
+        data = []
+        # Maps tags to the number of their documents in `data`
+        tags = Counter()
+        stopped = False
+        try:
+            while True:
+                item = await loop.run_in_executor(self._reader, queue.get)
+                if not PROCESS_FLAG.value or item is STOP:
+                    stopped = True
+                    break
+                if isinstance(item, transport.TagDone):
+                    if self.checkpoints is not None:
+                        self.checkpoints.set_expected(self.entity_name,
+                                                      item.tag, item.count)
+                    continue
+                if isinstance(item, transport.TagSkipped):
+                    # Skipped rows don't have to be sent to complete their
+                    # tag
+                    if self.checkpoints is not None:
+                        self.checkpoints.add_sent(self.entity_name,
+                                                  {item.tag: item.count})
+                    continue
+                if isinstance(item, list):
+                    data.extend(item)
+                    tag = getattr(item, "tag", None)
+                    if tag is not None:
+                        tags[tag] += len(item)
+                else:
+                    data.append(item)
+                if len(data) >= batch_size:
+                    await slots.acquire()
+                    self._start_send(requests, slots, data, tags)
+                    data = []
+                    tags = Counter()
+                if (self.checkpoints is not None and
+                        time.time() - last_checkpoint >=
+                        self.checkpoint_interval):
+                    try:
+                        await self._commit()
+                    except Exception as exc:
+                        logger.error("Failed to commit %s: %s",
+                                     self.entity_name, exc)
+                    last_checkpoint = time.time()
+        finally:
+            if not stopped:
+                # Processes blocked on putting items into a full channel
+                # would otherwise wait forever. The reader thread might
+                # still be waiting for an item, so it has to discard them.
+                logger.error("Failed to send the documents of %s, "
+                             "discarding the rest of them", self.entity_name)
+                await loop.run_in_executor(self._reader, _discard_until_stop,
+                                           queue)
+
+        queue.put(STOP)
+        if not PROCESS_FLAG.value:
+            return
+        logger.debug("%s: Sending remaining data & stopping",
+                     self.solr_connection)
+        await slots.acquire()
+        self._start_send(requests, slots, data, tags)
+        await asyncio.gather(*requests, return_exceptions=True)
+        await self._commit(final=True)
+
+    def _start_send(self, requests, slots, data, tags):
+        request = asyncio.ensure_future(self._send(slots, data, tags))
+        requests.add(request)
+        request.add_done_callback(partial(self._send_done, requests))
+
+    def _send_done(self, requests, request):
+        """
+        Remove the finished ``request`` from ``requests`` and mark the
+        documents of the entity as failed if it raised an exception.
+        """
+        requests.discard(request)
+        if request.cancelled() or request.exception() is None:
+            return
+        logger.error("Failed to send documents of %s: %s", self.entity_name,
+                     request.exception())
+        FAILED.value = True
+        self.failed = True
+
+    async def _send(self, slots, data, tags):
+        loop = asyncio.get_running_loop()
+        try:
+            sent = await loop.run_in_executor(
+                self._senders, send_data_to_solr, self.solr_connection, data,
+                self.retries, self.backoff, self.commit_within)
+        finally:
+            slots.release()
+        if not sent:
+            self.failed = True
+        if sent and tags and self.checkpoints is not None:
+            self.checkpoints.add_sent(self.entity_name, tags)
+        self.count += len(data)
+        logger.debug("Sent %d new documents. Total: %d", len(data),
+                     self.count)
+
+    async def _commit(self, final=False):
+        """
+        Commit the changes sent so far if checkpoints are recorded and mark
+        the bounds whose documents have all been sent before as committed.
+        If ``final`` is true, also commit according to the commit policy.
+        """
+        loop = asyncio.get_running_loop()
+        if self.checkpoints is not None:
+            # Bounds completed while the commit is running might not be part
+            # of it
+            sent = self.checkpoints.sent_bounds(self.entity_name)
+            await loop.run_in_executor(self._senders,
+                                       partial(util.solr_commit,
+                                               self.solr_connection,
+                                               open_searcher=False))
+            if sent:
+                self.checkpoints.mark_committed(self.entity_name, sent)
+                logger.debug("Committed %d bounds of %s", len(sent),
+                             self.entity_name)
+        if final and self.commit_policy in ("hard", "soft"):
+            logger.debug("Committing changes to Solr")
+            await loop.run_in_executor(
+                self._senders,
+                partial(self.solr_connection.commit,
+                        softCommit=self.commit_policy == "soft"))
+
+
+def send_data_to_solr(solr_connection, data, retries=0, backoff=1,
+                      commit_within=None):
     """
     Sends ``data`` through ``solr_connection``.
 
+    ``data`` can either contain dicts or documents already serialized with
+    :func:`encode_document`, which are sent without decoding them.
+
+    If sending fails, it's retried up to ``retries`` times, waiting
+    ``backoff`` seconds before the first retry and twice as long before
+    each further one.
+
+    If ``commit_within`` is given, Solr is asked to commit the documents
+    within that many milliseconds.
+
     :param solr.Solr solr_connection:
-    :param [dict] data:
+    :param data:
+    :type data: [dict] or [bytes]
+    :param int retries:
+    :param float backoff:
+    :param int commit_within:
     :raises: :class:`solr:solr.SolrException`
+    :returns: Whether the data has been sent successfully
+    :rtype: bool
     """
     with sentry_sdk.new_scope() as scope:
         scope.set_extra("data", data)
-        try:
-            solr_connection.add(data)
-            logger.debug("Done sending data to Solr")
-        except Exception as e:
-            logger.error("Error while submitting data to Solr:", exc_info=True)
-            sentry_sdk.capture_exception(e)
-            FAILED.value = True
-        else:
-            logger.debug("Sent data to Solr")
+        attempt = 0
+        while True:
+            try:
+                kwargs = {}
+                if data and isinstance(data[0], bytes):
+                    if commit_within:
+                        kwargs["params"] = {"commitWithin": commit_within}
+                    util.post_documents(solr_connection, data, **kwargs)
+                else:
+                    if commit_within:
+                        kwargs["commitWithin"] = commit_within
+                    solr_connection.add(data, **kwargs)
+                logger.debug("Done sending data to Solr")
+            except Exception as e:
+                if attempt < retries:
+                    delay = backoff * 2 ** attempt
+                    attempt += 1
+                    logger.warning("Error while submitting data to Solr, "
+                                   "retrying in %.1fs: %s", delay, e)
+                    time.sleep(delay)
+                    continue
+                logger.error("Error while submitting data to Solr:",
+                             exc_info=True)
+                sentry_sdk.capture_exception(e)
+                FAILED.value = True
+                return False
+            else:
+                logger.debug("Sent data to Solr")
+                return True
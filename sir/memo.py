@@ -0,0 +1,83 @@
+# Copyright (c) 2026 MetaBrainz Foundation
+# License: MIT, see LICENSE for details
+"""
+This module memoizes values derived from database rows while a batch of rows
+is converted, so rows sharing related rows (like the recordings of a release
+sharing its release group and artist credit) only convert them once.
+
+The memo only exists within :func:`batch_memo`, so its memory is released
+together with the batch.
+"""
+from contextlib import contextmanager
+from functools import wraps
+
+
+__all__ = ["batch_memo", "get_memo", "memo_key", "memoize"]
+
+
+_memo = None
+
+
+@contextmanager
+def batch_memo():
+    """
+    A context manager activating the memo for the current batch. Nested
+    uses share the memo of the outermost one.
+    """
+    global _memo
+    if _memo is not None:
+        yield
+        return
+    _memo = {}
+    try:
+        yield
+    finally:
+        _memo = None
+
+
+def get_memo():
+    """
+    Return the memo of the current batch, or ``None`` outside of
+    :func:`batch_memo`.
+
+    :rtype: dict
+    """
+    return _memo
+
+
+def memo_key(value):
+    """
+    Return a key identifying ``value`` in the memo. Persistent
+    :ref:`declarative <sqla:declarative_toplevel>` objects are identified
+    by their primary key, lists by the keys of their elements and anything
+    else by itself.
+
+    :rtype: hashable
+    """
+    state = getattr(value, "_sa_instance_state", None)
+    if state is not None and state.key is not None:
+        return state.key
+    if isinstance(value, list):
+        return tuple(memo_key(element) for element in value)
+    return value
+
+
+def memoize(function):
+    """
+    Decorate ``function`` so its results are reused within a batch for
+    arguments with the same :func:`memo_key`. The results are shared, so
+    they must not be modified afterwards.
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        memo = _memo
+        if memo is None:
+            return function(*args, **kwargs)
+        key = (function, tuple(memo_key(arg) for arg in args),
+               tuple(sorted(kwargs.items())))
+        try:
+            return memo[key]
+        except KeyError:
+            result = memo[key] = function(*args, **kwargs)
+            return result
+    return wrapper
@@ -3,7 +3,8 @@
 import logging
 
 
-from sqlalchemy import func, select
+from sqlalchemy import func, select, text
+from sqlalchemy.orm import class_mapper
 from sqlalchemy.orm.attributes import InstrumentedAttribute
 from sqlalchemy.orm.interfaces import ONETOMANY, MANYTOONE
 from sqlalchemy.orm.properties import RelationshipProperty
@@ -113,20 +114,171 @@ def iter_bounds(db_session, model, batch_size, importlimit):
     if importlimit:
         q = q.filter(subq.c.rownum <= importlimit)
 
-    intervals = list(db_session.execute(q).all())
-    bounds = []
+    starts = [row[0] for row in db_session.execute(q)]
+    bounds = list(zip(starts, starts[1:]))
 
-    while intervals:
-        start = intervals.pop(0)[0]
-        if intervals:
-            end = intervals[0][0]
-        elif importlimit:
+    if starts:
+        if importlimit:
             # If there's an importlimit, just add a noop bound. This way,
             # :func:`sir.indexing.index_entity` doesn't require any
             # information about the limit
-            end = start
+            end = starts[-1]
         else:
             end = None
-        bounds.append((start, end))
+        bounds.append((starts[-1], end))
 
     return bounds
+
+
+def stream_bounds(db_session, model, batch_size, importlimit, lower=None,
+                  upper=None):
+    """
+    Like :func:`iter_bounds`, but return a generator that determines the
+    bounds lazily via keyset pagination. Each bound requires one query that
+    skips ``batch_size`` rows along the primary key index, so the first
+    bound is available immediately instead of after numbering all rows of
+    the table.
+
+    ``batch_size`` can also be a function returning the size of the next
+    bound, which is called whenever a bound is determined.
+
+    If ``lower`` or ``upper`` is given, only the ids in the half-open range
+    between them are covered.
+
+    :param sqlalchemy.orm.session.Session db_session:
+    :param model: A :ref:`declarative <sqla:declarative_toplevel>` class.
+    :param batch_size:
+    :type batch_size: int or callable
+    :param int importlimit:
+    :param int lower:
+    :param int upper:
+    :rtype: iterator over (int, int)
+    """
+    if callable(batch_size):
+        next_batch_size = batch_size
+    else:
+        def next_batch_size():
+            return batch_size
+    query = select(func.min(model.id))
+    if lower is not None:
+        query = query.where(model.id >= lower)
+    if upper is not None:
+        query = query.where(model.id < upper)
+    start = db_session.execute(query).scalar()
+    rows = 0
+    while start is not None:
+        size = max(next_batch_size(), 1)
+        rows += size
+        if importlimit and rows >= importlimit:
+            # The next bound would start after the import limit, see
+            # iter_bounds for why this is a noop bound
+            yield (start, start)
+            return
+        end = db_session.execute(
+            select(model.id).
+            where(model.id >= start).
+            order_by(model.id).
+            offset(size).
+            limit(1)
+        ).scalar()
+        if end is None and importlimit:
+            end = start
+        if upper is not None and (end is None or end >= upper):
+            yield (start, upper)
+            return
+        yield (start, end)
+        start = end if end != start else None
+
+
+def estimate_row_count(db_session, model):
+    """
+    Return the number of rows in the table of ``model`` as estimated by the
+    PostgreSQL planner statistics. This is much cheaper than counting them.
+
+    :param sqlalchemy.orm.session.Session db_session:
+    :param model: A :ref:`declarative <sqla:declarative_toplevel>` class.
+    :rtype: int
+    """
+    table = model.__table__
+    if table.schema:
+        name = "%s.%s" % (table.schema, table.name)
+    else:
+        name = table.name
+    q = text("SELECT reltuples FROM pg_class "
+             "WHERE oid = CAST(:table AS regclass)")
+    estimate = db_session.execute(q, {"table": name}).scalar()
+    # Tables that were never analyzed have an estimate of -1
+    return max(int(estimate or 0), 0)
+
+
+def count_properties(model):
+    """
+    Return the column properties of ``model`` counting related rows that
+    were defined with :func:`sir.schema.modelext.count_property`.
+
+    :param model: A :ref:`declarative <sqla:declarative_toplevel>` class.
+    :rtype: [:class:`sqla:sqlalchemy.orm.properties.ColumnProperty`]
+    """
+    return [prop for prop in class_mapper(model).column_attrs
+            if "count_foreign_key" in prop.info]
+
+
+def count_by_foreign_key(db_session, foreign_key, lower, upper=None):
+    """
+    Count the rows referring to each id in the half-open range ``lower`` to
+    ``upper`` with ``foreign_key`` in a single ``GROUP BY`` query. An upper
+    bound of ``None`` means the range is unbounded.
+
+    :param sqlalchemy.orm.session.Session db_session:
+    :param sqlalchemy.orm.attributes.InstrumentedAttribute foreign_key:
+    :param int lower:
+    :param int upper:
+    :returns: The number of rows referring to each id. Ids no row refers to
+              are left out.
+    :rtype: dict(int, int)
+    """
+    query = (select(foreign_key, func.count()).
+             where(foreign_key >= lower).
+             group_by(foreign_key))
+    if upper is not None:
+        query = query.where(foreign_key < upper)
+    return dict(db_session.execute(query).all())
+
+
+def changed_ids(db_session, search_entity, since):
+    """
+    Return the ids of the rows of the model of ``search_entity`` whose own
+    ``last_updated`` column, or that of a row reachable through one of the
+    paths loaded by its :attr:`~sir.schema.searchentities.SearchEntity.query`,
+    is newer than ``since``. Models without a ``last_updated`` column are
+    ignored.
+
+    :param sqlalchemy.orm.session.Session db_session:
+    :param sir.schema.searchentities.SearchEntity search_entity:
+    :param datetime.datetime since:
+    :rtype: [int]
+    """
+    # Importing this at the top would be circular, because the schema
+    # imports this module
+    from .trigger_generation.paths import (generate_query,
+                                           last_model_in_path,
+                                           unique_split_paths)
+
+    model = search_entity.model
+    queries = []
+    if hasattr(model, "last_updated"):
+        queries.append(generate_query(model, "", model.last_updated > since))
+    paths = [path for field in search_entity.fields for path in field.paths]
+    paths.extend(search_entity.extrapaths or [])
+    for path in unique_split_paths(paths):
+        related_model = last_model_in_path(model, path)
+        if (related_model is not None and
+                hasattr(related_model, "last_updated")):
+            queries.append(generate_query(
+                model, path, related_model.last_updated > since))
+
+    ids = set()
+    for query in queries:
+        logger.debug("Collecting changed ids of %s: %s", model, query)
+        ids.update(row[0] for row in query.with_session(db_session))
+    return sorted(ids)
@@ -606,6 +606,9 @@ SCHEMA = OrderedDict(sorted({
     "work": SearchWork,
 }.items(), key=lambda val: val[0]))
 
+for _name, _entity in SCHEMA.items():
+    _entity.name = _name
+
 
 def generate_update_map():
     """
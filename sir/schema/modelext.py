@@ -14,6 +14,29 @@ from sqlalchemy.orm import relationship, column_property
 from sqlalchemy.sql.expression import and_
 
 
+def count_property(foreign_key, parent_id):
+    """
+    Return a column property counting the rows whose ``foreign_key`` refers
+    to the row with ``parent_id``, with a correlated subquery.
+
+    ``foreign_key`` is recorded as ``count_foreign_key`` in the ``info`` of
+    the property, so the counts of many rows can be computed at once (see
+    :func:`sir.querying.count_by_foreign_key`).
+
+    :param sqlalchemy.orm.attributes.InstrumentedAttribute foreign_key:
+    :param sqlalchemy.orm.attributes.InstrumentedAttribute parent_id:
+    :rtype: :class:`sqla:sqlalchemy.orm.properties.ColumnProperty`
+    """
+    model = foreign_key.class_
+    return column_property(
+        select(func.count(model.id)).
+        where(foreign_key == parent_id).
+        correlate_except(model).
+        scalar_subquery(),
+        info={"count_foreign_key": foreign_key}
+    )
+
+
 class CustomAnnotation(Annotation):
     areas = relationship("AreaAnnotation", viewonly=True)
     artists = relationship("ArtistAnnotation", viewonly=True)
@@ -36,24 +59,9 @@ class CustomArea(Area):
         viewonly=True
     )
     tags = relationship("AreaTag", viewonly=True)
-    place_count = column_property(
-        select(func.count(Place.id)).
-        where(Place.area_id == Area.id).
-        correlate_except(Place).
-        scalar_subquery()
-    )
-    label_count = column_property(
-        select(func.count(Label.id)).
-        where(Label.area_id == Area.id).
-        correlate_except(Label).
-        scalar_subquery()
-    )
-    artist_count = column_property(
-        select(func.count(Artist.id)).
-        where(Artist.area_id == Area.id).
-        correlate_except(Artist).
-        scalar_subquery()
-    )
+    place_count = count_property(Place.area_id, Area.id)
+    label_count = count_property(Label.area_id, Area.id)
+    artist_count = count_property(Artist.area_id, Area.id)
 
 
 class CustomArtist(Artist):
@@ -98,12 +106,7 @@ class CustomLabel(Label):
     aliases = relationship("LabelAlias", viewonly=True)
     area = relationship("CustomArea", foreign_keys=[Label.area_id])
     tags = relationship("LabelTag", viewonly=True)
-    release_count = column_property(
-        select(func.count(ReleaseLabel.id)).
-        where(ReleaseLabel.label_id == Label.id).
-        correlate_except(ReleaseLabel).
-        scalar_subquery()
-    )
+    release_count = count_property(ReleaseLabel.label_id, Label.id)
 
 
 class CustomMediumCDToc(MediumCDTOC):
@@ -127,23 +130,13 @@ class CustomReleaseGroup(ReleaseGroup):
     first_release_date = relationship("ReleaseGroupMeta", viewonly=True)
     releases = relationship("Release", viewonly=True)
     tags = relationship("ReleaseGroupTag", viewonly=True)
-    release_count = column_property(
-        select(func.count(Release.id)).
-        where(Release.release_group_id == ReleaseGroup.id).
-        correlate_except(Release).
-        scalar_subquery()
-    )
+    release_count = count_property(Release.release_group_id, ReleaseGroup.id)
 
 
 class CustomRelease(Release):
     aliases = relationship("ReleaseAlias", viewonly=True)
     asin = relationship("ReleaseMeta", viewonly=True)
-    medium_count = column_property(
-        select(func.count(Medium.id)).
-        where(Medium.release_id == Release.id).
-        correlate_except(Medium).
-        scalar_subquery()
-    )
+    medium_count = count_property(Medium.release_id, Release.id)
 
 
 class CustomReleaseRaw(ReleaseRaw):
@@ -2,16 +2,18 @@
 # License: MIT, see LICENSE for details
 from uuid import UUID
 
-from sir import config
-from sir.querying import iterate_path_values
+from sir import config, dimensions
+from sir.memo import get_memo, memo_key
 from collections import defaultdict
+from contextlib import contextmanager
 from functools import partial
 from logging import getLogger
+from operator import attrgetter
 try:
     from xml.etree.cElementTree import tostring
 except ImportError:
     from xml.etree.ElementTree import tostring
-from sqlalchemy.orm import class_mapper, Load, raiseload, defer
+from sqlalchemy.orm import class_mapper, Load, raiseload, defer, strategies
 from sqlalchemy.orm.attributes import InstrumentedAttribute
 from sqlalchemy.orm.descriptor_props import CompositeProperty
 from sqlalchemy.orm.interfaces import ONETOMANY, MANYTOONE
@@ -21,6 +23,35 @@ from sqlalchemy.orm.query import Query
 
 logger = getLogger("sir")
 
+#: Maps the names of eager loading strategies to the methods of
+#: :class:`sqla:sqlalchemy.orm.Load` applying them.
+LOADER_STRATEGIES = {"joined": "joinedload",
+                     "selectin": "selectinload",
+                     "subquery": "subqueryload"}
+
+
+@contextmanager
+def selectin_chunk_size():
+    """
+    A context manager making relationships loaded with ``selectin`` load the
+    related rows of ``selectin_chunk_size`` (from the ``sir`` section of the
+    configuration) parent rows per query while the queries are executed
+    within it. The previous chunk size is restored afterwards.
+    """
+    chunk_size = config.CFG.getint("sir", "selectin_chunk_size", fallback=0)
+    if not chunk_size:
+        yield
+        return
+    # SQLAlchemy doesn't offer an option for this. The private class
+    # attribute is the chunk size of all selectin loads of the process in
+    # SQLAlchemy 2.0 (checked with 2.0.38).
+    previous = strategies.SelectInLoader._chunksize
+    strategies.SelectInLoader._chunksize = chunk_size
+    try:
+        yield
+    finally:
+        strategies.SelectInLoader._chunksize = previous
+
 
 def is_composite_column(model, colname):
     """
@@ -67,6 +98,201 @@ def merge_paths(field_paths):
     return paths
 
 
+def compile_paths(model, paths):
+    """
+    Compile ``paths`` into a function that walks the paths of an instance of
+    ``model`` once, with paths sharing a prefix sharing the walk along it.
+    The function is called with the instance and a list of sets and adds the
+    values found at the end of each path to the set at the index the path
+    belongs to, like :func:`sir.querying.iterate_path_values` would find
+    them.
+
+    Within :func:`sir.memo.batch_memo`, the values found below a many-to-one
+    relationship that leads to further relationships are memoized by the
+    primary key of the related object.
+
+    :param model: A :ref:`declarative <sqla:declarative_toplevel>` class.
+    :param paths: Pairs of dot-delimited paths and indexes
+    :type paths: [(str, int)]
+    :rtype: function
+    """
+    tree = {}
+    for path, index in paths:
+        pathelem, _, rest = path.partition(".")
+        indexes, subpaths = tree.setdefault(pathelem, ([], []))
+        if rest:
+            subpaths.append((rest, index))
+        else:
+            indexes.append(index)
+
+    visitors = []
+    for pathelem, (indexes, subpaths) in tree.items():
+        column = getattr(model, pathelem)
+        if (isinstance(column, InstrumentedAttribute) and
+                isinstance(column.property, RelationshipProperty)):
+            prop = column.property
+            if subpaths:
+                visit = compile_paths(prop.mapper.class_, subpaths)
+                if prop.direction == ONETOMANY:
+                    visitors.append(_one_to_many_visitor(pathelem, visit))
+                elif prop.direction == MANYTOONE:
+                    visitors.append(_many_to_one_visitor(
+                        pathelem, visit,
+                        any("." in rest for rest, _ in subpaths)))
+            if indexes:
+                visitors.append(_value_visitor(pathelem, indexes))
+        else:
+            # The rest of a path is ignored for columns and other attributes
+            visitors.append(_value_visitor(
+                pathelem, indexes + [index for _, index in subpaths]))
+
+    if len(visitors) == 1:
+        return visitors[0]
+
+    def visit_all(obj, values):
+        for visit in visitors:
+            visit(obj, values)
+    return visit_all
+
+
+def compile_fields(model, fields):
+    """
+    Compile ``fields`` into a function that converts an instance of
+    ``model`` into a dict of the values of its fields. The values are
+    collected by a function compiled by :func:`compile_paths`, passed to
+    the transform functions of the fields and converted by a function
+    compiled for each field by :func:`_field_converter`. Fields without a
+    value are left out.
+
+    :param model: A :ref:`declarative <sqla:declarative_toplevel>` class.
+    :param [SearchField] fields:
+    :rtype: function
+    """
+    collect = compile_paths(model, [(path, index)
+                                    for index, field in enumerate(fields)
+                                    for path in field.paths])
+    converters = [(field.name, _field_converter(field)) for field in fields]
+    count = len(fields)
+
+    def build(obj):
+        values = [set() for _ in range(count)]
+        collect(obj, values)
+        data = {}
+        for (name, convert), field_values in zip(converters, values):
+            value = convert(field_values)
+            if value is not None:
+                data[name] = value
+        return data
+    return build
+
+
+def _field_converter(field):
+    """
+    Return a function that turns the set of values collected for ``field``
+    into the value of its field in a document, or None if the field has no
+    value: the values are passed to the transform function of the field, a
+    single value is taken out of its collection, empty and false values are
+    dropped and UUIDs are converted to strings.
+
+    :param SearchField field:
+    :rtype: function
+    """
+    transform = field.transformfunc
+    if transform is None:
+        # Only sets can be collected, so the checks for other types can be
+        # skipped
+        def convert_values(values):
+            if len(values) == 1:
+                value = values.pop()
+                if not value:
+                    return None
+                return str(value) if isinstance(value, UUID) else value
+            if not values:
+                return None
+            return [str(value) if isinstance(value, UUID) else value
+                    for value in values]
+        return convert_values
+
+    def convert_transformed(values):
+        values = transform(values)
+        if isinstance(values, (set, list)) and len(values) == 1:
+            values = values.pop()
+        if values is None or not values:
+            return None
+        if isinstance(values, UUID):
+            return str(values)
+        if isinstance(values, (set, list)):
+            return [str(value) if isinstance(value, UUID) else value
+                    for value in values]
+        return values
+    return convert_transformed
+
+
+def _value_visitor(name, indexes):
+    getter = attrgetter(name)
+    if len(indexes) == 1:
+        index = indexes[0]
+
+        def visit_value(obj, values):
+            value = getter(obj)
+            if value is not None:
+                if isinstance(value, list):
+                    values[index].update(value)
+                else:
+                    values[index].add(value)
+        return visit_value
+
+    def visit_values(obj, values):
+        value = getter(obj)
+        if value is not None:
+            if isinstance(value, list):
+                for index in indexes:
+                    values[index].update(value)
+            else:
+                for index in indexes:
+                    values[index].add(value)
+    return visit_values
+
+
+def _one_to_many_visitor(name, visit):
+    getter = attrgetter(name)
+
+    def visit_one_to_many(obj, values):
+        for sub_obj in getter(obj):
+            visit(sub_obj, values)
+    return visit_one_to_many
+
+
+def _many_to_one_visitor(name, visit, memoize=False):
+    getter = attrgetter(name)
+
+    def visit_many_to_one(obj, values):
+        sub_obj = getter(obj)
+        if sub_obj is not None:
+            visit(sub_obj, values)
+
+    if not memoize:
+        return visit_many_to_one
+
+    def visit_many_to_one_memoized(obj, values):
+        sub_obj = getter(obj)
+        if sub_obj is None:
+            return
+        memo = get_memo()
+        if memo is None:
+            visit(sub_obj, values)
+            return
+        key = (visit, memo_key(sub_obj))
+        found = memo.get(key)
+        if found is None:
+            collected = defaultdict(set)
+            visit(sub_obj, collected)
+            found = memo[key] = list(collected.items())
+        for index, sub_values in found:
+            values[index].update(sub_values)
+    return visit_many_to_one_memoized
+
+
 def defer_everything_but(mapper, load, *columns):
     primary_keys = [c.name for c in mapper.primary_key]
     columns_to_keep = set(columns)
@@ -153,10 +379,14 @@ class SearchEntity(object):
                            :meth:`query`.
         """
         self.model = model
+        #: The name of the core of this entity, set in
+        #: :data:`sir.schema.SCHEMA`
+        self.name = None
         self.fields = fields
         self.extrapaths = extrapaths
         self.extraquery = extraquery
         self._query = None
+        self._builder = None
         self.version = version
         self.compatconverter = compatconverter
 
@@ -170,14 +400,70 @@ class SearchEntity(object):
 
         return self._query
 
+    @property
+    def builder(self):
+        """
+        A function that converts an instance of :attr:`model` into a dict of
+        the values of all fields, compiled by :func:`compile_fields` on first
+        use.
+        """
+        if self._builder is None:
+            self._builder = compile_fields(self.model, self.fields)
+
+        return self._builder
+
+    def loader_strategies(self):
+        """
+        Return the strategy for eagerly loading one-to-many relationships
+        and the strategies for the relationships at specific paths, as
+        configured in the ``core:<name>`` section of the configuration,
+        falling back to the ``sir`` section.
+
+        ``eager_loading`` is one of :data:`LOADER_STRATEGIES` and defaults to
+        ``subquery``. ``eager_loading_paths`` is a whitespace-separated list
+        of ``<path>:<strategy>`` items whose paths lead from :attr:`model`
+        to a relationship, like ``tracks.medium.release.country_dates``.
+        Many-to-one relationships are loaded with ``joined`` unless a path
+        says otherwise.
+
+        :raises sir.config.ConfigError: If a strategy is unknown
+        :rtype: (str, dict(str, str))
+        """
+        def get(option, fallback):
+            value = config.CFG.get("sir", option, fallback=fallback)
+            if self.name is not None:
+                value = config.CFG.get("core:%s" % self.name, option,
+                                       fallback=value)
+            return value
+
+        default = get("eager_loading", "subquery")
+        paths = {}
+        for item in get("eager_loading_paths", "").split():
+            path, _, strategy = item.rpartition(":")
+            paths[path] = strategy
+        for strategy in [default] + list(paths.values()):
+            if strategy not in LOADER_STRATEGIES:
+                raise config.ConfigError("Unknown eager loading strategy %r"
+                                         % strategy)
+        return default, paths
+
     def build_entity_query(self):
         """
         Builds a :class:`sqla:sqlalchemy.orm.query.Query` object for this
         entity (an instance of :class:`sir.schema.searchentities.SearchEntity`)
-        that eagerly loads the values of all search fields.
+        that eagerly loads the values of all search fields with the
+        strategies returned by :meth:`loader_strategies`.
+
+        If ``dimension_cache`` is enabled in the ``sir`` section, the
+        relationships to the lookup tables cached by :mod:`sir.dimensions`
+        aren't loaded by the query.
 
         :rtype: :class:`sqla:sqlalchemy.orm.query.Query`
         """
+        default_strategy, path_strategies = self.loader_strategies()
+        cache_dimensions = config.CFG.getboolean("sir", "dimension_cache",
+                                                 fallback=False)
+
         root_model = self.model
         query = Query(root_model)
         paths = [field.paths for field in self.fields]
@@ -194,7 +480,7 @@ class SearchEntity(object):
                 model = root_model
                 load = Load(model)
                 split_path = path.split(".")
-                for pathelem in split_path:
+                for i, pathelem in enumerate(split_path):
                     current_merged_path = current_merged_path[pathelem]
                     column = getattr(model, pathelem)
 
@@ -205,11 +491,22 @@ class SearchEntity(object):
 
                     prop = column.property
                     if isinstance(prop, RelationshipProperty):
+                        if cache_dimensions and dimensions.is_cached(prop):
+                            # Only the foreign key is needed, the related
+                            # row is filled in from the cache
+                            load = load.lazyload(column)
+                            break
                         pk = column.mapper.primary_key[0].name
-                        if prop.direction == ONETOMANY:
-                            load = load.subqueryload(column)
-                        elif prop.direction == MANYTOONE:
-                            load = load.joinedload(column)
+                        strategy = path_strategies.get(
+                            ".".join(split_path[:i + 1]))
+                        if strategy is None:
+                            if prop.direction == ONETOMANY:
+                                strategy = default_strategy
+                            elif prop.direction == MANYTOONE:
+                                strategy = "joined"
+                        if strategy is not None:
+                            load = getattr(load,
+                                           LOADER_STRATEGIES[strategy])(column)
                         else:
                             load = load.defaultload(column)
                         required_columns = list(current_merged_path.keys())
@@ -255,33 +552,7 @@ class SearchEntity(object):
         :param obj: A :ref:`declarative <sqla:declarative_toplevel>` object.
         :rtype: dict
         """
-        data = {}
-        for field in self.fields:
-            fieldname = field.name
-            tempvals = set()
-            for path in field.paths:
-                for value in iterate_path_values(path, obj):
-                    if value is not None:
-                        if isinstance(value, list):
-                            tempvals.update(set(value))
-                        else:
-                            tempvals.add(value)
-            if field.transformfunc is not None:
-                tempvals = field.transformfunc(tempvals)
-            if (isinstance(tempvals, set) or isinstance(tempvals, list)) and len(tempvals) == 1:
-                tempvals = tempvals.pop()
-            if tempvals is not None and tempvals:
-                if isinstance(tempvals, UUID):
-                    new_tempvals = str(tempvals)
-                elif isinstance(tempvals, set) or isinstance(tempvals, list):
-                    new_tempvals = list()
-                    for tempval in tempvals:
-                        if isinstance(tempval, UUID):
-                            tempval = str(tempval)
-                        new_tempvals.append(tempval)
-                else:
-                    new_tempvals = tempvals
-                data[fieldname] = new_tempvals
+        data = self.builder(obj)
 
         if (config.CFG.getboolean("sir", "wscompat") and self.compatconverter is
             not None):
@@ -0,0 +1,235 @@
+# Copyright (c) 2026 MetaBrainz Foundation
+# License: MIT, see LICENSE for details
+"""
+This module splits a reindex into shards, so several hosts can reindex
+disjoint parts of the same cores at the same time.
+
+The ids of each entity type are divided into blocks of ``block_size`` ids.
+A :class:`Shard` reindexes the blocks whose number modulo the number of
+shards is its index. A :class:`LeasedShard` claims blocks through a lease
+table in the MusicBrainz database instead, so the blocks of a host that
+crashed are picked up by the other hosts once their leases expire.
+"""
+import os
+import socket
+import threading
+
+from . import util
+from logging import getLogger
+from sqlalchemy import func, select, text
+
+
+__all__ = ["Shard", "LeasedShard", "block_range"]
+
+
+logger = getLogger("sir")
+
+
+def block_range(block, last, block_size):
+    """
+    Return the half-open range of ids of block number ``block``. The range
+    of the ``last`` block is unbounded, so it covers rows added later.
+
+    :param int block:
+    :param int last:
+    :param int block_size:
+    :rtype: (int, int)
+    """
+    return (block * block_size,
+            None if block >= last else (block + 1) * block_size)
+
+
+class Shard(object):
+    """
+    Selects the blocks of ids belonging to shard ``index`` of ``count``.
+
+    :param int index: Starts at 0
+    :param int count:
+    :param int block_size:
+    """
+
+    def __init__(self, index, count, block_size):
+        if not 0 <= index < count:
+            raise ValueError("Shard %d doesn't exist among %d shards" %
+                             (index, count))
+        self.index = index
+        self.count = count
+        self.block_size = block_size
+
+    def __str__(self):
+        return "%d/%d" % (self.index + 1, self.count)
+
+    def contains(self, id_):
+        """
+        Return whether the row with id ``id_`` belongs to this shard.
+
+        :param int id_:
+        :rtype: bool
+        """
+        return id_ // self.block_size % self.count == self.index
+
+    def _last_block(self, session, model):
+        max_id = session.execute(select(func.max(model.id))).scalar()
+        return None if max_id is None else max_id // self.block_size
+
+    def ranges(self, session, core, model):
+        """
+        Return an iterator over the ranges of ids of ``model`` that this
+        shard reindexes.
+
+        :param sqlalchemy.orm.session.Session session:
+        :param str core:
+        :param model: A :ref:`declarative <sqla:declarative_toplevel>` class.
+        :rtype: iterator over (int, int)
+        """
+        last = self._last_block(session, model)
+        if last is None:
+            return
+        for block in range(self.index, last + 1, self.count):
+            yield block_range(block, last, self.block_size)
+
+    def start(self):
+        pass
+
+    def finish(self, core):
+        """
+        Record that the ranges of ``core`` returned by :meth:`ranges` have
+        been reindexed successfully.
+
+        :param str core:
+        """
+        pass
+
+    def stop(self):
+        pass
+
+
+class LeasedShard(Shard):
+    """
+    Like :class:`Shard`, but claims the blocks through the
+    ``sir.reindex_lease`` table (see ``sql/CreateReindexLeaseTable.sql``)
+    for the run ``run_id``.
+
+    The first host reindexing a core in a run adds a row for each of its
+    blocks to the table. Blocks are claimed one at a time, starting with the
+    unclaimed blocks of this shard, followed by blocks of any shard whose
+    lease has expired. Leases expire ``timeout`` seconds after they have
+    been claimed or renewed, and :meth:`start` starts a thread renewing the
+    leases of this process. Once a core has been reindexed successfully,
+    its blocks claimed by this process are marked as done and won't be
+    claimed again in the same run.
+
+    :param int index:
+    :param int count:
+    :param int block_size:
+    :param sqlalchemy.orm.session.sessionmaker db_session:
+    :param str run_id:
+    :param int timeout:
+    """
+
+    def __init__(self, index, count, block_size, db_session, run_id,
+                 timeout):
+        super(LeasedShard, self).__init__(index, count, block_size)
+        self.db_session = db_session
+        self.run_id = run_id
+        self.timeout = timeout
+        self.owner = "%s:%d" % (socket.gethostname(), os.getpid())
+        self._stopped = threading.Event()
+        self._heartbeat = None
+
+    def _params(self, **params):
+        params.update(run_id=self.run_id, owner=self.owner,
+                      timeout=self.timeout, index=self.index,
+                      count=self.count)
+        return params
+
+    def ranges(self, session, core, model):
+        """
+        Like :meth:`Shard.ranges`, but ``session`` is only used to determine
+        the last block. The leases are claimed through the sessions of
+        ``db_session``, because ``session`` may be read-only (see
+        :func:`sir.util.use_snapshot`).
+        """
+        last = self._last_block(session, model)
+        if last is None:
+            return
+        with util.db_session_ctx(self.db_session) as lease_session:
+            lease_session.execute(text(
+                "INSERT INTO sir.reindex_lease (run_id, core, block, expires) "
+                "SELECT :run_id, :core, block, "
+                "now() + :timeout * interval '1 second' "
+                "FROM generate_series(0, :last) AS block "
+                "ON CONFLICT DO NOTHING"), self._params(core=core, last=last))
+            # Other hosts may have added more blocks if rows have been added
+            last = lease_session.execute(text(
+                "SELECT max(block) FROM sir.reindex_lease "
+                "WHERE run_id = :run_id AND core = :core"),
+                self._params(core=core)).scalar()
+        claimed = 0
+        while True:
+            with util.db_session_ctx(self.db_session) as lease_session:
+                block = lease_session.execute(text(
+                    "UPDATE sir.reindex_lease SET owner = :owner, "
+                    "expires = now() + :timeout * interval '1 second' "
+                    "WHERE (run_id, core, block) IN ("
+                    "SELECT run_id, core, block FROM sir.reindex_lease "
+                    "WHERE run_id = :run_id AND core = :core AND NOT done "
+                    "AND ((owner IS NULL AND mod(block, :count) = :index) "
+                    "OR expires < now()) "
+                    "ORDER BY mod(block, :count) = :index DESC, block "
+                    "LIMIT 1 FOR UPDATE SKIP LOCKED) "
+                    "RETURNING block"), self._params(core=core)).scalar()
+            if block is None:
+                break
+            claimed += 1
+            yield block_range(block, last, self.block_size)
+        if not claimed:
+            logger.info("There are no blocks of %s left to claim in run %s",
+                        core, self.run_id)
+
+    def _execute(self, statement, **params):
+        with util.db_session_ctx(self.db_session) as session:
+            session.execute(text(statement), self._params(**params))
+
+    def _renew(self):
+        while not self._stopped.wait(self.timeout / 3):
+            try:
+                self._execute(
+                    "UPDATE sir.reindex_lease "
+                    "SET expires = now() + :timeout * interval '1 second' "
+                    "WHERE run_id = :run_id AND owner = :owner AND NOT done")
+            except Exception as exc:
+                logger.error("Failed to renew the leases of shard %s: %s",
+                             self, exc)
+
+    def start(self):
+        """
+        Start renewing the leases of this process in a thread.
+        """
+        self._stopped.clear()
+        self._heartbeat = threading.Thread(target=self._renew,
+                                           name="LeaseHeartbeat",
+                                           daemon=True)
+        self._heartbeat.start()
+
+    def finish(self, core):
+        self._execute("UPDATE sir.reindex_lease SET done = true "
+                      "WHERE run_id = :run_id AND core = :core "
+                      "AND owner = :owner", core=core)
+
+    def stop(self):
+        """
+        Stop renewing leases and release the ones of blocks that aren't
+        done, so other hosts can claim them right away.
+        """
+        self._stopped.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        try:
+            self._execute("UPDATE sir.reindex_lease SET expires = now() "
+                          "WHERE run_id = :run_id AND owner = :owner "
+                          "AND NOT done")
+        except Exception as exc:
+            logger.error("Failed to release the leases of shard %s: %s",
+                         self, exc)
@@ -0,0 +1,403 @@
+# Copyright (c) 2026 MetaBrainz Foundation
+# License: MIT, see LICENSE for details
+"""
+This module writes the documents of entity types to compressed JSONL files
+(shards) instead of sending them to Solr, see :func:`export`, and sends such
+files to Solr, see :func:`load`.
+"""
+import gzip
+import io
+import json
+import os
+import signal
+import threading
+import time
+
+from . import config, indexing, util
+from .schema import SCHEMA
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from logging import getLogger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+__all__ = ["export", "load", "queue_to_shards", "ShardWriter",
+           "LoadProgress", "open_shard", "shard_paths", "COMPRESSIONS"]
+
+
+logger = getLogger("sir")
+
+#: Maps the supported compression methods to the extension of their files.
+COMPRESSIONS = {"gzip": ".jsonl.gz", "zstd": ".jsonl.zst", "none": ".jsonl"}
+
+#: The name of the file in the export directory that keeps track of the
+#: progress of :func:`load`.
+PROGRESS_FILE = "load-progress.json"
+
+
+def open_shard(path, mode="rb", compression=None):
+    """
+    Open the shard at ``path``.
+
+    :param str path:
+    :param str mode: Either ``rb`` or ``wb``
+    :param str compression: One of :data:`COMPRESSIONS`. By default, it's
+                            determined by the extension of ``path``.
+    :raises ValueError: If the compression method isn't supported
+    """
+    if compression is None:
+        for compression, extension in COMPRESSIONS.items():
+            if path.endswith(extension):
+                break
+        else:
+            raise ValueError("Unknown shard type %s" % path)
+    if compression == "gzip":
+        return gzip.open(path, mode, compresslevel=6)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ValueError("Reading or writing %s requires the zstandard "
+                             "package" % path)
+        if "r" in mode:
+            # Decompression readers don't support reading lines on their own
+            return io.BufferedReader(zstandard.open(path, mode))
+        return zstandard.open(path, mode)
+    return open(path, mode)
+
+
+def shard_paths(directory, core):
+    """
+    Return the paths of the complete shards of ``core`` in ``directory`` in
+    the order they have been written.
+
+    :param str directory:
+    :param str core:
+    :rtype: [str]
+    """
+    core_directory = os.path.join(directory, core)
+    if not os.path.isdir(core_directory):
+        return []
+    return sorted(os.path.join(core_directory, name)
+                  for name in os.listdir(core_directory)
+                  if name.startswith(core + "-") and
+                  name.endswith(tuple(COMPRESSIONS.values())))
+
+
+class ShardWriter(object):
+    """
+    Writes documents serialized to JSON into the shards of ``core`` below
+    ``directory``, one document per line and starting a new shard every
+    ``shard_size`` documents.
+
+    Shards are written under a temporary name and only get their final
+    name once they're complete. Existing shards of ``core`` are removed.
+
+    :param str directory:
+    :param str core:
+    :param int shard_size:
+    :param str compression: One of :data:`COMPRESSIONS`
+    """
+
+    def __init__(self, directory, core, shard_size, compression="gzip"):
+        self.directory = os.path.join(directory, core)
+        self.core = core
+        self.shard_size = shard_size
+        self.compression = compression
+        self.extension = COMPRESSIONS[compression]
+        self.shards = 0
+        self.documents = 0
+        self._file = None
+        self._path = None
+        self._lines = 0
+        os.makedirs(self.directory, exist_ok=True)
+        for path in shard_paths(directory, core):
+            os.remove(path)
+
+    def write(self, document):
+        """
+        :param bytes document:
+        """
+        if self._file is None:
+            self._path = os.path.join(self.directory, "%s-%05d%s" %
+                                      (self.core, self.shards,
+                                       self.extension))
+            self._file = open_shard(self._path + ".part", "wb",
+                                    self.compression)
+        self._file.write(document)
+        self._file.write(b"\n")
+        self._lines += 1
+        self.documents += 1
+        if self._lines >= self.shard_size:
+            self._finish_shard()
+
+    def _finish_shard(self):
+        self._file.close()
+        os.rename(self._path + ".part", self._path)
+        self._file = None
+        self._lines = 0
+        self.shards += 1
+
+    def close(self):
+        """
+        Complete the current shard.
+        """
+        if self._file is not None:
+            self._finish_shard()
+
+
+def queue_to_shards(queue, entity_name, directory, shard_size, compression):
+    """
+    Read :class:`dict` objects (or lists of them) from ``queue`` like
+    :func:`sir.indexing.queue_to_solr`, but write them to the shards of
+    ``entity_name`` in ``directory`` with a :class:`ShardWriter`.
+
+    :param multiprocessing.Queue queue:
+    :param str entity_name:
+    :param str directory:
+    :param int shard_size:
+    :param str compression: One of :data:`COMPRESSIONS`
+    """
+    # Restoring the default SIGTERM handler so the process can actually be
+    # terminated on calling terminate.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    start = time.time()
+    writer = None
+    stopped = False
+    failed = False
+    try:
+        writer = ShardWriter(directory, entity_name, shard_size, compression)
+        while True:
+            item = queue.get()
+            if not indexing.PROCESS_FLAG.value or item is indexing.STOP:
+                stopped = True
+                break
+            if not isinstance(item, list):
+                item = [item]
+            for document in item:
+                if not isinstance(document, bytes):
+                    document = indexing.encode_document(document)
+                writer.write(document)
+        writer.close()
+    except Exception as exc:
+        logger.error("Failed to export %s, discarding its documents",
+                     entity_name)
+        logger.exception(exc)
+        indexing.FAILED.value = True
+        failed = True
+        while not stopped and queue.get() is not indexing.STOP:
+            pass
+    queue.put(indexing.STOP)
+
+    if writer is not None and not failed:
+        duration = time.time() - start
+        logger.info("Exported %d documents of %s into %d shards in %.1fs "
+                    "(%.0f documents/s)", writer.documents, entity_name,
+                    writer.shards, duration,
+                    writer.documents / duration if duration else 0)
+
+
+def export(args):
+    """
+    Writes the documents of all entity types in args["entity_type"] to
+    shards in args["directory"] instead of sending them to Solr.
+
+    If no types are specified, all known entities will be exported.
+
+    :param args: A dictionary with the keys ``entity_type``, ``directory``,
+                 ``shard_size`` and ``compression``.
+    :type args: dict
+    """
+    if not indexing.PROCESS_FLAG.value:
+        logger.info('Process Flag is off, terminating.')
+        return
+
+    entities = args["entity_type"]
+    if entities is None:
+        entities = SCHEMA.keys()
+
+    compression = args["compression"]
+    if compression == "zstd" and zstandard is None:
+        logger.error("zstd compression requires the zstandard package")
+        return
+
+    indexing.FAILED.value = False
+    sender = partial(queue_to_shards,
+                     directory=args["directory"],
+                     shard_size=args["shard_size"],
+                     compression=compression)
+    indexing._multiprocessed_import(entities, sender=sender)
+    if indexing.FAILED.value:
+        logger.error("Not all documents could be exported")
+
+
+class LoadProgress(object):
+    """
+    Keeps track of the number of lines of each shard that have been sent to
+    Solr in the JSON file at ``path``. The file is rewritten after every
+    update, so the progress survives interruptions.
+
+    :param str path:
+    :param bool reset: Whether to discard the progress recorded so far
+    """
+
+    def __init__(self, path, reset=False):
+        self.path = path
+        self._lock = threading.Lock()
+        self._sent = {}
+        if not reset and os.path.exists(path):
+            with open(path) as f:
+                self._sent = json.load(f)
+
+    def sent(self, shard):
+        """
+        Return the number of lines of ``shard`` that have been sent.
+
+        :param str shard:
+        :rtype: int
+        """
+        with self._lock:
+            return self._sent.get(shard, 0)
+
+    def update(self, shard, lines):
+        """
+        Record that the first ``lines`` lines of ``shard`` have been sent.
+
+        :param str shard:
+        :param int lines:
+        """
+        with self._lock:
+            self._sent[shard] = lines
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(self._sent, f)
+            os.replace(self.path + ".tmp", self.path)
+
+
+def _load_shard(solr_connection, path, key, progress, batch_size, retries,
+                backoff):
+    """
+    Send the lines of the shard at ``path`` that haven't been sent according
+    to ``progress`` to ``solr_connection`` in batches of ``batch_size``.
+
+    :returns: The number of documents sent, or ``None`` if sending failed
+    """
+    skip = progress.sent(key)
+    sent = 0
+    batch = []
+    lines = 0
+    with open_shard(path) as f:
+        for lines, line in enumerate(f, 1):
+            if lines <= skip:
+                continue
+            if not indexing.PROCESS_FLAG.value:
+                return None
+            batch.append(line.rstrip(b"\n"))
+            if len(batch) >= batch_size:
+                if not indexing.send_data_to_solr(solr_connection, batch,
+                                                  retries, backoff):
+                    return None
+                sent += len(batch)
+                progress.update(key, lines)
+                batch = []
+    if batch:
+        if not indexing.send_data_to_solr(solr_connection, batch, retries,
+                                          backoff):
+            return None
+        sent += len(batch)
+    progress.update(key, lines)
+    return sent
+
+
+def load(args):
+    """
+    Sends the shards written by :func:`export` for all entity types in
+    args["entity_type"] from args["directory"] to Solr, with up to
+    args["parallel"] requests running at the same time.
+
+    If no types are specified, all entity types with shards in the
+    directory will be loaded.
+
+    The shards are read line by line and sent in batches of the Solr
+    ``batch_size``. The number of lines sent from each shard is recorded in
+    :data:`PROGRESS_FILE` in the directory. If args["resume"] is true, lines
+    that have been sent by a previous run are skipped, relying on Solr's
+    update log to keep documents that have been sent but not committed yet.
+    Once all shards of an entity type have been sent, its core is committed
+    once.
+
+    :param args: A dictionary with the keys ``entity_type``, ``directory``,
+                 ``parallel`` and ``resume``.
+    :type args: dict
+    """
+    directory = args["directory"]
+    entities = args["entity_type"]
+    if entities is None:
+        entities = [e for e in SCHEMA.keys() if shard_paths(directory, e)]
+    shards = dict((e, shard_paths(directory, e)) for e in entities)
+    for e, paths in shards.items():
+        if not paths:
+            logger.warning("There are no shards of %s in %s", e, directory)
+
+    try:
+        logger.info("Checking whether the versions of the Solr cores are "
+                    "supported")
+        util.check_solr_cores_version(entities)
+    except util.VersionMismatchException as exc:
+        logger.error(exc)
+        return
+
+    parallel = args["parallel"]
+    batch_size = config.CFG.getint("solr", "batch_size")
+    retries = config.CFG.getint("solr", "retries", fallback=3)
+    backoff = config.CFG.getfloat("solr", "backoff_factor", fallback=1)
+    progress = LoadProgress(os.path.join(directory, PROGRESS_FILE),
+                            reset=not args["resume"])
+    connections = dict((e, util.solr_connection(e, pool_size=parallel))
+                       for e, paths in shards.items() if paths)
+    remaining = Counter(dict((e, len(paths)) for e, paths in shards.items()))
+    documents = Counter()
+    failed = set()
+    start = time.time()
+
+    with ThreadPoolExecutor(parallel) as executor:
+        futures = {}
+        for e, paths in shards.items():
+            for path in paths:
+                key = os.path.relpath(path, directory)
+                future = executor.submit(_load_shard, connections[e], path,
+                                         key, progress, batch_size, retries,
+                                         backoff)
+                futures[future] = (e, key)
+        for future in as_completed(futures):
+            e, key = futures[future]
+            try:
+                sent = future.result()
+            except Exception as exc:
+                logger.error("Failed to load %s: %s", key, exc)
+                sent = None
+            remaining[e] -= 1
+            if sent is None:
+                failed.add(e)
+            else:
+                documents[e] += sent
+                logger.info("Loaded %d documents from %s, %d shards of %s "
+                            "left", sent, key, remaining[e], e)
+            if remaining[e]:
+                continue
+            if e in failed:
+                logger.error("Not all shards of %s could be loaded, not "
+                             "committing it. Run the load again with "
+                             "--resume to retry.", e)
+                continue
+            try:
+                connections[e].commit()
+            except Exception as exc:
+                logger.error("Failed to commit %s: %s", e, exc)
+                failed.add(e)
+            else:
+                logger.info("Successfully loaded %d documents of %s in "
+                            "%.1fs", documents[e], e, time.time() - start)
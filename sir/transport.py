@@ -0,0 +1,263 @@
+# Copyright (c) 2026 MetaBrainz Foundation
+# License: MIT, see LICENSE for details
+"""
+This module contains the channels over which documents are passed from the
+processes querying the database to the processes sending them to Solr.
+"""
+import multiprocessing
+import time
+
+from collections import namedtuple
+from .config import ConfigError
+
+
+__all__ = ["Batch", "BatchingQueue", "BoundedChannel", "TagDone",
+           "TagSkipped", "Transport"]
+
+
+class Batch(list):
+    """
+    A list of items that's optionally tagged with the unit of work (for
+    example the bounds of a query) they belong to.
+
+    :param items:
+    :param tag:
+    """
+
+    def __init__(self, items=(), tag=None):
+        list.__init__(self, items)
+        self.tag = tag
+
+
+#: Put into a channel by :meth:`BatchingQueue.finish` after all ``count``
+#: items tagged with ``tag`` have been put into it.
+TagDone = namedtuple("TagDone", ["tag", "count"])
+
+#: Announces that ``count`` items tagged with ``tag`` have been dropped on
+#: the way, so the receiving side doesn't wait for them.
+TagSkipped = namedtuple("TagSkipped", ["tag", "count"])
+
+
+class BatchingQueue(object):
+    """
+    Collects items and puts them into ``queue`` as lists of ``batch_size``
+    items, so only one message per batch has to be passed between processes.
+
+    :meth:`flush` has to be called once no more items will be added.
+    :attr:`waited` adds up the seconds spent putting messages into
+    ``queue``, which includes waiting for room in it.
+
+    If :meth:`start` has been called with a tag, the batches are
+    :class:`Batch` objects tagged with it and :meth:`finish` additionally
+    puts a :class:`TagDone` message into ``queue``.
+
+    :param queue: Any object with a ``put`` method.
+    :param int batch_size:
+    :param encode: An optional function that's applied to each item before
+                   it's added to the current batch.
+    """
+
+    def __init__(self, queue, batch_size, encode=None):
+        self.queue = queue
+        self.batch_size = batch_size
+        self.encode = encode
+        self._batch = []
+        self._tag = None
+        self._count = 0
+        self.waited = 0.0
+
+    def start(self, tag=None):
+        """
+        Tag all items added from now on with ``tag``. :meth:`flush` has to
+        be called first if items tagged otherwise have been added.
+        """
+        self._tag = tag
+        self._count = 0
+
+    def put(self, item):
+        if self.encode is not None:
+            item = self.encode(item)
+        self._batch.append(item)
+        self._count += 1
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._batch:
+            if self._tag is not None:
+                self._batch = Batch(self._batch, self._tag)
+            self._put(self._batch)
+            self._batch = []
+
+    def _put(self, message):
+        start = time.time()
+        self.queue.put(message)
+        self.waited += time.time() - start
+
+    def finish(self):
+        """
+        Flush and, if a tag has been given to :meth:`start`, tell the
+        receiving side how many items have been tagged with it.
+        """
+        self.flush()
+        if self._tag is not None:
+            self._put(TagDone(self._tag, self._count))
+            self._tag = None
+
+
+def _weight(item):
+    """
+    Return the number of documents in ``item`` and the number of bytes of
+    those that have already been serialized.
+
+    :rtype: (int, int)
+    """
+    if item is None or isinstance(item, (TagDone, TagSkipped)):
+        return 0, 0
+    if not isinstance(item, list):
+        item = [item]
+    return len(item), sum(len(doc) for doc in item if isinstance(doc, bytes))
+
+
+class BoundedChannel(object):
+    """
+    Wraps a channel so that at most ``max_documents`` documents, or
+    ``max_bytes`` bytes of serialized documents, are waiting in it. Putting
+    an item blocks until there's enough room for it, unless the channel is
+    empty, so items larger than the capacity can still be passed. A limit of
+    0 means no limit.
+
+    The number of waiting documents and bytes is kept in ``counters`` and
+    guarded by ``condition``, which have to be shareable with the processes
+    using the channel.
+
+    :param channel: Any object with ``put``, ``get`` and ``close`` methods.
+    :param int max_documents:
+    :param int max_bytes:
+    :param condition:
+    :type condition: :class:`multiprocessing.Condition`
+    :param counters: The number of waiting documents and bytes
+    :type counters: A sequence of two integers
+    """
+
+    def __init__(self, channel, max_documents, max_bytes, condition,
+                 counters):
+        self.channel = channel
+        self.max_documents = max_documents
+        self.max_bytes = max_bytes
+        self._condition = condition
+        self._counters = counters
+
+    def _full(self, documents, size):
+        waiting_documents, waiting_bytes = self._counters[:]
+        if not waiting_documents:
+            return False
+        return ((self.max_documents and
+                 waiting_documents + documents > self.max_documents) or
+                (self.max_bytes and waiting_bytes + size > self.max_bytes))
+
+    def put(self, item):
+        documents, size = _weight(item)
+        if documents:
+            with self._condition:
+                while self._full(documents, size):
+                    # The timeout guards against missed notifications
+                    self._condition.wait(1)
+                self._counters[0] += documents
+                self._counters[1] += size
+        self.channel.put(item)
+
+    def get(self):
+        item = self.channel.get()
+        documents, size = _weight(item)
+        if documents:
+            with self._condition:
+                self._counters[0] -= documents
+                self._counters[1] -= size
+                self._condition.notify_all()
+        return item
+
+    def depth(self):
+        """
+        Return the number of documents and bytes waiting in the channel.
+
+        :rtype: (int, int)
+        """
+        with self._condition:
+            return tuple(self._counters[:])
+
+    def close(self):
+        self.channel.close()
+
+
+class Transport(object):
+    """
+    Creates one channel per name in ``names``. Two kinds of channels are
+    supported:
+
+    ``pipe``
+        A :class:`multiprocessing.SimpleQueue`, which writes directly into a
+        pipe. Its channels can only be passed to other processes when they
+        are started.
+
+    ``manager``
+        A queue living in a :class:`multiprocessing.managers.SyncManager`
+        server process, which can be passed to other processes at any time
+        but needs a round-trip through the server process for every message.
+
+    If ``max_documents`` or ``max_bytes`` is given, the channels are
+    :class:`BoundedChannel` objects limiting the number of documents or
+    bytes of serialized documents waiting in each of them, so processes
+    putting items into them block while the receiving side falls behind.
+
+    :param str kind: Either ``pipe`` or ``manager``.
+    :param [str] names:
+    :param int max_documents:
+    :param int max_bytes:
+    :raises sir.config.ConfigError: If ``kind`` is unknown
+    """
+
+    def __init__(self, kind, names, max_documents=0, max_bytes=0):
+        self.kind = kind
+        self._manager = None
+        if kind == "pipe":
+            factory = multiprocessing.SimpleQueue
+        elif kind == "manager":
+            self._manager = multiprocessing.Manager()
+            factory = self._manager.Queue
+        else:
+            raise ConfigError("Unknown transport %s" % kind)
+        #: Maps names to channels.
+        self.channels = dict((name, factory()) for name in names)
+        if max_documents or max_bytes:
+            for name, channel in self.channels.items():
+                self.channels[name] = BoundedChannel(
+                    channel, max_documents, max_bytes, *self._limit())
+
+    def _limit(self):
+        if self._manager is not None:
+            return (self._manager.Condition(),
+                    self._manager.list([0, 0]))
+        return (multiprocessing.Condition(),
+                multiprocessing.Array("q", 2, lock=False))
+
+    def depths(self):
+        """
+        Return the number of documents and bytes waiting in each bounded
+        channel.
+
+        :rtype: dict(str, (int, int))
+        """
+        return dict((name, channel.depth())
+                    for name, channel in self.channels.items()
+                    if isinstance(channel, BoundedChannel))
+
+    def close(self):
+        """
+        Release the resources of all channels.
+        """
+        if self._manager is not None:
+            self._manager.shutdown()
+        else:
+            for channel in self.channels.values():
+                channel.close()
@@ -5,6 +5,7 @@
 import amqp
 import logging
 import pysolr
+import re
 import urllib.request, urllib.error, urllib.parse
 
 import requests
@@ -16,7 +17,7 @@ from .schema import SCHEMA
 from contextlib import contextmanager
 from functools import partial
 from json import loads
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.engine.url import URL
 from sqlalchemy.orm import sessionmaker
 
@@ -66,6 +67,57 @@ def db_session():
     return sessionmaker(bind=engine())
 
 
+def export_snapshot():
+    """
+    Open a read-only transaction with the ``REPEATABLE READ`` isolation level
+    and export its snapshot, so other sessions can see the database in the
+    same state, see :func:`use_snapshot`.
+
+    The snapshot can only be imported as long as the transaction is open, so
+    the returned connection has to be kept open and closed afterwards.
+
+    :returns: The connection, the identifier of the snapshot and the WAL
+              position of the database when the snapshot was taken
+    :rtype: (:class:`sqla:sqlalchemy.engine.Connection`, str, str)
+    """
+    connection = engine().connect()
+    try:
+        connection.exec_driver_sql("SET TRANSACTION ISOLATION LEVEL "
+                                   "REPEATABLE READ READ ONLY")
+        snapshot, lsn = connection.execute(text(
+            "SELECT pg_export_snapshot(), "
+            "CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() "
+            "ELSE pg_current_wal_lsn() END")).one()
+    except Exception:
+        connection.close()
+        raise
+    return connection, snapshot, str(lsn)
+
+
+def use_snapshot(target, snapshot):
+    """
+    Make every transaction of ``target`` a read-only ``REPEATABLE READ``
+    transaction seeing the database in the state of ``snapshot``, which has
+    been exported by :func:`export_snapshot`.
+
+    :param target: A session or a sessionmaker, in which case all of its
+                   sessions use the snapshot
+    :type target: :class:`sqla:sqlalchemy.orm.session.Session` or
+                  :class:`sqla:sqlalchemy.orm.session.sessionmaker`
+    :param str snapshot:
+    :raises ValueError: If ``snapshot`` isn't a snapshot identifier
+    """
+    if not re.match(r"^[0-9A-F]+(-[0-9A-F]+)+$", snapshot):
+        raise ValueError("%r is not a snapshot identifier" % snapshot)
+
+    @event.listens_for(target, "after_begin")
+    def set_snapshot(session, transaction, connection):
+        connection.exec_driver_sql("SET TRANSACTION ISOLATION LEVEL "
+                                   "REPEATABLE READ READ ONLY")
+        connection.exec_driver_sql("SET TRANSACTION SNAPSHOT '%s'" %
+                                   snapshot)
+
+
 @contextmanager
 def db_session_ctx(Session):
     """
@@ -99,11 +151,14 @@ def get_requests_session():
     return http
 
 
-def solr_connection(core):
+def solr_connection(core, pool_size=None):
     """
     Creates a :class:`solr:solr.Solr` connection for the core ``core``.
 
     :param str core:
+    :param int pool_size: If given, the number of connections to Solr that
+                          are kept alive for reuse, which should be at least
+                          the number of threads using the connection.
     :raises urllib2.URLError: if a ping to the cores ping handler doesn't
                               succeed
     :rtype: :class:`solr:solr.Solr`
@@ -113,6 +168,10 @@ def solr_connection(core):
     ping_uri = core_uri + "/admin/ping"
 
     session = requests.Session()
+    if pool_size:
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
 
     logger.debug("Setting up a connection to %s", solr_uri)
     logger.debug("Pinging %s", ping_uri)
@@ -123,19 +182,77 @@ def solr_connection(core):
     return pysolr.Solr(core_uri, session=session)
 
 
-def solr_version_check(core):
+def post_documents(solr_connection, documents, params=None):
+    """
+    Sends ``documents``, which are already serialized to JSON, to the update
+    handler of the Solr core behind ``solr_connection`` as one JSON array.
+
+    Unlike :meth:`pysolr.Solr.add`, this never decodes or re-encodes the
+    documents.
+
+    :param pysolr.Solr solr_connection:
+    :param [bytes] documents:
+    :param dict params: Additional query parameters for the update handler,
+                        for example ``{"commitWithin": 10000}``.
+    :raises pysolr.SolrError: If Solr can't be reached or doesn't respond
+                              with a status code of 200
+    """
+    body = b"[" + b",".join(documents) + b"]"
+    try:
+        response = solr_connection.get_session().post(
+            solr_connection.url + "/update",
+            params=params,
+            data=body,
+            headers={"Content-type": "application/json; charset=utf-8"},
+            timeout=solr_connection.timeout,
+            auth=solr_connection.auth)
+    except requests.exceptions.RequestException as exc:
+        raise pysolr.SolrError("Failed to send documents to %s: %s" %
+                               (solr_connection.url, exc))
+    if response.status_code != 200:
+        raise pysolr.SolrError("Solr responded with HTTP %d: %s" %
+                               (response.status_code, response.text))
+
+
+def solr_commit(solr_connection, soft=False, open_searcher=True):
+    """
+    Commits the changes sent to the Solr core behind ``solr_connection``.
+
+    Unlike :meth:`pysolr.Solr.commit`, this allows making a hard commit
+    without opening a new searcher, which makes the changes durable without
+    the cost of making them visible.
+
+    :param pysolr.Solr solr_connection:
+    :param bool soft: Whether to make a soft commit
+    :param bool open_searcher: Whether a hard commit opens a new searcher
+    :raises pysolr.SolrError: If Solr can't be reached or doesn't respond
+                              with a status code of 200
+    """
+    if soft:
+        params = {"softCommit": "true"}
+    else:
+        params = {"commit": "true"}
+        if not open_searcher:
+            params["openSearcher"] = "false"
+    post_documents(solr_connection, [], params)
+
+
+def solr_version_check(core, solr_core=None):
     """
     Checks that the version of the Solr core ``core`` matches the one in the
     schema.
 
     :param str core:
+    :param str solr_core: The name of the Solr core to check instead of
+                          ``core``, for example a shadow core
     :raises urllib2.URLError: If the Solr core can't be reached
     :raises sir.util.VersionMismatchException: If the version in Solr is
                                                different from the supported one
     """
     expected_version = SCHEMA[core].version
     solr_uri = config.CFG.get("solr", "uri")
-    u = urllib.request.urlopen("%s/%s/schema/version" % (solr_uri, core))
+    u = urllib.request.urlopen("%s/%s/schema/version" %
+                               (solr_uri, solr_core or core))
     content = loads(u.read())
     seen_version = content["version"]
     if not seen_version == expected_version:
@@ -155,6 +272,97 @@ def check_solr_cores_version(cores):
     list(map(solr_version_check, cores))
 
 
+def solr_core_admin(action, **params):
+    """
+    Runs ``action`` of the CoreAdmin API of the Solr server.
+
+    :param str action: For example ``STATUS`` or ``SWAP``
+    :param params: Additional parameters of the action
+    :raises requests.HTTPError: If Solr responds with an error
+    :rtype: dict
+    """
+    solr_uri = config.CFG.get("solr", "uri")
+    params.update(action=action, wt="json")
+    response = requests.get(solr_uri + "/admin/cores", params=params)
+    response.raise_for_status()
+    return response.json()
+
+
+def solr_config(core, command, value):
+    """
+    Runs ``command`` of the Config API of the Solr core ``core``.
+
+    :param str core:
+    :param str command: For example ``set-property``
+    :param value: The argument of the command
+    :raises requests.HTTPError: If Solr responds with an error
+    :rtype: dict
+    """
+    solr_uri = config.CFG.get("solr", "uri")
+    response = requests.post(solr_uri + "/" + core + "/config",
+                             json={command: value})
+    response.raise_for_status()
+    return response.json()
+
+
+#: The properties of a shadow core that are overridden while it's filled,
+#: so it neither opens new searchers on automatic commits nor makes soft
+#: commits.
+SHADOW_CORE_PROPERTIES = {"updateHandler.autoSoftCommit.maxTime": -1,
+                          "updateHandler.autoCommit.openSearcher": False}
+
+
+def shadow_core_name(core):
+    """
+    Returns the name of the shadow core of ``core``, made up of ``core`` and
+    the ``shadow_suffix`` in the ``solr`` section of the configuration.
+
+    :param str core:
+    :rtype: str
+    """
+    return core + config.CFG.get("solr", "shadow_suffix", fallback="_shadow")
+
+
+def prepare_shadow_core(core, clear=True):
+    """
+    Makes sure the shadow core of ``core`` exists, creating it with the
+    config set named by ``shadow_config_set`` in the ``solr`` section of the
+    configuration (``{core}`` is replaced by ``core``) if it doesn't.
+
+    The properties in :data:`SHADOW_CORE_PROPERTIES` are overridden with the
+    Config API until :func:`restore_shadow_core` is called.
+
+    :param str core:
+    :param bool clear: Whether to delete all documents in the shadow core
+    :returns: The name of the shadow core
+    :rtype: str
+    """
+    name = shadow_core_name(core)
+    status = solr_core_admin("STATUS", core=name)
+    if not status["status"].get(name):
+        config_set = config.CFG.get("solr", "shadow_config_set",
+                                    fallback="{core}").format(core=core)
+        logger.info("Creating the Solr core %s with the config set %s",
+                    name, config_set)
+        solr_core_admin("CREATE", name=name, instanceDir=name,
+                        configSet=config_set)
+    if clear:
+        logger.info("Deleting all documents in the Solr core %s", name)
+        solr_connection(name).delete(q="*:*", commit=True)
+    solr_config(name, "set-property", SHADOW_CORE_PROPERTIES)
+    return name
+
+
+def restore_shadow_core(name):
+    """
+    Removes the overrides of :data:`SHADOW_CORE_PROPERTIES` from the shadow
+    core ``name``, so it uses the settings of its config set again.
+
+    :param str name:
+    """
+    solr_config(name, "unset-property", sorted(SHADOW_CORE_PROPERTIES))
+
+
 def create_amqp_connection():
     # type: () -> amqp.Connection
     """
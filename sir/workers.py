@@ -0,0 +1,339 @@
+# Copyright (c) 2026 MetaBrainz Foundation
+# License: MIT, see LICENSE for details
+"""
+A small process pool used by :func:`sir.indexing._multiprocessed_import`.
+
+Unlike :class:`multiprocessing.pool.Pool`, a worker of a :class:`WorkerPool`
+can decide on its own to retire after it has finished a task, for example
+because its memory usage grew too large. The parent process then starts a
+replacement. This allows keeping workers (and their database connections)
+alive across many tasks while still bounding their memory usage.
+"""
+import multiprocessing
+import os
+import pickle
+import resource
+import signal
+import time
+
+from collections import Counter
+from logging import getLogger
+from queue import Empty
+
+
+__all__ = ["WorkerPool", "WorkerError", "TaskError", "current_rss",
+           "peak_rss", "reset_peak_rss", "STATS"]
+
+
+logger = getLogger("sir")
+
+#: Counters describing the work done by the current worker process. Code
+#: running in a worker can add to them and they will be sent back to the
+#: parent when the worker exits.
+STATS = Counter()
+
+# Sent by a worker right before it exits.
+_EXITED = "exited"
+
+
+class WorkerError(Exception):
+    """
+    Raised in the parent process if a task failed in a way that can't be
+    reported with the original exception.
+    """
+    pass
+
+
+class TaskError(object):
+    """
+    Returned instead of a result by :meth:`WorkerPool.imap_unordered` for
+    a failed task if ``return_exceptions`` is true.
+
+    :param args: The argument of the failed task.
+    :param Exception exception: The exception raised by the task.
+    """
+
+    def __init__(self, args, exception):
+        self.args = args
+        self.exception = exception
+
+
+def current_rss():
+    """
+    Return the resident set size of the current process in bytes.
+
+    :rtype: int
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        # ru_maxrss is the peak and not the current value, which errs on the
+        # side of recycling a worker too early. It's in kilobytes on Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of the current process returned by
+    :func:`peak_rss` to the current one, if the kernel supports that.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except (IOError, OSError):
+        pass
+
+
+def peak_rss():
+    """
+    Return the peak resident set size of the current process in bytes since
+    the last call of :func:`reset_peak_rss`, or since it has been started if
+    the kernel doesn't support resetting it.
+
+    :rtype: int
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, IndexError, ValueError):
+        pass
+    # In kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _picklable_exception(exc):
+    try:
+        pickle.loads(pickle.dumps(exc))
+    except Exception:
+        return WorkerError(repr(exc))
+    return exc
+
+
+def _worker(inqueue, outqueue, initializer, initargs, maxtasks, max_rss):
+    """
+    The main loop of a worker process. Runs tasks from ``inqueue`` until
+    either ``maxtasks`` have been run, the resident set size exceeds
+    ``max_rss`` bytes or a ``None`` task is received.
+    """
+    # Restoring the default SIGTERM handler so the pool can actually
+    # terminate its workers
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    STATS.clear()
+
+    if initializer is not None:
+        initializer(*initargs)
+
+    completed = 0
+    while maxtasks is None or completed < maxtasks:
+        task = inqueue.get()
+        if task is None:
+            break
+        job, func, args = task
+        try:
+            result = (job, True, func(args))
+        except Exception as exc:
+            result = (job, False, _picklable_exception(exc))
+        outqueue.put(result)
+        completed += 1
+
+        if max_rss:
+            rss = current_rss()
+            if rss > max_rss:
+                logger.debug("Worker RSS of %d bytes exceeds %d bytes, "
+                             "recycling it after %d tasks",
+                             rss, max_rss, completed)
+                break
+
+    STATS["tasks"] += completed
+    outqueue.put((None, _EXITED, (os.getpid(), dict(STATS))))
+
+
+class WorkerPool(object):
+    """
+    A pool of worker processes.
+
+    :param int processes: The number of worker processes.
+    :param int maxtasks: The number of tasks a worker runs before it gets
+                         replaced by a new one. ``None`` means workers live
+                         until the pool is closed.
+    :param int max_rss: If not zero, a worker whose resident set size exceeds
+                        this many bytes after a task gets replaced by a new
+                        one.
+    :param initializer: A function that's called with ``initargs`` in each
+                        worker when it starts.
+    """
+
+    def __init__(self, processes, maxtasks=None, max_rss=0, initializer=None,
+                 initargs=()):
+        self._processes = processes
+        self._maxtasks = maxtasks
+        self._max_rss = max_rss
+        self._initializer = initializer
+        self._initargs = initargs
+        self._inqueue = multiprocessing.Queue()
+        self._outqueue = multiprocessing.Queue()
+        self._workers = {}
+        self._closed = False
+        self._job_counter = 0
+        self._stats = Counter()
+        for _ in range(processes):
+            self._start_worker()
+
+    def _start_worker(self):
+        start = time.time()
+        process = multiprocessing.Process(target=_worker,
+                                          args=(self._inqueue,
+                                                self._outqueue,
+                                                self._initializer,
+                                                self._initargs,
+                                                self._maxtasks,
+                                                self._max_rss))
+        process.daemon = True
+        process.start()
+        self._stats["workers"] += 1
+        self._stats["fork_time"] += time.time() - start
+        self._workers[process.pid] = process
+
+    def _worker_exited(self, pid, stats):
+        process = self._workers.pop(pid, None)
+        if process is not None:
+            process.join()
+        self._stats.update(stats)
+        if not self._closed:
+            self._start_worker()
+
+    def _reap_dead_workers(self):
+        """
+        Remove workers that died without saying goodbye, start replacements
+        and raise a :class:`WorkerError`, because whatever they were working
+        on is lost.
+        """
+        dead = [pid for pid, process in self._workers.items()
+                if process.exitcode is not None]
+        for pid in dead:
+            del self._workers[pid]
+            if not self._closed:
+                self._start_worker()
+        if dead and not self._closed:
+            raise WorkerError("Worker processes %s died unexpectedly" % dead)
+
+    def _get_message(self):
+        while True:
+            try:
+                return self._outqueue.get(timeout=1)
+            except Empty:
+                pass
+            if any(process.exitcode is not None
+                   for process in self._workers.values()):
+                # A worker flushes its goodbye message before exiting, so
+                # give it a chance to arrive before declaring it dead.
+                try:
+                    return self._outqueue.get(timeout=0.1)
+                except Empty:
+                    self._reap_dead_workers()
+            if self._closed and not self._workers:
+                return None
+
+    def imap_unordered(self, func, iterable, backlog=None,
+                       return_exceptions=False):
+        """
+        Call ``func`` with every element of ``iterable`` in the worker
+        processes and return an iterator over the results in the order in
+        which they finish.
+
+        ``iterable`` is consumed lazily: at most ``backlog`` tasks are
+        waiting for a worker or running at any time.
+
+        :param func: A picklable function taking a single argument.
+        :param iterable:
+        :param int backlog: Defaults to twice the number of processes.
+        :param bool return_exceptions: If true, a :class:`TaskError` is
+                                       returned for failed tasks instead of
+                                       raising the exception.
+        :raises: The exception raised by ``func`` if a task fails
+        """
+        if backlog is None:
+            backlog = 2 * self._processes
+        tasks = iter(iterable)
+        pending = {}
+        outstanding = 0
+        exhausted = False
+        while True:
+            while not exhausted and outstanding < backlog:
+                try:
+                    args = next(tasks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                self._job_counter += 1
+                self._inqueue.put((self._job_counter, func, args))
+                pending[self._job_counter] = args
+                outstanding += 1
+
+            if not outstanding:
+                return
+
+            job, status, value = self._get_message()
+            if status == _EXITED:
+                self._worker_exited(*value)
+                continue
+            outstanding -= 1
+            args = pending.pop(job)
+            if not status:
+                if return_exceptions:
+                    value = TaskError(args, value)
+                else:
+                    raise value
+            yield value
+
+    def close(self):
+        """
+        Tell all workers to exit once the tasks submitted so far are done.
+        """
+        self._closed = True
+        for _ in range(len(self._workers)):
+            self._inqueue.put(None)
+
+    def join(self):
+        """
+        Wait for all workers to exit. :meth:`close` has to be called first.
+        """
+        while self._workers:
+            message = self._get_message()
+            if message is not None and message[1] == _EXITED:
+                self._worker_exited(*message[2])
+
+    def terminate(self):
+        """
+        Stop all workers immediately.
+        """
+        self._closed = True
+        for process in self._workers.values():
+            process.terminate()
+        for process in self._workers.values():
+            process.join()
+        self._workers.clear()
+
+    def report(self):
+        """
+        Return a message describing how much process and database connection
+        setup was avoided by reusing workers, compared to starting one worker
+        per task.
+
+        :rtype: str
+        """
+        tasks = self._stats["tasks"]
+        workers = self._stats["workers"]
+        engines = self._stats["engines"]
+        saved_forks = max(tasks - workers, 0)
+        saved_engines = max(tasks - engines, 0)
+        fork_time = self._stats["fork_time"] / workers if workers else 0
+        engine_time = (self._stats["engine_setup_time"] / engines
+                       if engines else 0)
+        return ("Ran %d tasks in %d worker processes, avoiding %d forks "
+                "(~%.2fs) and %d database engine setups (~%.2fs)" %
+                (tasks, workers, saved_forks, saved_forks * fork_time,
+                 saved_engines, saved_engines * engine_time))
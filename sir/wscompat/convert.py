@@ -1,5 +1,6 @@
 # Copyright (c) Wieland Hoffmann
 # License: MIT, see LICENSE for details
+from sir.memo import memoize
 from sir.wscompat.modelfix import fix
 from functools import lru_cache
 from mbrng import models
@@ -126,7 +127,7 @@ def convert_iso_3166_3_code_list(obj):
     )
 
 
-@lru_cache()
+@memoize
 def convert_area_inner(obj):
     """
     :type obj: :class:`mbdata.models.Area`
@@ -152,7 +153,7 @@ def convert_area_simple(obj):
     return area
 
 
-@lru_cache()
+@memoize
 def convert_area_for_release_event(obj):
     """
     :type obj: :class:`mbdata.models.Area`
@@ -214,7 +215,7 @@ def convert_name_credit(obj, include_aliases=True):
     return nc
 
 
-@lru_cache(maxsize=5000)
+@memoize
 def convert_artist_credit(obj, include_aliases=True):
     """
     :type obj: :class:`mbdata.models.ArtistCredit`
@@ -284,7 +285,7 @@ def convert_attribute(obj):
     return attribute
 
 
-@lru_cache()
+@memoize
 def convert_artist_simple(obj, include_aliases=True):
     """
     :type obj: :class:`sir.schema.modelext.CustomArtist`
@@ -593,6 +594,7 @@ def convert_release_event(obj):
     return re
 
 
+@memoize
 def convert_release_event_list(obj):
     """
     :type obj: :class:`[mbdata.models.CountryDates]`
@@ -644,6 +646,7 @@ def convert_release_from_track(obj):
     return release
 
 
+@memoize
 def convert_release_group_for_release(obj):
     """
     :type obj: :class:`mbdata.models.ReleaseGroup`
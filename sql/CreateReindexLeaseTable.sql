@@ -0,0 +1,15 @@
+\set ON_ERROR_STOP 1
+BEGIN;
+
+CREATE SCHEMA IF NOT EXISTS sir;
+CREATE TABLE sir.reindex_lease (
+    run_id              text        NOT NULL,
+    core                text        NOT NULL,
+    block               integer     NOT NULL,
+    owner               text,
+    expires             timestamptz NOT NULL,
+    done                boolean     NOT NULL DEFAULT false,
+    PRIMARY KEY (run_id, core, block)
+);
+
+COMMIT;
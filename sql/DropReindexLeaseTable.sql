@@ -0,0 +1,3 @@
+\unset ON_ERROR_STOP
+
+DROP TABLE sir.reindex_lease;
@@ -1,7 +1,9 @@
 from collections import namedtuple
-from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
 from sqlalchemy.orm import composite, relationship, declarative_base
 
+from sir.schema.modelext import count_property
+
 Base = declarative_base()
 
 
@@ -18,6 +20,7 @@ class B(Base):
     foo = Column(Integer)
     c_id = Column('c', Integer, ForeignKey("table_c.id"))
     composite_column = composite(Comp, foo, c_id)
+    last_updated = Column(DateTime)
 
 
 class C(Base):
@@ -29,6 +32,7 @@ class C(Base):
     id = Column(Integer, primary_key=True)
     bar = Column(Integer)
     bs = relationship("B", backref="c")
+    last_updated = Column(DateTime)
 
 
 class D(Base):
@@ -41,3 +45,22 @@ class D(Base):
     key2 = Column(String)
     foo_id = Column(Integer)
     position = Column(Integer)
+
+
+class E(Base):
+    """
+    A class referring to :class:`.F` via its ``f_id`` attribute.
+    """
+    __tablename__ = "table_e"
+    id = Column(Integer, primary_key=True)
+    f_id = Column('f', Integer, ForeignKey("table_f.id"))
+
+
+class F(Base):
+    """
+    A class counting the :class:`.E` objects referring to it via its
+    ``e_count`` attribute.
+    """
+    __tablename__ = "table_f"
+    id = Column(Integer, primary_key=True)
+    e_count = count_property(E.f_id, id)
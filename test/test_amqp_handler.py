@@ -132,6 +132,14 @@ class HandlerTest(AmqpTestCase):
 
         self.handler.cores[self.entity_type].delete.assert_called_once_with(entity_gid)
 
+    def test_index_callback_invalidates_dimension_cache(self):
+        parsed_message = Message(1, 'artist_type', {'id': '1'}, 'update')
+        with mock.patch("sir.amqp.handler.dimensions") as dimensions:
+            with mock.patch.object(self.handler, "_index_by_pk"):
+                self.handler.index_callback.__wrapped__(self.handler,
+                                                        parsed_message)
+        dimensions.invalidate.assert_called_once_with('artist_type')
+
     def test_handler_checks_solr_version(self):
         handler.solr_version_check.assert_called_once_with(self.entity_type)
 
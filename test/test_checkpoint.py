@@ -0,0 +1,77 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from sir.checkpoint import CheckpointStore, merge_ranges, range_covered
+
+
+class CheckpointStoreTest(TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        self.store = CheckpointStore(self.path, "run")
+
+    def test_commit_complete_bounds(self):
+        self.store.add_sent("artist", {(1, 10): 5, (10, 20): 2})
+        self.store.set_expected("artist", (1, 10), 5)
+        self.store.set_expected("artist", (10, 20), 3)
+        self.store.set_expected("artist", (20, None), 0)
+        sent = self.store.sent_bounds("artist")
+        self.assertEqual(sorted(sent), [1, 20])
+        self.store.mark_committed("artist", sent)
+        self.assertEqual(self.store.sent_bounds("artist"), [])
+        self.assertEqual(self.store.committed_ranges("artist"),
+                         [(1, 10), (20, None)])
+
+    def test_sent_counts_add_up(self):
+        self.store.set_expected("artist", (1, 10), 5)
+        self.store.add_sent("artist", {(1, 10): 2})
+        self.assertEqual(self.store.sent_bounds("artist"), [])
+        self.store.add_sent("artist", {(1, 10): 3})
+        self.assertEqual(self.store.sent_bounds("artist"), [1])
+
+    def test_resume_after_crash_within_bound(self):
+        self.store.set_expected("artist", (1, 10), 0)
+        self.store.mark_committed("artist", [1])
+        # The run crashes after sending half of the documents of a bound
+        self.store.add_sent("artist", {(10, 20): 50})
+        resumed = CheckpointStore(self.path, "run")
+        resumed.discard_uncommitted("artist")
+        self.assertEqual(resumed.committed_ranges("artist"), [(1, 10)])
+        # The bound is sent again, possibly with a different upper bound
+        resumed.add_sent("artist", {(10, 30): 50})
+        resumed.set_expected("artist", (10, 30), 100)
+        self.assertEqual(resumed.sent_bounds("artist"), [])
+        resumed.add_sent("artist", {(10, 30): 50})
+        self.assertEqual(resumed.sent_bounds("artist"), [10])
+        resumed.mark_committed("artist", [10])
+        self.assertEqual(resumed.committed_ranges("artist"), [(1, 30)])
+
+    def test_runs_and_cores_are_separate(self):
+        other_run = CheckpointStore(self.path, "other")
+        self.store.set_expected("artist", (1, 10), 0)
+        self.store.mark_committed("artist", [1])
+        self.assertEqual(self.store.committed_ranges("label"), [])
+        self.assertEqual(other_run.committed_ranges("artist"), [])
+
+    def test_reset(self):
+        self.store.set_expected("artist", (1, 10), 0)
+        self.store.mark_committed("artist", [1])
+        self.store.reset("artist")
+        self.assertEqual(self.store.committed_ranges("artist"), [])
+
+
+class RangesTest(TestCase):
+    def test_merge(self):
+        self.assertEqual(merge_ranges([(10, 20), (1, 10), (30, 40),
+                                       (35, None), (50, 60)]),
+                         [(1, 20), (30, None)])
+
+    def test_covered(self):
+        ranges = [(1, 20), (30, None)]
+        self.assertTrue(range_covered((1, 10), ranges))
+        self.assertTrue(range_covered((10, 20), ranges))
+        self.assertTrue(range_covered((40, None), ranges))
+        self.assertFalse(range_covered((15, 25), ranges))
+        self.assertFalse(range_covered((10, None), [(1, 20)]))
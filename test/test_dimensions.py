@@ -0,0 +1,97 @@
+from unittest import mock, TestCase
+
+from mbdata.models import Artist, Medium, Release
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import lazyload, Session
+
+from sir import dimensions
+from sir.dimensions import (DimensionCache, dimension_relationships,
+                            is_dimension_table)
+from sir.schema import SCHEMA
+from sir.schema.searchentities import SearchField
+from test import models
+
+
+class DimensionCacheTest(TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite:///:memory:")
+        models.Base.metadata.create_all(self.engine)
+        with Session(self.engine) as session:
+            session.add_all([models.C(id=1, bar=10), models.C(id=2, bar=20),
+                             models.B(id=1, c_id=1), models.B(id=2),
+                             models.B(id=3, c_id=3)])
+            session.commit()
+        self.cache = DimensionCache([models.B.c.property])
+        with Session(self.engine) as session:
+            self.cache.load(session)
+            session.commit()
+        # Added after the cache has been loaded
+        with Session(self.engine) as session:
+            session.add(models.C(id=3, bar=30))
+            session.commit()
+        self.statements = []
+        event.listen(self.engine, "before_cursor_execute",
+                     lambda *args: self.statements.append(args[2]))
+
+    def tearDown(self):
+        self.cache.invalidate()
+
+    def query(self, session):
+        return (session.query(models.B).options(lazyload(models.B.c)).
+                order_by(models.B.id).all())
+
+    def test_related_rows_from_cache(self):
+        with Session(self.engine) as session:
+            b1, b2, _ = self.query(session)
+            self.assertIs(b1.c, self.cache.rows[models.C][1])
+            self.assertEqual(b1.c.bar, 10)
+            self.assertIsNone(b2.c)
+            self.assertEqual(len(self.statements), 1)
+
+    def test_missing_rows_are_loaded_lazily(self):
+        with Session(self.engine) as session:
+            b3 = self.query(session)[2]
+            self.assertEqual(b3.c.bar, 30)
+            self.assertEqual(len(self.statements), 2)
+
+    def test_invalidate(self):
+        self.cache.invalidate()
+        self.assertFalse(self.cache.loaded)
+        with Session(self.engine) as session:
+            b1 = self.query(session)[0]
+            self.assertIsNot(b1.c, None)
+            self.assertEqual(len(self.statements), 2)
+
+
+class DimensionRelationshipsTest(TestCase):
+    def test_is_dimension_table(self):
+        self.assertTrue(is_dimension_table("artist_type"))
+        self.assertTrue(is_dimension_table("gender"))
+        self.assertFalse(is_dimension_table("tag"))
+        self.assertFalse(is_dimension_table("area"))
+
+    def test_schema(self):
+        relationships = dimension_relationships(SCHEMA.values())
+        self.assertIn(Artist.gender.property, relationships)
+        self.assertIn(Medium.format.property, relationships)
+        self.assertIn(Release.status.property, relationships)
+        self.assertNotIn(Artist.area.property, relationships)
+
+    def test_paths_past_the_lookup_table(self):
+        entity = mock.Mock(model=Artist, extrapaths=None,
+                           fields=[SearchField("type", "type.name"),
+                                   SearchField("gender", "gender.name")])
+        self.assertEqual(dimension_relationships([entity]),
+                         set([Artist.type.property,
+                              Artist.gender.property]))
+        entity.extrapaths = ["type.parent.name"]
+        self.assertEqual(dimension_relationships([entity]),
+                         set([Artist.gender.property]))
+
+    def test_invalidate_by_table_name(self):
+        cache = mock.Mock()
+        with mock.patch.object(dimensions, "_cache", cache):
+            dimensions.invalidate("artist")
+            cache.invalidate.assert_not_called()
+            dimensions.invalidate("artist_type")
+            cache.invalidate.assert_called_once_with()
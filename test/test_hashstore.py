@@ -0,0 +1,94 @@
+import os
+import pickle
+import tempfile
+from unittest import TestCase
+
+from sir.hashstore import (HashFilter, HashStore, document_hash,
+                           document_key)
+
+
+class DocumentHashTest(TestCase):
+    def test_stable(self):
+        self.assertEqual(document_hash({"mbid": "a", "tag": ["x", "y"],
+                                        "name": "foo"}),
+                         document_hash({"name": "foo", "tag": ["y", "x"],
+                                        "mbid": "a"}))
+
+    def test_changes(self):
+        self.assertNotEqual(document_hash({"mbid": "a", "name": "foo"}),
+                            document_hash({"mbid": "a", "name": "bar"}))
+
+    def test_key(self):
+        self.assertEqual(document_key({"mbid": "a", "id": 1}), "a")
+        self.assertEqual(document_key({"id": 1}), "1")
+
+
+class HashStoreTest(TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        self.store = HashStore(self.path)
+        self.store.start("artist")
+
+    def test_changed(self):
+        self.assertEqual(self.store.changed("artist", {"a": b"1", "b": b"2"}),
+                         {"a", "b"})
+        # Pending hashes aren't compared against
+        self.assertEqual(self.store.changed("artist", {"a": b"1"}), {"a"})
+        self.assertEqual(self.store.promote("artist"), 2)
+        self.assertEqual(self.store.changed("artist", {"a": b"1", "b": b"3",
+                                                       "c": b"4"}),
+                         {"b", "c"})
+        self.assertEqual(self.store.changed("label", {"a": b"1"}), {"a"})
+        self.assertEqual(self.store.stats("artist"), (6, 5))
+
+    def test_start_discards_pending(self):
+        self.store.changed("artist", {"a": b"1"})
+        self.store.start("artist")
+        self.assertEqual(self.store.promote("artist"), 0)
+        self.assertEqual(self.store.stats("artist"), (0, 0))
+        self.assertEqual(self.store.changed("artist", {"a": b"1"}), {"a"})
+
+    def test_many_documents(self):
+        hashes = dict((str(i), b"x") for i in range(1200))
+        self.store.changed("artist", hashes)
+        self.store.promote("artist")
+        hashes["1100"] = b"y"
+        self.assertEqual(self.store.changed("artist", hashes), {"1100"})
+
+    def test_pickle(self):
+        self.store.changed("artist", {"a": b"1"})
+        store = pickle.loads(pickle.dumps(self.store))
+        self.assertEqual(store.promote("artist"), 1)
+
+
+class HashFilterTest(TestCase):
+    def setUp(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        self.store = HashStore(path)
+        self.puts = []
+
+    def put(self, item):
+        self.puts.append(item)
+
+    def test_filter(self):
+        docs = [{"mbid": str(i), "name": "foo"} for i in range(3)]
+        documents = HashFilter(self, self.store, "artist", 2)
+        for doc in docs:
+            documents.put(doc)
+        self.assertEqual(self.puts, docs[:2])
+        documents.flush()
+        self.assertEqual(self.puts, docs)
+        self.store.promote("artist")
+
+        self.puts = []
+        docs[1] = {"mbid": "1", "name": "bar"}
+        documents = HashFilter(self, self.store, "artist", 10)
+        for doc in docs:
+            documents.put(doc)
+        documents.flush()
+        self.assertEqual(self.puts, [docs[1]])
+        self.assertEqual(documents.skipped, 2)
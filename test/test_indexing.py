@@ -1,13 +1,26 @@
+import io
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
 from unittest import mock, TestCase
 
-from multiprocessing import Queue
+from collections import namedtuple
+from multiprocessing import Queue, SimpleQueue, Value
 
 import pysolr
 import requests
 from pysolr import SolrError
 
 import sir.indexing
-from sir.indexing import queue_to_solr, send_data_to_solr, FAILED
+from sir import checkpoint, transport
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Query, Session, subqueryload
+from test import models
+from sir.indexing import (queue_to_solr, send_data_to_solr, encode_document,
+                          FAILED)
 
 
 class QueueToSolrTest(TestCase):
@@ -33,6 +46,269 @@ class QueueToSolrTest(TestCase):
         mock_add.assert_called_once_with([{"foo": "bar"}])
         mock_commit.assert_called()
 
+    @mock.patch.object(requests.Session, "get")
+    @mock.patch.object(pysolr.Solr, "commit")
+    @mock.patch.object(pysolr.Solr, "add")
+    def test_batched_send(self, mock_add, mock_commit, mock_get):
+        queue = Queue()
+        queue.put([{"foo": "bar"}, {"foo": "baz"}])
+        queue.put(None)
+        queue_to_solr(queue, 2, "test")
+        expected = [mock.call([{"foo": "bar"}, {"foo": "baz"}]), mock.call([])]
+        mock_add.assert_has_calls(expected)
+
+    @mock.patch.object(requests.Session, "get")
+    @mock.patch.object(pysolr.Solr, "add")
+    def test_connection_failure_drains_queue(self, mock_add, mock_get):
+        mock_get.side_effect = requests.ConnectionError
+        FAILED.value = False
+        queue_to_solr(self.queue, 1, "test")
+        mock_add.assert_not_called()
+        self.assertTrue(FAILED.value)
+        self.assertIsNone(self.queue.get(timeout=1))
+        FAILED.value = False
+
+    @mock.patch("sir.indexing.util.solr_connection")
+    def test_in_flight(self, mock_connection):
+        lock = threading.Lock()
+        running = []
+        concurrency = []
+
+        def add(data):
+            with lock:
+                running.append(data)
+                concurrency.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(data)
+
+        mock_connection.return_value.add.side_effect = add
+        queue = Queue()
+        for i in range(6):
+            queue.put([{"id": i}])
+        queue.put(None)
+        queue_to_solr(queue, 1, "test", in_flight=2)
+        mock_connection.assert_called_once_with("test", pool_size=2)
+        self.assertEqual(mock_connection.return_value.add.call_count, 7)
+        self.assertEqual(max(concurrency), 2)
+        mock_connection.return_value.commit.assert_called_once_with(
+            softCommit=False)
+
+    @mock.patch("sir.indexing.util.solr_commit")
+    @mock.patch("sir.indexing.util.solr_connection")
+    def test_commit_policies(self, mock_connection, mock_solr_commit):
+        connection = mock_connection.return_value
+        for policy, commit in (("hard", [mock.call(softCommit=False)]),
+                               ("soft", [mock.call(softCommit=True)]),
+                               ("within", []),
+                               ("none", [])):
+            connection.reset_mock()
+            queue = Queue()
+            queue.put({"foo": "bar"})
+            queue.put(None)
+            queue_to_solr(queue, 1, "test", commit_policy=policy)
+            self.assertEqual(connection.commit.call_args_list, commit)
+            if policy == "within":
+                connection.add.assert_any_call([{"foo": "bar"}],
+                                               commitWithin=10000)
+            else:
+                connection.add.assert_any_call([{"foo": "bar"}])
+        mock_solr_commit.assert_not_called()
+
+    @mock.patch("sir.indexing.time.sleep")
+    @mock.patch("sir.indexing.util.solr_connection")
+    def test_exit_status_after_failure(self, mock_connection, mock_sleep):
+        connection = mock_connection.return_value
+        connection.add.side_effect = SolrError("boom")
+        queue = Queue()
+        queue.put({"foo": "bar"})
+        queue.put(None)
+        with self.assertRaises(SystemExit) as cm:
+            queue_to_solr(queue, 1, "test")
+        self.assertEqual(cm.exception.code, 1)
+        FAILED.value = False
+
+    @mock.patch("sir.indexing.util.solr_commit")
+    @mock.patch("sir.indexing.util.solr_connection")
+    def test_exit_status_after_exception(self, mock_connection,
+                                         mock_solr_commit):
+        checkpoints = mock.Mock()
+        checkpoints.add_sent.side_effect = ValueError("boom")
+        checkpoints.sent_bounds.return_value = []
+        queue = Queue()
+        queue.put(transport.Batch([{"foo": "bar"}], (1, 3)))
+        queue.put(transport.Batch([{"foo": "baz"}], (3, 5)))
+        queue.put(None)
+        with self.assertRaises(SystemExit) as cm:
+            queue_to_solr(queue, 1, "test", checkpoints)
+        self.assertEqual(cm.exception.code, 1)
+        self.assertEqual(checkpoints.add_sent.call_count, 2)
+        FAILED.value = False
+
+    @mock.patch("sir.indexing.util.solr_connection")
+    def test_failure_unblocks_producers(self, mock_connection):
+        checkpoints = mock.Mock()
+        checkpoints.set_expected.side_effect = ValueError("boom")
+        queue = transport.BoundedChannel(SimpleQueue(), 1, 0,
+                                         multiprocessing.Condition(),
+                                         [0, 0])
+
+        def produce():
+            queue.put(transport.Batch([{"foo": "bar"}], (1, 3)))
+            queue.put(transport.TagDone((1, 3), 1))
+            for i in range(3):
+                queue.put(transport.Batch([{"id": i}], (3, 5)))
+            queue.put(None)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        with self.assertRaises(ValueError):
+            queue_to_solr(queue, 10, "test", checkpoints)
+        producer.join(5)
+        self.assertFalse(producer.is_alive())
+        self.assertIsNone(queue.get())
+
+    @mock.patch("sir.indexing.util.solr_commit")
+    @mock.patch.object(requests.Session, "get")
+    @mock.patch.object(pysolr.Solr, "commit")
+    @mock.patch.object(pysolr.Solr, "add")
+    def test_checkpoints(self, mock_add, mock_commit, mock_get,
+                         mock_solr_commit):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        checkpoints = checkpoint.CheckpointStore(path, "test")
+        queue = Queue()
+        queue.put(transport.Batch([{"foo": "bar"}], (1, 3)))
+        queue.put(transport.TagDone((1, 3), 1))
+        queue.put(transport.Batch([{"foo": "baz"}], (3, 5)))
+        queue.put(transport.TagDone((3, 5), 2))
+        queue.put(transport.Batch([{"foo": "qux"}], (5, 7)))
+        queue.put(transport.TagSkipped((5, 7), 1))
+        queue.put(transport.TagDone((5, 7), 2))
+        queue.put(transport.TagDone((7, None), 0))
+        queue.put(None)
+        queue_to_solr(queue, 1, "test", checkpoints, commit_policy="none")
+        mock_commit.assert_not_called()
+        mock_solr_commit.assert_called_once_with(mock.ANY,
+                                                 open_searcher=False)
+        self.assertEqual(checkpoints.committed_ranges("test"),
+                         [(1, 3), (5, None)])
+
+
+Row = namedtuple("Row", ["id"])
+
+
+class ConvertRowsTest(TestCase):
+    def setUp(self):
+        # Unlike Queue, SimpleQueue writes items right away, so empty() is
+        # reliable once convert_rows has returned
+        self.data_queue = SimpleQueue()
+        self.running = Value("i", 2)
+        self.entity = mock.Mock()
+        self.entity.query_result_to_dict.side_effect = self.convert
+        patcher = mock.patch.dict("sir.indexing.SCHEMA",
+                                  {"test": self.entity})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def convert(self, row):
+        if row.id == 2:
+            raise ValueError("control character")
+        if row.id == 4:
+            raise KeyError("broken")
+        return {"id": row.id}
+
+    def run_converter(self, items, hashes=None):
+        queue = Queue()
+        for item in items:
+            queue.put(item)
+        with mock.patch("sir.indexing.config.CFG") as mock_cfg:
+            mock_cfg.getboolean.return_value = False
+            sir.indexing.convert_rows(queue, self.data_queue, "test", 2,
+                                      self.running, hashes)
+        self.assertIsNone(queue.get(timeout=1))
+
+    def get_all(self):
+        items = []
+        while not self.data_queue.empty():
+            items.append(self.data_queue.get())
+        return items
+
+    def rows(self, *ids):
+        return [Row(i) for i in ids]
+
+    def test_convert(self):
+        self.run_converter([transport.Batch(self.rows(1, 2, 3), (1, 5)),
+                            transport.TagDone((1, 5), 3),
+                            None])
+        items = self.get_all()
+        self.assertEqual(items, [[{"id": 1}, {"id": 3}],
+                                 transport.TagSkipped((1, 5), 1),
+                                 transport.TagDone((1, 5), 3)])
+        self.assertEqual(items[0].tag, (1, 5))
+        self.assertEqual(self.running.value, 1)
+
+    def test_last_converter_stops_sender(self):
+        self.running.value = 1
+        self.run_converter([self.rows(1), None])
+        self.assertEqual(self.get_all(), [[{"id": 1}], None])
+
+    def test_failure(self):
+        self.running.value = 1
+        with self.assertRaises(SystemExit) as cm:
+            self.run_converter([self.rows(1, 4), self.rows(3), None])
+        self.assertEqual(cm.exception.code, 1)
+        self.assertEqual(self.get_all(), [[{"id": 1}], None])
+
+    def test_unchanged(self):
+        hashes = mock.Mock()
+        hashes.changed.side_effect = lambda core, h: set(h) - {"3"}
+        self.run_converter([transport.Batch(self.rows(1, 3), (1, 5)), None],
+                           hashes)
+        self.assertEqual(self.get_all(), [[{"id": 1}],
+                                          transport.TagSkipped((1, 5), 1)])
+
+
+class CoreOptionTest(TestCase):
+    @mock.patch("sir.indexing.config.CFG")
+    def test_fallbacks(self, mock_cfg):
+        mock_cfg.getint.side_effect = lambda section, option, fallback: {
+            ("core:a", "solr_threads"): 4}.get((section, option), fallback)
+        self.assertEqual(sir.indexing._core_option("a", "solr_threads", 1), 4)
+        self.assertEqual(sir.indexing._core_option("b", "solr_threads", 1), 1)
+
+
+class ReadIdsFileTest(TestCase):
+    def read(self, content, entity_names):
+        with tempfile.NamedTemporaryFile("w", delete=False) as f:
+            f.write(content)
+        self.addCleanup(os.unlink, f.name)
+        return sir.indexing.read_ids_file(f.name, entity_names)
+
+    def test_single_entity_type(self):
+        self.assertEqual(self.read("3\n# comment\n\n1\n3\n", ["artist"]),
+                         {"artist": [1, 3]})
+
+    def test_entity_types(self):
+        self.assertEqual(self.read("artist 2\nlabel,1\nrelease 5\n",
+                                   ["artist", "label"]),
+                         {"artist": [2], "label": [1]})
+
+    def test_missing_entity_type(self):
+        self.assertRaises(ValueError, self.read, "1\n", ["artist", "label"])
+
+    def test_invalid_id(self):
+        self.assertRaises(ValueError, self.read, "artist x\n", ["artist"])
+
+    def test_stdin(self):
+        stdin = io.StringIO("artist 2\n")
+        with mock.patch("sir.indexing.sys.stdin", stdin):
+            self.assertEqual(sir.indexing.read_ids_file("-", ["artist"]),
+                             {"artist": [2]})
+        self.assertFalse(stdin.closed)
+
+
 class SendDataToSolrTest(TestCase):
     def setUp(self):
         self.solr_connection = mock.MagicMock()
@@ -44,11 +320,31 @@ class SendDataToSolrTest(TestCase):
         calls = self.solr_connection.add.call_args_list
         self.assertEqual(calls, expected)
 
+    @mock.patch("sir.indexing.util.post_documents")
+    def test_encoded_send(self, mock_post):
+        data = [encode_document({"foo": "bar"})]
+        send_data_to_solr(self.solr_connection, data)
+        mock_post.assert_called_once_with(self.solr_connection, data)
+        self.solr_connection.add.assert_not_called()
+
     def test_fail_send(self):
         self.solr_connection.add.side_effect = SolrError('Test Error')
         self.assertFalse(FAILED.value)
         send_data_to_solr(self.solr_connection, [{"foo": "bar"}])
         self.assertTrue(FAILED.value)
+        FAILED.value = False
+
+    @mock.patch("sir.indexing.time.sleep")
+    def test_retry(self, mock_sleep):
+        self.solr_connection.add.side_effect = [SolrError('Test Error'),
+                                                SolrError('Test Error'),
+                                                None]
+        self.assertTrue(send_data_to_solr(self.solr_connection,
+                                          [{"foo": "bar"}], retries=2,
+                                          backoff=0.5))
+        self.assertEqual(mock_sleep.call_args_list,
+                         [mock.call(0.5), mock.call(1.0)])
+        self.assertFalse(FAILED.value)
 
 class LiveIndexFailTest(TestCase):
     def setUp(self):
@@ -63,3 +359,262 @@ class LiveIndexFailTest(TestCase):
         with self.assertRaises(Exception):
             sir.indexing.live_index(mock.MagicMock())
         self.assertTrue(FAILED.value)
+
+
+class ReindexShardTest(TestCase):
+    def setUp(self):
+        cfg = mock.patch("sir.indexing.config.CFG")
+        self.cfg = cfg.start()
+        self.addCleanup(cfg.stop)
+        self.cfg.get.side_effect = (
+            lambda section, option, fallback=None: fallback)
+        self.cfg.getint.side_effect = (
+            lambda section, option, fallback=None: fallback)
+        self.cfg.getboolean.side_effect = (
+            lambda section, option, fallback=None: option == "shard_leases")
+        for target in ("util.check_solr_cores_version", "util.db_session",
+                       "_multiprocessed_import"):
+            patcher = mock.patch("sir.indexing." + target)
+            setattr(self, target.split(".")[-1], patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def test_leases_require_run_id(self):
+        sir.indexing.reindex({"entity_type": ["artist"], "shard": (0, 2)})
+        self._multiprocessed_import.assert_not_called()
+
+    @mock.patch("sir.indexing.sharding.LeasedShard")
+    def test_leases(self, mock_shard):
+        sir.indexing.reindex({"entity_type": ["artist"], "shard": (0, 2),
+                              "run_id": "2026-10"})
+        mock_shard.assert_called_once_with(0, 2, 100000, mock.ANY,
+                                           "2026-10", 300)
+        self._multiprocessed_import.assert_called_once_with(
+            ["artist"], checkpoints=None, resume=False, hashes=None,
+            shard=mock_shard.return_value)
+
+
+class SwapShadowCoresTest(TestCase):
+    def setUp(self):
+        FAILED.value = False
+        restore = mock.patch("sir.indexing.util.restore_shadow_core")
+        self.restore = restore.start()
+        self.addCleanup(restore.stop)
+
+    @mock.patch("sir.indexing.util.solr_core_admin")
+    @mock.patch("sir.indexing.util.solr_version_check")
+    def test_swap(self, mock_check, mock_admin):
+        sir.indexing._swap_shadow_cores({"artist": "artist_shadow",
+                                         "label": "label_shadow"},
+                                        {"label"})
+        mock_check.assert_called_once_with("artist", "artist_shadow")
+        mock_admin.assert_called_once_with("SWAP", core="artist",
+                                           other="artist_shadow")
+        self.restore.assert_called_once_with("artist_shadow")
+
+    @mock.patch("sir.indexing.util.solr_core_admin")
+    @mock.patch("sir.indexing.util.solr_version_check")
+    def test_restore_failure(self, mock_check, mock_admin):
+        self.restore.side_effect = requests.HTTPError("boom")
+        sir.indexing._swap_shadow_cores({"artist": "artist_shadow"}, set())
+        mock_admin.assert_not_called()
+
+    @mock.patch("sir.indexing.util.solr_core_admin")
+    @mock.patch("sir.indexing.util.solr_version_check")
+    def test_version_mismatch(self, mock_check, mock_admin):
+        mock_check.side_effect = sir.indexing.util.VersionMismatchException(
+            "artist", 1.1, 1.0)
+        sir.indexing._swap_shadow_cores({"artist": "artist_shadow"}, set())
+        mock_admin.assert_not_called()
+
+    @mock.patch("sir.indexing.util.solr_core_admin")
+    def test_send_failure(self, mock_admin):
+        FAILED.value = True
+        sir.indexing._swap_shadow_cores({"artist": "artist_shadow"}, set())
+        mock_admin.assert_not_called()
+        FAILED.value = False
+
+
+class EncodeDocumentTest(TestCase):
+    def test_encode(self):
+        doc = {"mbid": "a/b", "name": "Sigur R\u00f3s", "tracks": [1, 2]}
+        self.assertEqual(json.loads(encode_document(doc)), doc)
+
+
+class FetchChunksTest(TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite:///:memory:")
+        models.Base.metadata.create_all(engine)
+        self.session = Session(engine)
+        self.session.add_all([models.C(id=i, bs=[models.B(id=i)])
+                              for i in range(1, 11)])
+        self.session.commit()
+        self.session.expunge_all()
+        self.query = (self.session.query(models.C).
+                      filter(models.C.id > 1).
+                      options(subqueryload(models.C.bs)))
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_chunks(self):
+        chunks = []
+        for rows in sir.indexing._fetch_chunks(self.session, self.query,
+                                               models.C, 4):
+            self.assertTrue(all("bs" in row.__dict__ for row in rows))
+            chunks.append([row.id for row in rows])
+            self.assertEqual(len(self.session.identity_map), 2 * len(rows))
+        self.assertEqual(chunks, [[2, 3, 4, 5], [6, 7, 8, 9], [10]])
+
+    def test_no_chunks(self):
+        chunks = list(sir.indexing._fetch_chunks(self.session, self.query,
+                                                 models.C))
+        self.assertEqual([[row.id for row in rows] for rows in chunks],
+                         [list(range(2, 11))])
+
+
+class QueryDatabaseCountsTest(TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite:///:memory:")
+        models.Base.metadata.create_all(self.engine)
+        with Session(self.engine) as session:
+            session.add_all([models.F(id=i) for i in range(1, 5)])
+            session.add_all([models.E(id=1, f_id=1), models.E(id=2, f_id=1),
+                             models.E(id=3, f_id=3)])
+            session.commit()
+        self.statements = []
+        event.listen(self.engine, "before_cursor_execute",
+                     lambda *args: self.statements.append(args[2]))
+        entity = mock.Mock(model=models.F, query=Query(models.F))
+        patchers = [mock.patch.dict(sir.indexing.SCHEMA, {"f": entity}),
+                    mock.patch.object(sir.indexing, "_convert", False),
+                    mock.patch.object(sir.indexing.config, "CFG")]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        sir.indexing.config.CFG.getint.return_value = 0
+        sir.indexing.config.CFG.getboolean.return_value = True
+
+    def index(self, bounds):
+        rows = []
+        queue = mock.Mock(**{"put.side_effect": rows.append})
+        sir.indexing.index_entity(Session(self.engine), "f", bounds, queue)
+        return dict((row.id, row.e_count) for row in rows)
+
+    def test_counted_per_bound(self):
+        self.assertEqual(self.index((1, 4)), {1: 2, 2: 0, 3: 1})
+        self.assertEqual(len(self.statements), 2)
+        self.assertIn("GROUP BY", self.statements[0])
+        self.assertNotIn("count", self.statements[1])
+
+    def test_correlated_subquery_without_bounds(self):
+        rows = []
+        queue = mock.Mock(**{"put.side_effect": rows.append})
+        sir.indexing.live_index_entity(Session(self.engine), "f", [1, 4],
+                                       queue)
+        self.assertEqual(dict((row.id, row.e_count) for row in rows),
+                         {1: 2, 4: 0})
+        self.assertEqual(len(self.statements), 1)
+
+    def test_disabled(self):
+        sir.indexing.config.CFG.getboolean.return_value = False
+        self.assertEqual(self.index((3, None)), {3: 1, 4: 0})
+        self.assertEqual(len(self.statements), 1)
+
+
+class BatchSizerTest(TestCase):
+    def setUp(self):
+        self.sizer = sir.indexing._BatchSizer(1000, 100, 5000, 10,
+                                              max_rss=1024)
+
+    def result(self, rows, seconds, rss=0):
+        return sir.indexing._TaskResult("a", rows, seconds, rss)
+
+    def test_initial_size(self):
+        self.assertEqual(self.sizer.size("a"), 1000)
+        sizer = sir.indexing._BatchSizer(20000, 100, 5000, 10)
+        self.assertEqual(sizer.size("a"), 5000)
+
+    def test_target_rate(self):
+        self.sizer.update(self.result(1000, 8))
+        self.assertEqual(self.sizer.size("a"), 1250)
+        self.assertEqual(self.sizer.size("b"), 1000)
+
+    def test_limited_change(self):
+        self.sizer.update(self.result(1000, 1))
+        self.assertEqual(self.sizer.size("a"), 2000)
+        self.sizer.update(self.result(2000, 1000))
+        self.assertEqual(self.sizer.size("a"), 1000)
+
+    def test_bounds(self):
+        for _ in range(5):
+            self.sizer.update(self.result(1000, 0.1))
+        self.assertEqual(self.sizer.size("a"), 5000)
+        for _ in range(10):
+            self.sizer.update(self.result(1000, 1000))
+        self.assertEqual(self.sizer.size("a"), 100)
+
+    def test_memory(self):
+        self.sizer.update(self.result(1000, 1, rss=2048))
+        self.assertEqual(self.sizer.size("a"), 500)
+
+    def test_no_rows(self):
+        self.sizer.update(self.result(0, 1))
+        self.assertEqual(self.sizer.size("a"), 1000)
+
+
+class RepeaterTest(TestCase):
+    def test_repeat(self):
+        calls = []
+
+        def function():
+            calls.append(time.time())
+            if len(calls) == 1:
+                raise ValueError("boom")
+
+        repeater = sir.indexing._Repeater(0.01, function)
+        repeater.start()
+        deadline = time.time() + 5
+        while len(calls) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        repeater.stop()
+        count = len(calls)
+        self.assertGreaterEqual(count, 3)
+        time.sleep(0.05)
+        self.assertEqual(len(calls), count)
+
+
+class SchedulerTest(TestCase):
+    def setUp(self):
+        self.done = []
+
+    def on_done(self, e, failed):
+        self.done.append((e, failed))
+
+    def test_interleaving(self):
+        tasks = {"big": iter(range(4)), "small": iter(range(2))}
+        scheduler = sir.indexing._Scheduler(tasks, {"big": 4, "small": 2},
+                                            self.on_done)
+        order = []
+        for task in scheduler:
+            order.append(task)
+        self.assertEqual(order, [0, 0, 1, 2, 1, 3])
+
+    def test_done(self):
+        tasks = {"a": iter(["a1", "a2"]), "b": iter([])}
+        scheduler = sir.indexing._Scheduler(tasks, {"a": 1, "b": 1},
+                                            self.on_done)
+        self.assertEqual(list(scheduler), ["a1", "a2"])
+        self.assertEqual(self.done, [("b", False)])
+        scheduler.task_done("a")
+        self.assertEqual(self.done, [("b", False)])
+        scheduler.task_done("a")
+        self.assertEqual(self.done, [("b", False), ("a", False)])
+
+    def test_failure_stops_scheduling(self):
+        tasks = {"a": iter(["a1", "a2", "a3"])}
+        scheduler = sir.indexing._Scheduler(tasks, {"a": 1}, self.on_done)
+        it = iter(scheduler)
+        self.assertEqual(next(it), "a1")
+        scheduler.task_failed("a")
+        self.assertEqual(list(it), [])
+        self.assertEqual(self.done, [("a", True)])
@@ -0,0 +1,53 @@
+from unittest import mock, TestCase
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from sir.memo import batch_memo, get_memo, memo_key, memoize
+from test import models
+
+
+class MemoizeTest(TestCase):
+    def setUp(self):
+        self.function = mock.Mock(side_effect=lambda obj, flag=True:
+                                  object())
+        self.memoized = memoize(self.function)
+
+    def test_no_memo_outside_of_batch(self):
+        self.assertIsNot(self.memoized(1), self.memoized(1))
+        self.assertIsNone(get_memo())
+
+    def test_reused_within_batch(self):
+        with batch_memo():
+            first = self.memoized(1)
+            self.assertIs(self.memoized(1), first)
+            self.assertIsNot(self.memoized(1, flag=False), first)
+            self.assertIsNot(self.memoized(2), first)
+        self.assertEqual(self.function.call_count, 3)
+        self.assertIsNone(get_memo())
+
+    def test_nested_batches_share_memo(self):
+        with batch_memo():
+            first = self.memoized(1)
+            with batch_memo():
+                self.assertIs(self.memoized(1), first)
+            self.assertIs(self.memoized(1), first)
+
+
+class MemoKeyTest(TestCase):
+    def test_persistent_objects(self):
+        engine = create_engine("sqlite:///:memory:")
+        models.Base.metadata.create_all(engine)
+        with Session(engine) as session:
+            session.add(models.C(id=1))
+            session.commit()
+            first = session.get(models.C, 1)
+            session.expunge_all()
+            second = session.get(models.C, 1)
+        self.assertIsNot(first, second)
+        self.assertEqual(memo_key(first), memo_key(second))
+        self.assertEqual(memo_key([first]), memo_key([second]))
+
+    def test_transient_objects(self):
+        obj = models.C(id=1)
+        self.assertIs(memo_key(obj), obj)
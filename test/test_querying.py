@@ -1,11 +1,17 @@
 import doctest
+from datetime import datetime
 from unittest import mock, TestCase
 
 from test import models
 from collections import defaultdict
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
 from sqlalchemy.orm.properties import RelationshipProperty
-from sir.querying import iterate_path_values
-from sir.schema.searchentities import defer_everything_but, merge_paths
+from sir.querying import (changed_ids, count_by_foreign_key,
+                          count_properties, iterate_path_values, iter_bounds,
+                          stream_bounds)
+from sir.schema.searchentities import (defer_everything_but, merge_paths,
+                                       SearchEntity, SearchField)
 from sir.schema import generate_update_map, SCHEMA
 from sir.trigger_generation.paths import second_last_model_in_path
 
@@ -60,6 +66,135 @@ class IteratePathValuesTest(TestCase):
         self.assertEqual(res, [models.C.__tablename__])
 
 
+class BoundsTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = create_engine("sqlite:///:memory:")
+        models.Base.metadata.create_all(cls.engine)
+        cls.session = Session(cls.engine)
+        # Leave some gaps in the ids
+        cls.session.add_all([models.C(id=i) for i in range(1, 60, 3)])
+        cls.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.close()
+
+    def test_iter_bounds(self):
+        bounds = iter_bounds(self.session, models.C, 5, 0)
+        self.assertEqual(bounds, [(1, 16), (16, 31), (31, 46), (46, None)])
+
+    def test_iter_bounds_importlimit(self):
+        bounds = iter_bounds(self.session, models.C, 5, 12)
+        self.assertEqual(bounds, [(1, 16), (16, 31), (31, 31)])
+
+    def test_stream_bounds_matches_iter_bounds(self):
+        for batch_size in (1, 2, 5, 19, 20, 21, 100):
+            for importlimit in (0, 1, 5, 12, 20, 50):
+                self.assertEqual(
+                    list(stream_bounds(self.session, models.C, batch_size,
+                                       importlimit)),
+                    iter_bounds(self.session, models.C, batch_size,
+                                importlimit),
+                    (batch_size, importlimit))
+
+    def test_stream_bounds_variable_size(self):
+        sizes = [5, 2]
+        bounds = stream_bounds(self.session, models.C,
+                               lambda: sizes.pop(0) if sizes else 10, 0)
+        self.assertEqual(list(bounds),
+                         [(1, 16), (16, 22), (22, 52), (52, None)])
+
+    def test_stream_bounds_empty_table(self):
+        self.assertEqual(list(stream_bounds(self.session, models.B, 5, 0)),
+                         [])
+
+    def test_stream_bounds_range(self):
+        bounds = stream_bounds(self.session, models.C, 5, 0, 10, 40)
+        self.assertEqual(list(bounds), [(10, 25), (25, 40)])
+
+    def test_stream_bounds_open_ranges(self):
+        self.assertEqual(list(stream_bounds(self.session, models.C, 5, 0,
+                                            upper=20)),
+                         [(1, 16), (16, 20)])
+        self.assertEqual(list(stream_bounds(self.session, models.C, 5, 0,
+                                            lower=44)),
+                         [(46, None)])
+
+    def test_stream_bounds_empty_range(self):
+        self.assertEqual(list(stream_bounds(self.session, models.C, 5, 0,
+                                            2, 4)),
+                         [])
+
+
+class ChangedIdsTest(TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite:///:memory:")
+        models.Base.metadata.create_all(engine)
+        self.session = Session(engine)
+        old, new = datetime(2020, 1, 1), datetime(2026, 1, 1)
+        self.session.add_all([
+            models.C(id=1, last_updated=new, bs=[models.B(id=1,
+                                                          last_updated=old)]),
+            models.C(id=2, last_updated=old, bs=[models.B(id=2,
+                                                          last_updated=new)]),
+            models.C(id=3, last_updated=old, bs=[models.B(id=3,
+                                                          last_updated=old)]),
+            models.C(id=4, last_updated=new),
+        ])
+        self.session.commit()
+        self.addCleanup(self.session.close)
+
+    def test_changed_ids(self):
+        entity = SearchEntity(models.C, [SearchField("bar", "bar"),
+                                         SearchField("foo", "bs.foo")], 1.0)
+        self.assertEqual(changed_ids(self.session, entity,
+                                     datetime(2025, 1, 1)), [1, 2, 4])
+
+    def test_own_rows(self):
+        entity = SearchEntity(models.C, [SearchField("bar", "bar")], 1.0)
+        self.assertEqual(changed_ids(self.session, entity,
+                                     datetime(2025, 1, 1)), [1, 4])
+
+
+class CountTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = create_engine("sqlite:///:memory:")
+        models.Base.metadata.create_all(cls.engine)
+        cls.session = Session(cls.engine)
+        cls.session.add_all([models.F(id=i) for i in range(1, 5)])
+        cls.session.add_all([models.E(id=1, f_id=1), models.E(id=2, f_id=1),
+                             models.E(id=3, f_id=3), models.E(id=4, f_id=4),
+                             models.E(id=5)])
+        cls.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.close()
+
+    def test_count_properties(self):
+        self.assertEqual([prop.key for prop in count_properties(models.F)],
+                         ["e_count"])
+        self.assertEqual(count_properties(models.E), [])
+        self.assertEqual(
+            [prop.key for prop in count_properties(SCHEMA["area"].model)],
+            ["place_count", "label_count", "artist_count"])
+
+    def test_count_by_foreign_key(self):
+        self.assertEqual(count_by_foreign_key(self.session, models.E.f_id,
+                                              1, 4),
+                         {1: 2, 3: 1})
+        self.assertEqual(count_by_foreign_key(self.session, models.E.f_id,
+                                              3),
+                         {3: 1, 4: 1})
+
+    def test_same_as_correlated_subquery(self):
+        counts = count_by_foreign_key(self.session, models.E.f_id, 0)
+        for f in self.session.query(models.F):
+            self.assertEqual(f.e_count, counts.get(f.id, 0))
+
+
 class MergePathsTest(TestCase):
     def test_dotless_path(self):
         paths = [["id"], ["name"]]
@@ -1,11 +1,17 @@
 from unittest import mock, TestCase
+from uuid import uuid4
 
 from test import models
 from xml.etree.ElementTree import Element, tostring
+from sir.memo import batch_memo, get_memo
+from sir.querying import iterate_path_values
 from sir.schema.searchentities import (SearchEntity as E, SearchField as F,
-                                       is_composite_column)
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+                                       compile_fields, compile_paths,
+                                       is_composite_column,
+                                       selectin_chunk_size)
+from sir.config import ConfigError
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, strategies
 
 
 class QueryResultToDictTest(TestCase):
@@ -53,6 +59,65 @@ class QueryResultToDictTest(TestCase):
         self.assertEqual(convmock.to_etree.call_count, 1)
 
 
+class CompileFieldsTest(TestCase):
+    def test_fields(self):
+        gid, other_gid = uuid4(), uuid4()
+        b = models.B(id=0, c=models.C(id=2, bar=gid))
+        build = compile_fields(models.B, [
+            F("id", "id"),
+            F("gid", "c.bar"),
+            F("gids", "c.bar", transformfunc=lambda v: v | set([other_gid])),
+            F("count", "c.id", transformfunc=len)])
+        data = build(b)
+        self.assertEqual(sorted(data.keys()), ["count", "gid", "gids"])
+        self.assertEqual(data["gid"], str(gid))
+        self.assertCountEqual(data["gids"], [str(gid), str(other_gid)])
+        self.assertEqual(data["count"], 1)
+
+
+class CompilePathsTest(TestCase):
+    def setUp(self):
+        self.c = models.C(id=1, bar=2)
+        self.c.bs = [models.B(id=3, foo=[4, 5]), models.B(id=6)]
+
+    def collect(self, model, paths, obj):
+        values = [set() for _ in range(max(i for _, i in paths) + 1)]
+        compile_paths(model, paths)(obj, values)
+        return values
+
+    def test_shared_prefix(self):
+        paths = [("id", 0), ("bs.id", 1), ("bs.foo", 2), ("bs.id", 2),
+                 ("__tablename__", 3)]
+        self.assertEqual(self.collect(models.C, paths, self.c),
+                         [{1}, {3, 6}, {3, 4, 5, 6}, {"table_c"}])
+
+    def test_matches_iterate_path_values(self):
+        b = models.B(id=7, c=self.c)
+        for path in ("c.bar", "c.bs.id", "c.id", "composite_column.foo"):
+            self.assertEqual(self.collect(models.B, [(path, 0)], b),
+                             [set(value for value
+                                  in iterate_path_values(path, b)
+                                  if value is not None)], path)
+
+    def test_batch_memo(self):
+        other = models.B(id=9, c=self.c)
+        entity = E(models.B, [F("id", "id"), F("siblings", "c.bs.id")], 1.0)
+        with mock.patch("sir.config.CFG") as cfg:
+            cfg.getboolean.return_value = False
+            expected = [entity.query_result_to_dict(b)
+                        for b in self.c.bs + [other]]
+            with batch_memo():
+                self.assertEqual([entity.query_result_to_dict(b)
+                                  for b in self.c.bs + [other]], expected)
+                # The values below the shared C are only collected once
+                self.assertEqual(len(get_memo()), 1)
+
+    def test_missing_many_to_one(self):
+        self.assertEqual(self.collect(models.B, [("c.bar", 0)],
+                                      models.B(id=8)),
+                         [set()])
+
+
 class TestIsCompositeColumn(TestCase):
     def test_composite_column(self):
         self.assertTrue(is_composite_column(models.B, "composite_column"))
@@ -94,6 +159,8 @@ class SearchEntityTest(TestCase):
     @mock.patch("sir.config.CFG")
     def test_extraquery(self, mock):
         mock.getboolean.return_value = False
+        mock.get.side_effect = mock.getint.side_effect = \
+            lambda section, option, fallback=None: fallback
         searchentity_b = E(models.B,
                            [F("id", "id")],
                            1.0,
@@ -107,3 +174,68 @@ class SearchEntityTest(TestCase):
         # Retrieve them and make sure we only get 20
         query = searchentity_b.query.with_session(session)
         self.assertEqual(len(query.all()), self.FILTER_MAX)
+
+
+class LoaderStrategiesTest(TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite:///:memory:")
+        models.Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.session.add_all([models.C(id=1, bs=[models.B(id=1, foo=2),
+                                                 models.B(id=2, foo=3)]),
+                              models.C(id=2)])
+        self.session.commit()
+        self.session.expunge_all()
+        self.options = {}
+        config_patcher = mock.patch("sir.config.CFG")
+        self.addCleanup(config_patcher.stop)
+        cfg = config_patcher.start()
+        cfg.getboolean.return_value = False
+        cfg.get.side_effect = cfg.getint.side_effect = \
+            lambda section, option, fallback=None: self.options.get(
+                (section, option), fallback)
+        self.entity = E(models.C, [F("foo", "bs.foo")], 1.0)
+        self.entity.name = "c"
+
+    def run_query(self):
+        statements = []
+        event.listen(self.engine, "before_cursor_execute",
+                     lambda conn, cursor, statement, *args:
+                     statements.append(statement))
+        rows = self.entity.query.with_session(self.session).all()
+        values = [self.entity.query_result_to_dict(row) for row in rows]
+        return values, statements
+
+    def test_default(self):
+        self.assertEqual(self.entity.loader_strategies(), ("subquery", {}))
+        values, statements = self.run_query()
+        self.assertEqual(values, [{"foo": [2, 3]}, {}])
+        self.assertEqual(len(statements), 2)
+        self.assertIn("anon", statements[1])
+
+    def test_selectin(self):
+        self.options[("sir", "eager_loading")] = "joined"
+        self.options[("core:c", "eager_loading_paths")] = "bs:selectin"
+        self.assertEqual(self.entity.loader_strategies(),
+                         ("joined", {"bs": "selectin"}))
+        values, statements = self.run_query()
+        self.assertEqual(values, [{"foo": [2, 3]}, {}])
+        self.assertEqual(len(statements), 2)
+        self.assertIn(" IN (", statements[1])
+
+    def test_selectin_chunk_size(self):
+        self.options[("sir", "eager_loading")] = "selectin"
+        self.options[("sir", "selectin_chunk_size")] = 1
+        default = strategies.SelectInLoader._chunksize
+        with selectin_chunk_size():
+            values, statements = self.run_query()
+        self.assertEqual(values, [{"foo": [2, 3]}, {}])
+        self.assertEqual(len(statements), 3)
+        self.assertEqual(strategies.SelectInLoader._chunksize, default)
+        # Building the query doesn't change the chunk size of other queries
+        values, statements = self.run_query()
+        self.assertEqual(len(statements), 2)
+
+    def test_unknown_strategy(self):
+        self.options[("core:c", "eager_loading")] = "lazy"
+        self.assertRaises(ConfigError, self.entity.loader_strategies)
@@ -0,0 +1,84 @@
+from unittest import mock, TestCase
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from sir.sharding import LeasedShard, Shard, block_range
+from test import models
+
+
+class ShardTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = create_engine("sqlite:///:memory:")
+        models.Base.metadata.create_all(cls.engine)
+        cls.session = Session(cls.engine)
+        cls.session.add_all([models.C(id=i) for i in range(1, 60, 3)])
+        cls.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.close()
+
+    def test_block_range(self):
+        self.assertEqual(block_range(0, 5, 10), (0, 10))
+        self.assertEqual(block_range(5, 5, 10), (50, None))
+
+    def test_ranges_are_disjoint(self):
+        self.assertEqual(list(Shard(0, 2, 10).ranges(self.session, "c",
+                                                     models.C)),
+                         [(0, 10), (20, 30), (40, 50)])
+        self.assertEqual(list(Shard(1, 2, 10).ranges(self.session, "c",
+                                                     models.C)),
+                         [(10, 20), (30, 40), (50, None)])
+
+    def test_empty_table(self):
+        self.assertEqual(list(Shard(0, 2, 10).ranges(self.session, "b",
+                                                     models.B)),
+                         [])
+
+    def test_contains(self):
+        shard = Shard(1, 3, 10)
+        self.assertEqual([i for i in range(0, 70, 5) if shard.contains(i)],
+                         [10, 15, 40, 45])
+
+    def test_invalid_index(self):
+        self.assertRaises(ValueError, Shard, 2, 2, 10)
+
+
+class LeasedShardTest(TestCase):
+    def results(self, *values):
+        return [mock.Mock(**{"scalar.return_value": value})
+                for value in values]
+
+    def shard(self, *values):
+        db_session = mock.Mock()
+        self.lease_session = db_session.return_value
+        self.lease_session.execute.side_effect = self.results(*values)
+        return LeasedShard(1, 2, 10, db_session, "run", 60)
+
+    def read_only_session(self, max_id):
+        # Like a session in an exported snapshot, see sir.util.use_snapshot
+        def execute(statement, *args):
+            if not str(statement).lstrip().upper().startswith("SELECT"):
+                raise Exception("cannot execute %s in a read-only "
+                                "transaction" % statement)
+            return mock.Mock(**{"scalar.return_value": max_id})
+        return mock.Mock(**{"execute.side_effect": execute})
+
+    def test_claims_blocks_outside_of_snapshot_session(self):
+        # The insert, the last block and three claims
+        shard = self.shard(None, 6, 1, 3, None)
+        self.assertEqual(list(shard.ranges(self.read_only_session(58), "c",
+                                           models.C)),
+                         [(10, 20), (30, 40)])
+        params = self.lease_session.execute.call_args[0][1]
+        self.assertEqual((params["run_id"], params["core"], params["index"],
+                          params["count"]), ("run", "c", 1, 2))
+        self.assertEqual(self.lease_session.commit.call_count, 4)
+
+    def test_last_block_of_other_hosts(self):
+        shard = self.shard(None, 6, 5, 6, None)
+        self.assertEqual(list(shard.ranges(self.read_only_session(58), "c",
+                                           models.C)),
+                         [(50, 60), (60, None)])
@@ -0,0 +1,140 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from multiprocessing import Queue
+from unittest import mock, TestCase
+
+from sir import indexing, shards
+
+
+class ShardWriterTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def read(self, path):
+        with shards.open_shard(path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_shards(self):
+        writer = shards.ShardWriter(self.directory, "artist", 2)
+        for i in range(5):
+            writer.write(b'{"id":%d}' % i)
+        paths = shards.shard_paths(self.directory, "artist")
+        self.assertEqual([os.path.basename(p) for p in paths],
+                         ["artist-00000.jsonl.gz", "artist-00001.jsonl.gz"])
+        writer.close()
+        paths = shards.shard_paths(self.directory, "artist")
+        self.assertEqual(len(paths), 3)
+        self.assertEqual([self.read(p) for p in paths],
+                         [[{"id": 0}, {"id": 1}], [{"id": 2}, {"id": 3}],
+                          [{"id": 4}]])
+        self.assertEqual((writer.documents, writer.shards), (5, 3))
+
+    def test_existing_shards_are_removed(self):
+        writer = shards.ShardWriter(self.directory, "artist", 1)
+        writer.write(b"{}")
+        writer.write(b"{}")
+        writer = shards.ShardWriter(self.directory, "artist", 1, "none")
+        writer.write(b"{}")
+        writer.close()
+        self.assertEqual([os.path.basename(p) for p in
+                          shards.shard_paths(self.directory, "artist")],
+                         ["artist-00000.jsonl"])
+
+    @mock.patch("sir.shards.zstandard", None)
+    def test_zstd_missing(self):
+        self.assertRaises(ValueError, shards.open_shard,
+                          os.path.join(self.directory, "a.jsonl.zst"), "wb")
+
+    def test_queue_to_shards(self):
+        queue = Queue()
+        queue.put([{"id": 1}, indexing.encode_document({"id": 2})])
+        queue.put({"id": 3})
+        queue.put(None)
+        shards.queue_to_shards(queue, "artist", self.directory, 10, "gzip")
+        path, = shards.shard_paths(self.directory, "artist")
+        with gzip.open(path) as f:
+            self.assertEqual([json.loads(line) for line in f],
+                             [{"id": 1}, {"id": 2}, {"id": 3}])
+        self.assertIsNone(queue.get(timeout=1))
+
+
+class ExportTest(TestCase):
+    @mock.patch("sir.shards.indexing._multiprocessed_import")
+    def test_export(self, mock_import):
+        shards.export({"entity_type": ["artist"], "directory": "out",
+                       "shard_size": 5, "compression": "gzip"})
+        args, kwargs = mock_import.call_args
+        self.assertEqual(args, (["artist"],))
+        sender = kwargs["sender"]
+        self.assertEqual(sender.func, shards.queue_to_shards)
+        self.assertEqual(sender.keywords, {"directory": "out",
+                                           "shard_size": 5,
+                                           "compression": "gzip"})
+
+
+class LoadTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        writer = shards.ShardWriter(self.directory, "artist", 3)
+        for i in range(5):
+            writer.write(b'{"id":%d}' % i)
+        writer.close()
+        self.args = {"entity_type": None, "directory": self.directory,
+                     "parallel": 2, "resume": False}
+        config_patcher = mock.patch("sir.shards.config.CFG")
+        cfg = config_patcher.start()
+        self.addCleanup(config_patcher.stop)
+        cfg.getint.side_effect = lambda section, option, fallback=None: {
+            "batch_size": 2, "retries": 0}[option]
+        cfg.getfloat.return_value = 0
+
+    def test_progress(self):
+        path = os.path.join(self.directory, "progress.json")
+        progress = shards.LoadProgress(path)
+        progress.update("a", 5)
+        self.assertEqual(shards.LoadProgress(path).sent("a"), 5)
+        self.assertEqual(shards.LoadProgress(path, reset=True).sent("a"), 0)
+
+    @mock.patch("sir.shards.util.post_documents")
+    def test_load_shard(self, mock_post):
+        path = shards.shard_paths(self.directory, "artist")[0]
+        progress = shards.LoadProgress(os.path.join(self.directory, "p"))
+        progress.update("key", 1)
+        connection = mock.Mock()
+        sent = shards._load_shard(connection, path, "key", progress, 1, 0, 0)
+        self.assertEqual(sent, 2)
+        self.assertEqual(mock_post.call_args_list,
+                         [mock.call(connection, [b'{"id":1}']),
+                          mock.call(connection, [b'{"id":2}'])])
+        self.assertEqual(progress.sent("key"), 3)
+
+    @mock.patch("sir.shards.util.post_documents")
+    @mock.patch("sir.shards.util.solr_connection")
+    @mock.patch("sir.shards.util.check_solr_cores_version")
+    def test_load(self, mock_check, mock_connection, mock_post):
+        shards.load(self.args)
+        mock_check.assert_called_once_with(["artist"])
+        mock_connection.assert_called_once_with("artist", pool_size=2)
+        sent = [doc for call in mock_post.call_args_list
+                for doc in call[0][1]]
+        self.assertEqual(sorted(sent), [b'{"id":%d}' % i for i in range(5)])
+        mock_connection.return_value.commit.assert_called_once_with()
+
+        mock_post.reset_mock()
+        self.args["resume"] = True
+        shards.load(self.args)
+        mock_post.assert_not_called()
+
+    @mock.patch("sir.shards.util.post_documents")
+    @mock.patch("sir.shards.util.solr_connection")
+    @mock.patch("sir.shards.util.check_solr_cores_version")
+    def test_load_failure(self, mock_check, mock_connection, mock_post):
+        mock_post.side_effect = ValueError("Test Error")
+        shards.load(self.args)
+        mock_connection.return_value.commit.assert_not_called()
+        indexing.FAILED.value = False
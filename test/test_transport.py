@@ -0,0 +1,142 @@
+import multiprocessing
+import pickle
+import threading
+from unittest import mock, TestCase
+
+from sir.config import ConfigError
+from sir.transport import (Batch, BatchingQueue, BoundedChannel, TagDone,
+                           Transport)
+
+
+class BatchingQueueTest(TestCase):
+    def setUp(self):
+        self.puts = []
+        self.queue = BatchingQueue(self, 2)
+
+    def put(self, item):
+        self.puts.append(item)
+
+    def test_full_batches(self):
+        for i in range(5):
+            self.queue.put(i)
+        self.assertEqual(self.puts, [[0, 1], [2, 3]])
+
+    def test_flush(self):
+        for i in range(3):
+            self.queue.put(i)
+        self.queue.flush()
+        self.queue.flush()
+        self.assertEqual(self.puts, [[0, 1], [2]])
+
+    def test_tags(self):
+        self.queue.start((1, 5))
+        for i in range(3):
+            self.queue.put(i)
+        self.queue.finish()
+        self.queue.put(3)
+        self.queue.finish()
+        self.assertEqual(self.puts, [[0, 1], [2], TagDone((1, 5), 3), [3]])
+        self.assertEqual([getattr(b, "tag", None) for b in self.puts[:2]],
+                         [(1, 5), (1, 5)])
+        self.assertNotIsInstance(self.puts[3], Batch)
+
+    def test_waited(self):
+        with mock.patch("sir.transport.time.time",
+                        side_effect=[0, 2, 5, 6]):
+            for i in range(3):
+                self.queue.put(i)
+            self.queue.flush()
+        self.assertEqual(self.queue.waited, 3)
+
+    def test_pickle_batch(self):
+        batch = pickle.loads(pickle.dumps(Batch([1, 2], (1, 5))))
+        self.assertEqual(batch, [1, 2])
+        self.assertEqual(batch.tag, (1, 5))
+
+
+class BoundedChannelTest(TestCase):
+    def setUp(self):
+        self.channel = BoundedChannel(multiprocessing.SimpleQueue(), 2, 10,
+                                      multiprocessing.Condition(),
+                                      multiprocessing.Array("q", 2,
+                                                            lock=False))
+        self.addCleanup(self.channel.close)
+
+    def _put_in_thread(self, item):
+        thread = threading.Thread(target=self.channel.put, args=(item,))
+        thread.start()
+        thread.join(0.2)
+        return thread
+
+    def test_blocks_when_full(self):
+        self.channel.put([{"id": 1}, {"id": 2}])
+        self.assertEqual(self.channel.depth(), (2, 0))
+        thread = self._put_in_thread([{"id": 3}])
+        self.assertTrue(thread.is_alive())
+        self.assertEqual(self.channel.get(), [{"id": 1}, {"id": 2}])
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.channel.depth(), (1, 0))
+
+    def test_bytes(self):
+        self.channel.put([b"12345678"])
+        self.assertEqual(self.channel.depth(), (1, 8))
+        thread = self._put_in_thread(b"123")
+        self.assertTrue(thread.is_alive())
+        self.channel.get()
+        thread.join(5)
+        self.assertEqual(self.channel.depth(), (1, 3))
+
+    def test_oversized_item(self):
+        thread = self._put_in_thread([1, 2, 3])
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.channel.depth(), (3, 0))
+
+    def test_messages_not_counted(self):
+        self.channel.put([1, 2])
+        self.channel.put(TagDone((1, 5), 2))
+        self.channel.put(None)
+        self.assertEqual(self.channel.depth(), (2, 0))
+        self.channel.get()
+        self.assertEqual(self.channel.get(), TagDone((1, 5), 2))
+        self.assertIsNone(self.channel.get())
+        self.assertEqual(self.channel.depth(), (0, 0))
+
+
+def put_batch(channel):
+    channel.put([{"foo": "bar"}])
+
+
+class TransportTest(TestCase):
+    def _test_transport(self, kind, max_documents=0):
+        data_transport = Transport(kind, ["a", "b"], max_documents)
+        self.addCleanup(data_transport.close)
+        self.assertEqual(set(data_transport.channels), {"a", "b"})
+        p = multiprocessing.Process(target=put_batch,
+                                    args=(data_transport.channels["a"],))
+        p.start()
+        self.assertEqual(data_transport.channels["a"].get(), [{"foo": "bar"}])
+        p.join()
+
+    def test_pipe(self):
+        self._test_transport("pipe")
+
+    def test_manager(self):
+        self._test_transport("manager")
+
+    def test_bounded_pipe(self):
+        self._test_transport("pipe", 10)
+
+    def test_bounded_manager(self):
+        self._test_transport("manager", 10)
+
+    def test_depths(self):
+        data_transport = Transport("manager", ["a"], 10)
+        self.addCleanup(data_transport.close)
+        self.assertIsInstance(data_transport.channels["a"], BoundedChannel)
+        data_transport.channels["a"].put([1, 2])
+        self.assertEqual(data_transport.depths(), {"a": (2, 0)})
+        self.assertEqual(Transport("pipe", ["a"]).depths(), {})
+
+    def test_unknown(self):
+        self.assertRaises(ConfigError, Transport, "carrier-pigeon", ["a"])
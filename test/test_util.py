@@ -1,9 +1,12 @@
 from unittest import mock, TestCase
 
+import pysolr
+
 from test.models import B
 from json import dumps
 from sir import util
 from sir.schema import searchentities
+from sqlalchemy.orm import Session, sessionmaker
 
 
 def noop(*args, **kwargs):
@@ -51,3 +54,114 @@ class VersionCheckerTest(TestCase):
                                 "^testcore: Expected 1.1, got 1.0",
                                 util.solr_version_check,
                                 "testcore")
+
+
+class ShadowCoreTest(TestCase):
+    def setUp(self):
+        config = mock.patch("sir.util.config.CFG")
+        cfg = config.start()
+        self.addCleanup(config.stop)
+        cfg.get.side_effect = lambda section, option, fallback=None: {
+            "uri": "http://solr"}.get(option, fallback)
+        get = mock.patch("sir.util.requests.get")
+        self.get = get.start()
+        self.addCleanup(get.stop)
+        post = mock.patch("sir.util.requests.post")
+        self.post = post.start()
+        self.addCleanup(post.stop)
+        connection = mock.patch("sir.util.solr_connection")
+        self.connection = connection.start()
+        self.addCleanup(connection.stop)
+
+    def actions(self):
+        return [call[1]["params"] for call in self.get.call_args_list]
+
+    def test_create(self):
+        self.get.return_value.json.return_value = {
+            "status": {"artist_shadow": {}}}
+        self.assertEqual(util.prepare_shadow_core("artist"), "artist_shadow")
+        self.assertEqual(self.actions(),
+                         [{"action": "STATUS", "wt": "json",
+                           "core": "artist_shadow"},
+                          {"action": "CREATE", "wt": "json",
+                           "name": "artist_shadow",
+                           "instanceDir": "artist_shadow",
+                           "configSet": "artist"}])
+        self.connection.assert_called_once_with("artist_shadow")
+        self.connection.return_value.delete.assert_called_once_with(
+            q="*:*", commit=True)
+        self.post.assert_called_once_with(
+            "http://solr/artist_shadow/config",
+            json={"set-property": util.SHADOW_CORE_PROPERTIES})
+
+    def test_existing(self):
+        self.get.return_value.json.return_value = {
+            "status": {"artist_shadow": {"name": "artist_shadow"}}}
+        util.prepare_shadow_core("artist", clear=False)
+        self.assertEqual(len(self.actions()), 1)
+        self.connection.assert_not_called()
+        self.post.assert_called_once_with(
+            "http://solr/artist_shadow/config",
+            json={"set-property": util.SHADOW_CORE_PROPERTIES})
+
+    def test_restore(self):
+        util.restore_shadow_core("artist_shadow")
+        self.post.assert_called_once_with(
+            "http://solr/artist_shadow/config",
+            json={"unset-property":
+                  ["updateHandler.autoCommit.openSearcher",
+                   "updateHandler.autoSoftCommit.maxTime"]})
+
+
+class PostDocumentsTest(TestCase):
+    def setUp(self):
+        self.solr_connection = mock.Mock(url="http://solr/core", timeout=60,
+                                         auth=None)
+        self.post = self.solr_connection.get_session.return_value.post
+        self.post.return_value.status_code = 200
+
+    def test_body(self):
+        util.post_documents(self.solr_connection, [b'{"a":1}', b'{"b":2}'])
+        args, kwargs = self.post.call_args
+        self.assertEqual(args, ("http://solr/core/update",))
+        self.assertEqual(kwargs["data"], b'[{"a":1},{"b":2}]')
+
+    def test_error_status(self):
+        self.post.return_value.status_code = 400
+        self.assertRaises(pysolr.SolrError, util.post_documents,
+                          self.solr_connection, [b'{"a":1}'])
+
+    def test_commit(self):
+        util.solr_commit(self.solr_connection, open_searcher=False)
+        args, kwargs = self.post.call_args
+        self.assertEqual(kwargs["params"],
+                         {"commit": "true", "openSearcher": "false"})
+        self.assertEqual(kwargs["data"], b"[]")
+        util.solr_commit(self.solr_connection, soft=True)
+        args, kwargs = self.post.call_args
+        self.assertEqual(kwargs["params"], {"softCommit": "true"})
+
+
+class UseSnapshotTest(TestCase):
+    def begin(self, session):
+        connection = mock.Mock()
+        session.dispatch.after_begin(session, None, connection)
+        return [c[0][0] for c in connection.exec_driver_sql.call_args_list]
+
+    def test_session(self):
+        session = Session()
+        util.use_snapshot(session, "00000003-0000001B-1")
+        self.assertEqual(self.begin(session),
+                         ["SET TRANSACTION ISOLATION LEVEL REPEATABLE READ "
+                          "READ ONLY",
+                          "SET TRANSACTION SNAPSHOT '00000003-0000001B-1'"])
+
+    def test_sessionmaker(self):
+        maker = sessionmaker()
+        util.use_snapshot(maker, "00000003-0000001B-1")
+        self.assertEqual(len(self.begin(maker())), 2)
+        self.assertEqual(self.begin(Session()), [])
+
+    def test_invalid_snapshot(self):
+        self.assertRaises(ValueError, util.use_snapshot, Session(),
+                          "1'; DROP TABLE artist; --")
@@ -0,0 +1,79 @@
+import os
+from unittest import mock, TestCase
+
+from sir import workers
+
+
+def square(x):
+    return x * x
+
+
+def getpid(_):
+    return os.getpid()
+
+
+def fail(_):
+    raise ValueError("Test Error")
+
+
+class WorkerPoolTest(TestCase):
+    def tearDown(self):
+        self.pool.terminate()
+
+    def test_results(self):
+        self.pool = workers.WorkerPool(2)
+        res = sorted(self.pool.imap_unordered(square, range(10)))
+        self.assertEqual(res, [x * x for x in range(10)])
+
+    def test_lazy_consumption(self):
+        self.pool = workers.WorkerPool(1)
+        consumed = []
+
+        def tasks():
+            for i in range(10):
+                consumed.append(i)
+                yield i
+
+        results = self.pool.imap_unordered(square, tasks(), backlog=2)
+        next(results)
+        self.assertLessEqual(len(consumed), 3)
+
+    def test_persistent_workers(self):
+        self.pool = workers.WorkerPool(1)
+        pids = set(self.pool.imap_unordered(getpid, range(5)))
+        self.assertEqual(len(pids), 1)
+        self.pool.close()
+        self.pool.join()
+        self.assertIn("Ran 5 tasks in 1 worker processes, avoiding 4 forks",
+                      self.pool.report())
+
+    def test_maxtasks(self):
+        self.pool = workers.WorkerPool(1, maxtasks=1)
+        pids = set(self.pool.imap_unordered(getpid, range(3)))
+        self.assertEqual(len(pids), 3)
+
+    def test_max_rss(self):
+        with mock.patch("sir.workers.current_rss", return_value=2):
+            self.pool = workers.WorkerPool(1, max_rss=1)
+            pids = set(self.pool.imap_unordered(getpid, range(3)))
+        self.assertEqual(len(pids), 3)
+
+    def test_exception(self):
+        self.pool = workers.WorkerPool(1)
+        with self.assertRaisesRegex(ValueError, "Test Error"):
+            list(self.pool.imap_unordered(fail, range(1)))
+
+    def test_return_exceptions(self):
+        self.pool = workers.WorkerPool(1)
+        res = list(self.pool.imap_unordered(fail, [42],
+                                            return_exceptions=True))
+        self.assertEqual(len(res), 1)
+        self.assertIsInstance(res[0], workers.TaskError)
+        self.assertEqual(res[0].args, 42)
+        self.assertIsInstance(res[0].exception, ValueError)
+
+
+class PeakRssTest(TestCase):
+    def test_peak_rss(self):
+        workers.reset_peak_rss()
+        self.assertGreaterEqual(workers.peak_rss(), workers.current_rss())